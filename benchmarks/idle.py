@@ -0,0 +1,104 @@
+"""
+    idle.py: memory held by idle keep-alive clients, as a regression number
+
+    python -m benchmarks.idle --connections 5000 [--max-bytes 16384]
+
+Each client sends one request through the proxy, reads the response and
+keeps its connection open. The resident memory of the proxy is read from
+/proc before and after, the difference divided by the number of clients
+is the cost of an idle connection. With --max-bytes the benchmark exits
+with an error when the cost is higher. Linux only.
+"""
+
+import argparse
+import json
+import resource
+import socket
+import sys
+import time
+
+from .load import ProxyProcess, read_response
+from .origin import OriginServer
+
+
+def resident_bytes(proxy: ProxyProcess) -> int:
+    total = 0
+    for pid in proxy.pids():
+        with open('/proc/%d/status' % pid) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    total += int(line.split()[1]) * 1024
+    return total
+
+
+def open_clients(proxy_port: int, origin_port: int, count: int):
+    request = ('GET http://127.0.0.1:%d/bytes/64 HTTP/1.1\r\n'
+               'Host: 127.0.0.1:%d\r\n\r\n' % (origin_port, origin_port)
+               ).encode()
+    socks = []
+    for _ in range(count):
+        sock = socket.create_connection(('127.0.0.1', proxy_port))
+        sock.sendall(request)
+        read_response(sock, bytearray())
+        socks.append(sock)
+    return socks
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--connections', type=int, default=5000)
+    parser.add_argument('--settle', type=float, default=1,
+                        help='seconds to wait before reading the memory')
+    parser.add_argument('--max-bytes', type=int,
+                        help='fail above this many bytes per connection')
+    parser.add_argument('--output', help='write the JSON here too')
+    parser.add_argument('proxy_args', nargs='*',
+                        help='extra proxy flags, after --')
+    options = parser.parse_args(argv)
+
+    # the benchmark and the proxy each hold a socket per client
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard != resource.RLIM_INFINITY and options.connections + 256 > hard:
+        parser.error('--connections is above the open files limit %d' % hard)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    origin = OriginServer().start()
+    proxy = ProxyProcess(list(options.proxy_args), False, {})
+    proxy.start()
+    try:
+        # the first requests warm up the code paths and the upstream pool
+        for sock in open_clients(proxy.port, origin.port, 64):
+            sock.close()
+        time.sleep(options.settle)
+        before = resident_bytes(proxy)
+        socks = open_clients(proxy.port, origin.port, options.connections)
+        time.sleep(options.settle)
+        after = resident_bytes(proxy)
+        for sock in socks:
+            sock.close()
+    finally:
+        proxy.stop()
+        origin.stop()
+
+    per_connection = (after - before) // options.connections
+    results = {
+        'python': sys.version.split()[0],
+        'proxy_args': options.proxy_args,
+        'connections': options.connections,
+        'rss_before_mb': round(before / 2 ** 20, 2),
+        'rss_after_mb': round(after / 2 ** 20, 2),
+        'bytes_per_idle_connection': per_connection,
+    }
+    text = json.dumps(results, indent=2)
+    print(text)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(text + '\n')
+    if options.max_bytes is not None and per_connection > options.max_bytes:
+        print('%d bytes per idle connection, above %d' % (
+            per_connection, options.max_bytes), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,296 @@
+"""
+    load.py: drive concurrent clients through the proxy and report JSON
+
+    python -m benchmarks.load --scenarios plain,connect,mitm --duration 10
+
+Scenarios:
+    plain    absolute-form GET requests to a plain http origin
+    connect  a CONNECT tunnel per client, plain http requests inside it
+    mitm     a CONNECT tunnel to a TLS origin on port 443, intercepted
+             with --man-in-the-middle; binding 443 needs the privilege,
+             and the proxy needs its CA in proxy/certs
+
+Each client keeps one connection and sends requests back to back. The
+proxy runs as a subprocess by default, its CPU time and peak RSS are
+read from /proc, so they are only reported on Linux. With --in-process
+the proxy runs in a thread of the benchmark and these are not reported.
+"""
+
+from typing import Dict, List, Optional
+import argparse
+import json
+import os
+import random
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from .origin import OriginServer, make_certificate, tls_context
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentile(values: List[float], fraction: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def read_response(sock, buffered: bytearray) -> int:
+    """Read one response with a Content-Length, return its body size."""
+    while True:
+        end = buffered.find(b'\r\n\r\n')
+        if end >= 0:
+            break
+        data = sock.recv(65536)
+        if not data:
+            raise ConnectionError('connection closed in the head')
+        buffered += data
+    head = bytes(buffered[:end]).lower()
+    start = head.find(b'content-length:')
+    size = int(head[start + 15:head.find(b'\r\n', start)]) \
+        if start >= 0 else 0
+    total = end + 4 + size
+    while len(buffered) < total:
+        data = sock.recv(max(65536, total - len(buffered)))
+        if not data:
+            raise ConnectionError('connection closed in the body')
+        buffered += data
+    del buffered[:total]
+    return size
+
+
+def open_tunnel(proxy_port: int, host: str, port: int):
+    sock = socket.create_connection(('127.0.0.1', proxy_port))
+    sock.sendall(b'CONNECT %s:%d HTTP/1.1\r\nHost: %s:%d\r\n\r\n' % (
+        host.encode(), port, host.encode(), port))
+    buffered = bytearray()
+    while b'\r\n\r\n' not in buffered:
+        data = sock.recv(4096)
+        if not data:
+            raise ConnectionError('tunnel refused')
+        buffered += data
+    if not buffered.startswith(b'HTTP/1.1 200'):
+        raise ConnectionError(bytes(buffered).split(b'\r\n')[0].decode())
+    return sock
+
+
+class Client(threading.Thread):
+
+    def __init__(self, scenario: str, proxy_port: int, origin_port: int,
+                 size: int, deadline: float):
+        super().__init__(daemon=True)
+        self.scenario = scenario
+        self.proxy_port = proxy_port
+        self.origin_port = origin_port
+        self.size = size
+        self.deadline = deadline
+        self.latencies: List[float] = []
+        self.bytes = 0
+        self.errors = 0
+
+    def connect(self):
+        if self.scenario == 'plain':
+            sock = socket.create_connection(('127.0.0.1', self.proxy_port))
+            target = 'http://127.0.0.1:%d/bytes/%d' % (self.origin_port,
+                                                        self.size)
+        elif self.scenario == 'connect':
+            sock = open_tunnel(self.proxy_port, '127.0.0.1',
+                               self.origin_port)
+            target = '/bytes/%d' % self.size
+        else:
+            sock = open_tunnel(self.proxy_port, 'localhost', 443)
+            context = ssl.create_default_context()
+            # the certificate is minted by the proxy's own CA
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+            sock = context.wrap_socket(sock, server_hostname='localhost')
+            target = '/bytes/%d' % self.size
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        request = ('GET %s HTTP/1.1\r\nHost: localhost\r\n\r\n'
+                   % target).encode()
+        return sock, request
+
+    def run(self):
+        while time.monotonic() < self.deadline:
+            try:
+                sock, request = self.connect()
+            except (OSError, ConnectionError):
+                self.errors += 1
+                time.sleep(0.01)
+                continue
+            buffered = bytearray()
+            try:
+                while time.monotonic() < self.deadline:
+                    started = time.perf_counter()
+                    sock.sendall(request)
+                    self.bytes += read_response(sock, buffered)
+                    self.latencies.append(time.perf_counter() - started)
+            except (OSError, ConnectionError, ValueError):
+                self.errors += 1
+            finally:
+                sock.close()
+
+
+class ProxyProcess:
+
+    def __init__(self, args: List[str], in_process: bool,
+                 env: Dict[str, str]):
+        self.port = random.randint(20000, 40000)
+        self.args = ['-p', str(self.port), '--access-log', ''] + args
+        self.in_process = in_process
+        self.env = env
+        self.process: Optional[subprocess.Popen] = None
+
+    def start(self):
+        if self.in_process:
+            os.environ.update(self.env)
+            from proxy.__main__ import flags, TcpServer
+            flags.parse_args(self.args)
+            server = TcpServer('127.0.0.1', self.port)
+            threading.Thread(target=server.run, daemon=True).start()
+        else:
+            self.process = subprocess.Popen(
+                [sys.executable, '-m', 'proxy'] + self.args,
+                cwd=REPO_DIR, env=dict(os.environ, **self.env),
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            try:
+                socket.create_connection(('127.0.0.1', self.port)).close()
+                return
+            except OSError:
+                time.sleep(0.05)
+        raise RuntimeError('the proxy did not start')
+
+    def pids(self) -> List[int]:
+        # with --workers, the supervisor and its worker processes
+        pid = self.process.pid
+        with open('/proc/%d/task/%d/children' % (pid, pid)) as f:
+            return [pid] + [int(child) for child in f.read().split()]
+
+    def usage(self) -> Dict[str, Optional[float]]:
+        if self.process is None:
+            return {'cpu_seconds': None, 'peak_rss_mb': None}
+        try:
+            ticks = os.sysconf('SC_CLK_TCK')
+            cpu = rss = 0.0
+            for pid in self.pids():
+                with open('/proc/%d/stat' % pid) as f:
+                    fields = f.read().rsplit(')', 1)[1].split()
+                cpu += (int(fields[11]) + int(fields[12])) / ticks
+                with open('/proc/%d/status' % pid) as f:
+                    for line in f:
+                        if line.startswith('VmHWM:'):
+                            rss += int(line.split()[1]) / 1024
+            return {'cpu_seconds': cpu, 'peak_rss_mb': rss}
+        except (OSError, ValueError, IndexError):
+            return {'cpu_seconds': None, 'peak_rss_mb': None}
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait()
+
+
+def run_scenario(scenario: str, options, origins, env) -> Dict:
+    proxy_args = list(options.proxy_args)
+    if scenario == 'mitm':
+        proxy_args.append('--man-in-the-middle')
+    proxy = ProxyProcess(proxy_args, options.in_process, env)
+    proxy.start()
+    try:
+        origin_port = origins['tls'].port if scenario == 'mitm' \
+            else origins['plain'].port
+        if options.warmup:
+            warmup = Client(scenario, proxy.port, origin_port, options.size,
+                            time.monotonic() + options.warmup)
+            warmup.run()
+        before = proxy.usage()
+        deadline = time.monotonic() + options.duration
+        clients = [Client(scenario, proxy.port, origin_port, options.size,
+                          deadline) for _ in range(options.concurrency)]
+        started = time.monotonic()
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        elapsed = time.monotonic() - started
+        after = proxy.usage()
+    finally:
+        proxy.stop()
+    latencies = [v for c in clients for v in c.latencies]
+    total_bytes = sum(c.bytes for c in clients)
+    cpu = None
+    if after['cpu_seconds'] is not None:
+        cpu = round(after['cpu_seconds'] - before['cpu_seconds'], 3)
+
+    def ms(value):
+        return round(value * 1000, 3) if value is not None else None
+    return {
+        'scenario': scenario,
+        'concurrency': options.concurrency,
+        'response_size': options.size,
+        'duration_seconds': round(elapsed, 3),
+        'requests': len(latencies),
+        'errors': sum(c.errors for c in clients),
+        'requests_per_second': round(len(latencies) / elapsed, 1),
+        'megabytes_per_second': round(total_bytes / elapsed / 1e6, 2),
+        'latency_p50_ms': ms(percentile(latencies, 0.5)),
+        'latency_p99_ms': ms(percentile(latencies, 0.99)),
+        'proxy_cpu_seconds': cpu,
+        'proxy_peak_rss_mb': after['peak_rss_mb'],
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--scenarios', default='plain,connect,mitm')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--warmup', type=float, default=1)
+    parser.add_argument('--size', type=int, default=16 * 1024,
+                        help='response body size in bytes')
+    parser.add_argument('--in-process', action='store_true')
+    parser.add_argument('--output', help='write the JSON here too')
+    parser.add_argument('proxy_args', nargs='*',
+                        help='extra proxy flags, after --')
+    options = parser.parse_args(argv)
+    scenarios = [s for s in options.scenarios.split(',') if s]
+
+    tmpdir = tempfile.mkdtemp(prefix='proxy-bench-')
+    certfile, keyfile = make_certificate(tmpdir)
+    origins = {'plain': OriginServer().start()}
+    env = {}
+    if 'mitm' in scenarios:
+        try:
+            origins['tls'] = OriginServer(
+                443, tls_context(certfile, keyfile)).start()
+            env['SSL_CERT_FILE'] = certfile
+        except OSError as e:
+            print('Skip mitm, cannot bind port 443: %s' % e, file=sys.stderr)
+            scenarios.remove('mitm')
+
+    results = {
+        'python': sys.version.split()[0],
+        'platform': sys.platform,
+        'proxy_args': options.proxy_args,
+        'results': [run_scenario(s, options, origins, env)
+                    for s in scenarios],
+    }
+    for origin in origins.values():
+        origin.stop()
+    text = json.dumps(results, indent=2)
+    print(text)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(text + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+"""
+    micro.py: microbenchmarks of the parser and the buffers
+
+    python -m benchmarks.micro [--repeat 5] [--output micro.json]
+
+Every case reports the best of ``--repeat`` runs, in operations and
+megabytes per second.
+"""
+
+from typing import Callable, Dict, List
+import argparse
+import json
+import socket
+import sys
+import time
+
+from proxy.buffer import BufferChain, recv_chunks
+from proxy.http_parser import HttpParser, RESPONSE_PARSER
+
+REQUEST = (b'GET http://example.com/index.html?q=1 HTTP/1.1\r\n'
+           b'Host: example.com\r\n'
+           b'User-Agent: Mozilla/5.0 (X11; Linux x86_64) Gecko/20100101\r\n'
+           b'Accept: text/html,application/xhtml+xml;q=0.9,*/*;q=0.8\r\n'
+           b'Accept-Language: en-US,en;q=0.5\r\n'
+           b'Accept-Encoding: gzip, deflate, br\r\n'
+           b'Cookie: session=0123456789abcdef; theme=dark\r\n'
+           b'Connection: keep-alive\r\n\r\n')
+
+BODY = b'x' * (256 * 1024)
+RESPONSE = (b'HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\n'
+            b'Content-Length: %d\r\n\r\n' % len(BODY)) + BODY
+
+
+def chunked(body: bytes, size: int) -> bytes:
+    parts = [b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n']
+    for i in range(0, len(body), size):
+        piece = body[i:i + size]
+        parts.append(b'%x\r\n%s\r\n' % (len(piece), piece))
+    parts.append(b'0\r\n\r\n')
+    return b''.join(parts)
+
+
+CHUNKED_RESPONSE = chunked(BODY, 8192)
+
+
+def parse_request():
+    HttpParser().parse(REQUEST)
+    return len(REQUEST)
+
+
+def parse_request_split():
+    # a head trickling in, 32 bytes per read
+    parser = HttpParser()
+    view = memoryview(REQUEST)
+    for i in range(0, len(view), 32):
+        parser.parse(view[i:i + 32])
+    return len(REQUEST)
+
+
+def parse_response(data: bytes, read_size: int):
+    def run():
+        parser = HttpParser(RESPONSE_PARSER)
+        parser.request_method = 'GET'
+        view = memoryview(data)
+        for i in range(0, len(view), read_size):
+            piece = view[i:i + read_size]
+            while len(piece):
+                piece = piece[parser.parse(piece):]
+        assert parser.is_completed()
+        return len(data)
+    return run
+
+
+def buffer_chain(chunk_size: int, count: int):
+    chunks = [memoryview(bytearray(chunk_size)) for _ in range(count)]
+
+    def run():
+        chain = BufferChain()
+        for chunk in chunks:
+            chain.push(chunk)
+        while len(chain):
+            chain.consume(min(len(chain), 3 * chunk_size // 2))
+        return chunk_size * count
+    return run
+
+
+def socket_roundtrip(chunk_size: int, count: int):
+    # recv_chunks on one end, BufferChain.send on the other, through a
+    # socketpair
+    left, right = socket.socketpair()
+    left.setblocking(False)
+    right.setblocking(False)
+    payload = memoryview(bytes(chunk_size))
+    total = chunk_size * count
+
+    def run():
+        chain = BufferChain()
+        for _ in range(count):
+            chain.push(payload)
+        received = 0
+        while received < total:
+            if len(chain):
+                try:
+                    chain.send(left)
+                except BlockingIOError:
+                    pass
+            try:
+                chunks = recv_chunks(right)
+            except BlockingIOError:
+                continue
+            received += sum(len(c) for c in chunks)
+        return total
+    return run
+
+
+CASES: Dict[str, Callable] = {
+    'parse_request': parse_request,
+    'parse_request_split_32': parse_request_split,
+    'parse_response_length_64k': parse_response(RESPONSE, 64 * 1024),
+    'parse_response_chunked_16k': parse_response(CHUNKED_RESPONSE,
+                                                 16 * 1024),
+    'buffer_chain_push_consume_4k': buffer_chain(4096, 256),
+    'buffer_chain_push_consume_64k': buffer_chain(64 * 1024, 64),
+    'socketpair_send_recv_64k': socket_roundtrip(64 * 1024, 64),
+}
+
+
+def measure(func: Callable, repeat: int, min_time: float = 0.2) -> Dict:
+    # calibrate the number of calls to last about min_time per run
+    number = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_time:
+            break
+        number *= 2
+    best = elapsed
+    nbytes = func()
+    for _ in range(repeat - 1):
+        started = time.perf_counter()
+        for _ in range(number):
+            func()
+        best = min(best, time.perf_counter() - started)
+    return {
+        'ops_per_second': round(number / best, 1),
+        'megabytes_per_second': round(number * nbytes / best / 1e6, 2),
+        'microseconds_per_op': round(best / number * 1e6, 3),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--cases', help='comma separated, all by default')
+    parser.add_argument('--output', help='write the JSON here too')
+    options = parser.parse_args(argv)
+    names: List[str] = options.cases.split(',') if options.cases \
+        else list(CASES)
+    results = {
+        'python': sys.version.split()[0],
+        'results': {name: measure(CASES[name], options.repeat)
+                    for name in names},
+    }
+    text = json.dumps(results, indent=2)
+    print(text)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(text + '\n')
+
+
+if __name__ == '__main__':
+    main()
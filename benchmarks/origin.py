@@ -0,0 +1,83 @@
+"""
+    origin.py: local origin servers for the benchmarks
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+from urllib.parse import urlsplit
+import os
+import ssl
+import subprocess
+import threading
+
+PAYLOAD = os.urandom(16 * 1024 * 1024)
+
+
+class OriginHandler(BaseHTTPRequestHandler):
+    """``GET /bytes/<n>`` answers n bytes, anything else a short body."""
+
+    protocol_version = 'HTTP/1.1'
+    # the head and the body are separate writes
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        # proxies may forward the absolute form
+        path = urlsplit(self.path).path
+        size = 64
+        if path.startswith('/bytes/'):
+            try:
+                size = min(int(path[7:]), len(PAYLOAD))
+            except ValueError:
+                self.send_error(400)
+                return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(size))
+        self.end_headers()
+        self.wfile.write(memoryview(PAYLOAD)[:size])
+
+    def log_message(self, *args):
+        pass
+
+
+class OriginServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, port: int = 0, context: Optional[ssl.SSLContext] = None):
+        super().__init__(('127.0.0.1', port), OriginHandler)
+        if context is not None:
+            self.socket = context.wrap_socket(self.socket, server_side=True)
+        self.port = self.server_address[1]
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def make_certificate(directory: str):
+    """Create a self-signed certificate for localhost with openssl.
+
+    Return the certificate and key paths, the certificate is also what
+    the proxy must trust to reach the TLS origin.
+    """
+    certfile = os.path.join(directory, 'origin.pem')
+    keyfile = os.path.join(directory, 'origin.key')
+    subprocess.run([
+        'openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+        '-keyout', keyfile, '-out', certfile, '-days', '2',
+        '-subj', '/CN=localhost',
+        '-addext', 'subjectAltName=DNS:localhost,IP:127.0.0.1',
+    ], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return certfile, keyfile
+
+
+def tls_context(certfile: str, keyfile: str) -> ssl.SSLContext:
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(certfile, keyfile)
+    return context
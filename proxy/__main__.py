@@ -2,12 +2,39 @@
 
 import sys
 import argparse
+from typing import Optional
 
 from .tcp_server import TcpServer
+from .aio import AsyncProxyServer
+from .supervisor import Supervisor
 from .logger import Logger
 from .flag import flags
+from .cert import CertificateHelper, check_dependencies
+from . import rules, tls
+from .constants import (DEFAULT_HIGH_WATERMARK, DEFAULT_LOW_WATERMARK,
+                        DEFAULT_MEMORY_BUDGET, DEFAULT_CERT_CACHE_SIZE,
+                        DEFAULT_TLS_SESSION_CACHE_SIZE, DEFAULT_READ_BUDGET,
+                        DEFAULT_CONNECT_TIMEOUT, DEFAULT_DNS_CACHE_SIZE,
+                        DEFAULT_DNS_TTL, DEFAULT_DNS_NEGATIVE_TTL,
+                        DEFAULT_DNS_WORKERS, DEFAULT_POOL_MAX_IDLE,
+                        DEFAULT_POOL_IDLE_TIMEOUT, DEFAULT_CACHE_MEMORY_SIZE,
+                        DEFAULT_CACHE_DISK_SIZE, DEFAULT_CACHE_MAX_OBJECT_SIZE,
+                        DEFAULT_ACCESS_LOG_FILE, DEFAULT_IDLE_TIMEOUT,
+                        DEFAULT_HEADER_TIMEOUT, DEFAULT_HANDSHAKE_TIMEOUT,
+                        DEFAULT_HOST, DEFAULT_WORKERS, DEFAULT_THREADS,
+                        DEFAULT_DRAIN_TIMEOUT, DEFAULT_COMPRESS_MIN_SIZE,
+                        DEFAULT_COMPRESS_TYPES, DEFAULT_COMPRESS_THREADS,
+                        DEFAULT_RULES_RELOAD_INTERVAL, DEFAULT_PROFILE_SECONDS,
+                        DEFAULT_LAG_THRESHOLD, DEFAULT_CAPTURE_FORMAT,
+                        DEFAULT_CAPTURE_BUFFER_SIZE, DEFAULT_CAPTURE_FILE_SIZE,
+                        DEFAULT_CAPTURE_FILES, DEFAULT_METRICS_HOST)
 
 
+flags.add_argument(
+        "--host",
+        default=DEFAULT_HOST,
+        help="the address to which the server bind")
+
 flags.add_argument(
         "-p",
         "--port",
@@ -15,16 +42,337 @@ flags.add_argument(
         type=int,
         help="the port to which the server bind")
 
+flags.add_argument(
+        "-w",
+        "--workers",
+        default=DEFAULT_WORKERS,
+        type=int,
+        help="number of worker processes, more than 1 runs a supervisor "
+             "that restarts them and reloads them on SIGHUP")
+
+flags.add_argument(
+        "--threads",
+        default=DEFAULT_THREADS,
+        type=int,
+        help="number of event loop threads per process, new clients go to "
+             "the least loaded one; selector engine only")
+
+flags.add_argument(
+        "--drain-timeout",
+        default=DEFAULT_DRAIN_TIMEOUT,
+        type=float,
+        help="seconds a stopping worker lets its clients finish, "
+             "on SIGQUIT or a reload")
+
+flags.add_argument(
+        "--engine",
+        default="selector",
+        choices=["selector", "asyncio"],
+        help="the event loop: the built-in selector loop, or asyncio "
+             "(on uvloop if it is installed), faster but without --cache, "
+             "--splice, --compress, --capture-dir, --threads, "
+             "--client-rate and --lag-threshold")
+
 flags.add_argument(
         "-m",
         "--man-in-the-middle",
         action="store_true",
-        help="man in the middle interception")
+        help="man in the middle interception; certificates are minted in "
+             "process with the cryptography package, and shared by sibling "
+             "hosts with the publicsuffixlist package, when installed")
 
+flags.add_argument(
+        "--high-watermark",
+        default=DEFAULT_HIGH_WATERMARK,
+        type=int,
+        help="stop reading from one side while the other side has "
+             "this many bytes pending")
 
-if __name__ == '__main__':
-    args: argparse.Namespace = flags.parse_args()
-    Logger.setup(add_console_logger=True)
-    server = TcpServer('127.0.0.1', args.port)
+flags.add_argument(
+        "--low-watermark",
+        default=DEFAULT_LOW_WATERMARK,
+        type=int,
+        help="resume reading once the pending bytes drop to this")
+
+flags.add_argument(
+        "--memory-budget",
+        default=DEFAULT_MEMORY_BUDGET,
+        type=int,
+        help="pending bytes allowed across all connections, split between "
+             "the threads, 0 to disable")
+
+flags.add_argument(
+        "--read-budget",
+        default=DEFAULT_READ_BUDGET,
+        type=int,
+        help="bytes read from a connection before the others get their "
+             "turn, 0 to read until it would block")
+
+flags.add_argument(
+        "--client-rate",
+        default=0,
+        type=int,
+        help="bytes per second relayed for each client, both ways, "
+             "0 for no limit")
+
+flags.add_argument(
+        "--cert-cache-size",
+        default=DEFAULT_CERT_CACHE_SIZE,
+        type=int,
+        help="number of minted server TLS contexts kept in memory")
+
+flags.add_argument(
+        "--tls-session-cache-size",
+        default=DEFAULT_TLS_SESSION_CACHE_SIZE,
+        type=int,
+        help="number of upstream TLS sessions kept to resume them, "
+             "0 to disable")
+
+flags.add_argument(
+        "--connect-timeout",
+        default=DEFAULT_CONNECT_TIMEOUT,
+        type=float,
+        help="seconds to wait for an upstream connection")
+
+flags.add_argument(
+        "--idle-timeout",
+        default=DEFAULT_IDLE_TIMEOUT,
+        type=float,
+        help="seconds before closing a connection with no traffic")
+
+flags.add_argument(
+        "--header-timeout",
+        default=DEFAULT_HEADER_TIMEOUT,
+        type=float,
+        help="seconds to receive a complete request head")
+
+flags.add_argument(
+        "--handshake-timeout",
+        default=DEFAULT_HANDSHAKE_TIMEOUT,
+        type=float,
+        help="seconds to complete the TLS handshakes of an intercepted tunnel")
+
+flags.add_argument(
+        "--dns-cache-size",
+        default=DEFAULT_DNS_CACHE_SIZE,
+        type=int,
+        help="number of resolved host names kept in memory")
+
+flags.add_argument(
+        "--dns-ttl",
+        default=DEFAULT_DNS_TTL,
+        type=float,
+        help="seconds a resolved host name is reused")
+
+flags.add_argument(
+        "--dns-negative-ttl",
+        default=DEFAULT_DNS_NEGATIVE_TTL,
+        type=float,
+        help="seconds a failed resolution is reused")
+
+flags.add_argument(
+        "--dns-workers",
+        default=DEFAULT_DNS_WORKERS,
+        type=int,
+        help="threads running the name resolutions")
+
+flags.add_argument(
+        "--pool-max-idle",
+        default=DEFAULT_POOL_MAX_IDLE,
+        type=int,
+        help="idle upstream connections kept per host and port, "
+             "0 to disable pooling")
+
+flags.add_argument(
+        "--pool-idle-timeout",
+        default=DEFAULT_POOL_IDLE_TIMEOUT,
+        type=float,
+        help="seconds an idle upstream connection is kept")
+
+flags.add_argument(
+        "--cache",
+        action="store_true",
+        help="cache responses to plain http GET requests")
+
+flags.add_argument(
+        "--cache-memory-size",
+        default=DEFAULT_CACHE_MEMORY_SIZE,
+        type=int,
+        help="bytes of cached responses kept in memory")
+
+flags.add_argument(
+        "--cache-dir",
+        default=None,
+        help="directory of the disk cache tier, disabled if not set")
+
+flags.add_argument(
+        "--cache-disk-size",
+        default=DEFAULT_CACHE_DISK_SIZE,
+        type=int,
+        help="bytes of cached responses kept on disk")
+
+flags.add_argument(
+        "--cache-max-object-size",
+        default=DEFAULT_CACHE_MAX_OBJECT_SIZE,
+        type=int,
+        help="largest response body that is cached")
+
+flags.add_argument(
+        "--compress",
+        action="store_true",
+        help="compress responses for clients that accept gzip, or br and "
+             "zstd if installed; the requests in intercepted tunnels are "
+             "then parsed too")
+
+flags.add_argument(
+        "--compress-min-size",
+        default=DEFAULT_COMPRESS_MIN_SIZE,
+        type=int,
+        help="smallest Content-Length worth compressing, chunked responses "
+             "are always compressed")
+
+flags.add_argument(
+        "--compress-types",
+        default=DEFAULT_COMPRESS_TYPES,
+        help="comma separated media types to compress, a type ending with / "
+             "matches all its subtypes")
+
+flags.add_argument(
+        "--compress-threads",
+        default=DEFAULT_COMPRESS_THREADS,
+        type=int,
+        help="threads running the compression")
+
+flags.add_argument(
+        "--rules",
+        default=None,
+        help="file of allow, deny and route rules per host, as text or "
+             "compiled with python -m proxy.rules, see proxy/rules.py")
+
+flags.add_argument(
+        "--rules-reload-interval",
+        default=DEFAULT_RULES_RELOAD_INTERVAL,
+        type=float,
+        help="seconds between checks of the rules file for changes, 0 to "
+             "never reload it; only compiled files are reloaded")
+
+flags.add_argument(
+        "--profile-seconds",
+        default=DEFAULT_PROFILE_SECONDS,
+        type=float,
+        help="seconds a profile started with SIGUSR2 samples the stacks for")
+
+flags.add_argument(
+        "--profile-dir",
+        default=".",
+        help="directory of the profiles started with SIGUSR2, written as "
+             "collapsed stacks for flame graphs")
+
+flags.add_argument(
+        "--lag-threshold",
+        default=DEFAULT_LAG_THRESHOLD,
+        type=float,
+        help="log the loop iterations longer than this many seconds, with "
+             "the handler and operation that took the time, 0 to disable")
+
+flags.add_argument(
+        "--capture-dir",
+        default=None,
+        help="record the exchanges, and the bytes of the tunnels that "
+             "aren't decrypted, to files in this directory; the requests "
+             "in intercepted tunnels are then parsed too")
+
+flags.add_argument(
+        "--capture-format",
+        default=DEFAULT_CAPTURE_FORMAT,
+        choices=("har", "pcapng"),
+        help="har holds the exchanges only, pcapng the tunnel bytes too, as "
+             "made up TCP streams")
+
+flags.add_argument(
+        "--capture-hosts",
+        default="",
+        help="comma separated hosts to capture, with their subdomains, all "
+             "when empty")
+
+flags.add_argument(
+        "--capture-sample",
+        default=1.0,
+        type=float,
+        help="fraction of the exchanges and tunnels to capture")
+
+flags.add_argument(
+        "--capture-buffer-size",
+        default=DEFAULT_CAPTURE_BUFFER_SIZE,
+        type=int,
+        help="bytes waiting to be written before captures are dropped, "
+             "split between the threads")
+
+flags.add_argument(
+        "--capture-file-size",
+        default=DEFAULT_CAPTURE_FILE_SIZE,
+        type=int,
+        help="size at which a capture file is closed and a new one started")
+
+flags.add_argument(
+        "--capture-files",
+        default=DEFAULT_CAPTURE_FILES,
+        type=int,
+        help="capture files kept per process, the oldest are removed")
+
+flags.add_argument(
+        "--splice",
+        action="store_true",
+        help="relay plain CONNECT tunnels with splice(2) where available")
+
+flags.add_argument(
+        "--metrics-port",
+        default=0,
+        type=int,
+        help="serve Prometheus metrics, and the /debug/profile and "
+             "/debug/lag paths, on this port, 0 to disable; with "
+             "several workers, worker i serves them on this port + i")
+
+flags.add_argument(
+        "--metrics-host",
+        default=DEFAULT_METRICS_HOST,
+        help="the address the metrics and debug paths are served on, "
+             "they aren't authenticated")
+
+flags.add_argument(
+        "--access-log",
+        default=DEFAULT_ACCESS_LOG_FILE,
+        help="file of the JSON access records, empty to disable")
+
+
+def serve(slot: Optional[int] = None):
+    args = flags.args
+    if args.engine == 'asyncio':
+        server = AsyncProxyServer(args.host, args.port, slot)
+    else:
+        server = TcpServer(args.host, args.port, slot)
     server.run()
 
+
+def main(argv=None):
+    args: argparse.Namespace = flags.parse_args(argv)
+    Logger.setup(add_console_logger=True)
+    CertificateHelper.context_cache_size = args.cert_cache_size
+    if args.man_in_the_middle:
+        check_dependencies()
+    tls.sessions.size = args.tls_session_cache_size
+    if args.rules:
+        # fail once here, rather than in every worker process
+        try:
+            rules.load(args.rules)
+        except (OSError, rules.RulesError) as e:
+            sys.exit('Cannot load the rules: %s' % e)
+    if args.workers > 1:
+        Supervisor(args.workers, serve).run()
+    else:
+        serve()
+
+
+if __name__ == '__main__':
+    main()
+
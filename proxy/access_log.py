@@ -0,0 +1,143 @@
+"""
+    access_log.py: structured access records written off the event loop
+"""
+
+from typing import Optional
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class AccessLog:
+    """Write one JSON line per record to ``path``.
+
+    ``log`` only enqueues the record, the formatting and the file writes
+    happen on a background thread, which writes whatever is queued in a
+    single batch. When the queue is full, records are dropped and counted
+    rather than slowing down the workers.
+    """
+
+    def __init__(self, path: str, max_queue: int = 65536,
+                 batch_size: int = 1024):
+        self.path = path
+        self.batch_size = batch_size
+        self.queue: queue.Queue = queue.Queue(max_queue)
+        self.dropped = 0
+        self.thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='access-log',
+                                       daemon=True)
+        self.thread.start()
+
+    def log(self, record: dict):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def run(self):
+        # a batch is a single append, worker processes sharing the file
+        # don't interleave their lines
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            while True:
+                batch = [self.queue.get()]
+                while len(batch) < self.batch_size:
+                    try:
+                        batch.append(self.queue.get_nowait())
+                    except queue.Empty:
+                        break
+                stop = batch[-1] is None
+                data = ''.join(
+                    json.dumps(record, separators=(',', ':')) + '\n'
+                    for record in batch if record is not None).encode()
+                try:
+                    os.write(fd, data)
+                except OSError as e:
+                    logger.warning('Cannot write the access log: %s', e)
+                if stop:
+                    return
+        finally:
+            os.close(fd)
+
+    def close(self, timeout: float = 5.0):
+        if self.thread is None:
+            return
+        self.queue.put(None)
+        self.thread.join(timeout)
+        if self.dropped:
+            logger.warning('Dropped %d access records', self.dropped)
+
+
+class AccessRecorder:
+    """The access records of a client connection, one per request.
+
+    Each record gets the bytes counted since the previous one, received
+    from the client and written for it, and the close reason if the
+    connection ends before the request completes.
+    """
+
+    __slots__ = ('access_log', 'handler_id', 'client_addr', 'record',
+                 'started', 'bytes', 'close_reason')
+
+    def __init__(self, access_log: Optional[AccessLog], handler_id: int,
+                 client_addr):
+        self.access_log = access_log
+        self.handler_id = handler_id
+        self.client_addr = client_addr
+        self.record: Optional[dict] = None
+        self.started = 0.0
+        self.bytes = (0, 0)
+        self.close_reason: Optional[str] = None
+
+    @property
+    def client(self) -> Optional[str]:
+        # formatted per record, idle connections don't keep the string
+        if not self.client_addr:
+            return None
+        return '%s:%d' % tuple(self.client_addr[:2])
+
+    def start(self, request):
+        if self.access_log is None or self.record is not None:
+            return
+        self.record = {
+            'time': round(time.time(), 3),
+            'handler': self.handler_id,
+            'client': self.client,
+            'method': request.method,
+            'host': request.host,
+            'port': request.port,
+            'target': request.target.decode('latin-1'),
+            'status': None,
+            'cache': None,
+            'encoding': None,
+        }
+        self.started = time.monotonic()
+
+    def update(self, **fields):
+        if self.record is not None:
+            self.record.update(fields)
+
+    def finish(self, bytes_in: int, bytes_out: int,
+               reason: Optional[str] = None):
+        record, self.record = self.record, None
+        if record is None:
+            return
+        record['bytes_in'] = bytes_in - self.bytes[0]
+        record['bytes_out'] = bytes_out - self.bytes[1]
+        record['duration_ms'] = round(
+            (time.monotonic() - self.started) * 1000, 3)
+        record['reason'] = reason or self.close_reason or 'closed'
+        self.bytes = (bytes_in, bytes_out)
+        self.access_log.log(record)
+
+    def set_close_reason(self, reason: str):
+        # the first reason is the one that matters
+        if self.close_reason is None:
+            self.close_reason = reason
@@ -0,0 +1,669 @@
+"""
+    aio.py: the proxy on asyncio protocols and transports
+"""
+
+from typing import Dict, List, Optional, Set, Tuple
+import asyncio
+import logging
+import signal
+import socket
+import ssl
+import threading
+import time
+
+from .access_log import AccessLog, AccessRecorder
+from .cert import CertificateHelper
+from .constants import (CONNECTION_ESTABLISHED_MESSAGE, HAPPY_EYEBALLS_DELAY,
+                        DEFAULT_LAG_THRESHOLD)
+from .flag import flags
+from .http_handler import error_response, handler_ids
+from .http_parser import HttpParser, HttpParserError, RESPONSE_PARSER
+from .metrics import MetricsServer, WorkerMetrics, registry
+from .rules import DENY, ROUTE, Rules
+from .profiler import profiler
+from .supervisor import notify_ready
+from . import tls
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+logger = logging.getLogger(__name__)
+
+
+def set_result_once(future: asyncio.Future, result):
+    if not future.done():
+        future.set_result(result)
+
+
+class UpstreamProtocol(asyncio.Protocol):
+    """An upstream connection, attached to a client or idle in the pool."""
+
+    def __init__(self, key: Tuple[str, int, Optional[str]],
+                 pool: 'AsyncUpstreamPool'):
+        self.key = key
+        self.pool = pool
+        self.handler: Optional['ClientProtocol'] = None
+        self.transport: Optional[asyncio.Transport] = None
+        self.closed = False
+        self.idle_timer: Optional[asyncio.TimerHandle] = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        if self.handler:
+            self.handler.upstream_data(data)
+        else:
+            # nothing is expected on an idle connection
+            self.transport.close()
+
+    def eof_received(self):
+        if self.handler:
+            self.handler.upstream_eof()
+
+    def connection_lost(self, exc):
+        self.closed = True
+        if self.handler:
+            self.handler.upstream_lost(exc)
+        else:
+            self.pool.discard(self)
+
+    def pause_writing(self):
+        if self.handler:
+            self.handler.pause_client('upstream')
+
+    def resume_writing(self):
+        if self.handler:
+            self.handler.resume_client('upstream')
+
+
+class AsyncUpstreamPool:
+    """Idle keep-alive upstream connections, see pool.UpstreamPool.
+
+    Idle connections keep being read, so a close by the origin removes
+    them from the pool right away.
+    """
+
+    def __init__(self, loop, max_idle: int, idle_timeout: float):
+        self.loop = loop
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.idle: Dict[Tuple[str, int, Optional[str]],
+                        List[UpstreamProtocol]] = {}
+
+    def checkout(self, key) -> Optional[UpstreamProtocol]:
+        conns = self.idle.get(key)
+        while conns:
+            upstream = conns.pop()
+            upstream.idle_timer.cancel()
+            if not upstream.closed:
+                if not conns:
+                    del self.idle[key]
+                return upstream
+        self.idle.pop(key, None)
+        return None
+
+    def checkin(self, upstream: UpstreamProtocol):
+        upstream.handler = None
+        if self.max_idle <= 0:
+            upstream.transport.close()
+            return
+        upstream.transport.resume_reading()
+        conns = self.idle.setdefault(upstream.key, [])
+        if len(conns) >= self.max_idle:
+            oldest = conns.pop(0)
+            oldest.idle_timer.cancel()
+            oldest.transport.close()
+        upstream.idle_timer = self.loop.call_later(
+            self.idle_timeout, upstream.transport.close)
+        conns.append(upstream)
+
+    def discard(self, upstream: UpstreamProtocol):
+        conns = self.idle.get(upstream.key)
+        if conns and upstream in conns:
+            conns.remove(upstream)
+            upstream.idle_timer.cancel()
+            if not conns:
+                del self.idle[upstream.key]
+
+    def close(self):
+        for conns in self.idle.values():
+            for upstream in conns:
+                upstream.idle_timer.cancel()
+                upstream.transport.close()
+        self.idle.clear()
+
+
+class ClientProtocol(asyncio.Protocol):
+    """HttpProxyHandler on transports.
+
+    Requests, responses, keep-alive pooling, tunnels and the interception
+    of port 443 behave as in the selector engine. Backpressure uses the
+    transports' write buffer limits, TLS upgrades use ``loop.start_tls``.
+    """
+
+    def __init__(self, server: 'AsyncProxyServer'):
+        self.server = server
+        self.loop = server.loop
+        self.metrics = server.metrics
+        self.id = next(handler_ids)
+        self.transport: Optional[asyncio.Transport] = None
+        self.upstream: Optional[UpstreamProtocol] = None
+        self.connect_task: Optional[asyncio.Task] = None
+        # data for one side while the other isn't ready for it
+        self.upstream_backlog: List = []
+        self.client_backlog: List = []
+        self.request = HttpParser()
+        self.response: Optional[HttpParser] = None
+        self.upstream_reusable = False
+        self.intercepting = False
+        # the local address to connect from, routed by the rules
+        self.egress: Optional[str] = None
+        # why the client isn't read
+        self.paused: Set[str] = set()
+        self.closed = False
+        self.bytes_up = 0
+        self.bytes_down = 0
+        self.bytes_to_client = 0
+        self.recorder: Optional[AccessRecorder] = None
+        # a single timer for whatever the client waits on, as in
+        # HttpProxyHandler
+        self.timeouts = server.timeouts
+        self.deadline: Optional[asyncio.TimerHandle] = None
+        self.deadline_reason: Optional[str] = None
+        self.last_activity = time.monotonic()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.set_deadline('header')
+        transport.set_write_buffer_limits(flags.args.high_watermark,
+                                          flags.args.low_watermark)
+        self.recorder = AccessRecorder(
+            self.server.access_log, self.id,
+            transport.get_extra_info('peername'))
+        self.server.handlers.add(self)
+        self.metrics.inc('handlers')
+
+    def data_received(self, data):
+        self.last_activity = time.monotonic()
+        self.bytes_up += len(data)
+        self.metrics.inc('client_bytes_received', len(data))
+        try:
+            self.feed_request(memoryview(data))
+        except HttpParserError as e:
+            logger.debug('Invalid request from client %s: %s',
+                         self.recorder.client, e)
+            self.recorder.set_close_reason('invalid request: %s' % e)
+            self.reply_error(e.status)
+
+    def eof_received(self):
+        self.recorder.set_close_reason('client closed')
+        if self.upstream:
+            self.upstream.transport.close()
+
+    def connection_lost(self, exc):
+        self.closed = True
+        self.cancel_deadline()
+        if exc is not None:
+            self.recorder.set_close_reason(
+                '%s: %s' % (type(exc).__name__, exc))
+        if self.connect_task:
+            self.connect_task.cancel()
+        if self.upstream:
+            self.upstream.handler = None
+            self.upstream.transport.close()
+        self.recorder.finish(self.bytes_up, self.bytes_to_client)
+        self.server.handlers.discard(self)
+
+    def pause_writing(self):
+        if self.upstream:
+            self.upstream.transport.pause_reading()
+
+    def resume_writing(self):
+        self.last_activity = time.monotonic()
+        if self.upstream:
+            self.upstream.transport.resume_reading()
+
+    def set_deadline(self, reason: str):
+        if self.deadline:
+            self.deadline.cancel()
+        self.deadline_reason = reason
+        self.deadline = self.loop.call_later(self.timeouts[reason],
+                                             self.on_deadline)
+
+    def cancel_deadline(self):
+        if self.deadline:
+            self.deadline.cancel()
+            self.deadline = None
+
+    def on_deadline(self):
+        self.deadline = None
+        if self.closed:
+            return
+        reason = self.deadline_reason
+        if reason == 'idle':
+            # activity only stamps last_activity, the timer is moved here
+            remaining = self.last_activity + self.timeouts['idle'] - \
+                time.monotonic()
+            if remaining > 0:
+                self.deadline = self.loop.call_later(remaining,
+                                                     self.on_deadline)
+                return
+        logger.debug('Handler %s: %s timeout', self.id, reason)
+        self.recorder.set_close_reason('%s timeout' % reason)
+        if reason == 'header':
+            self.reply_error(408)
+            # in case the client doesn't read the response
+            self.set_deadline('idle')
+        else:
+            self.abort()
+
+    def pause_client(self, reason: str):
+        if not self.paused and not self.closed:
+            self.transport.pause_reading()
+        self.paused.add(reason)
+
+    def resume_client(self, reason: str):
+        if reason not in self.paused:
+            return
+        self.paused.discard(reason)
+        if not self.paused and not self.closed:
+            self.transport.resume_reading()
+
+    def feed_request(self, data):
+        while len(data) and not self.closed:
+            if self.request.is_completed():
+                if not self.request.is_connect():
+                    # pipelined requests, the responses can't be told apart
+                    self.upstream_reusable = False
+                self.send_upstream(data)
+                return
+            in_head = not self.request.is_headers_completed()
+            if in_head and self.deadline_reason != 'header':
+                self.set_deadline('header')
+            n = self.request.parse(data)
+            if not in_head:
+                self.send_upstream(data[:n])
+            elif self.request.is_headers_completed():
+                self.on_request_head()
+            data = data[n:]
+
+    def on_request_head(self):
+        if not self.request.has_host():
+            raise HttpParserError('no host in request')
+        self.recorder.start(self.request)
+        self.set_deadline('idle')
+        if self.server.rules:
+            action, self.egress = self.server.rules.decide(self.request.host)
+            if action == DENY:
+                self.metrics.inc('rule_denials')
+                self.recorder.set_close_reason('denied by rule')
+                self.reply_error(403)
+                return
+            if action == ROUTE:
+                self.metrics.inc('rule_routes')
+        if not self.request.is_connect():
+            self.send_upstream(self.request.raw_head)
+        if not self.upstream:
+            self.connect_upstream()
+
+    def connect_upstream(self):
+        key = self.request.host, self.request.port, self.egress
+        if not self.request.is_connect():
+            upstream = self.server.pool.checkout(key)
+            if upstream:
+                self.metrics.inc('upstream_reuses')
+                self.attach_upstream(upstream)
+                return
+        # nothing can be forwarded before the upstream is connected
+        self.pause_client('connect')
+        self.connect_task = self.loop.create_task(self.open_upstream(key))
+
+    async def open_upstream(self, key: Tuple[str, int, Optional[str]]):
+        started = time.monotonic()
+        try:
+            _, upstream = await asyncio.wait_for(
+                self.loop.create_connection(
+                    lambda: UpstreamProtocol(key, self.server.pool),
+                    key[0], key[1],
+                    happy_eyeballs_delay=HAPPY_EYEBALLS_DELAY,
+                    local_addr=(key[2], 0) if key[2] else None),
+                flags.args.connect_timeout)
+        except (OSError, ValueError, asyncio.TimeoutError) as e:
+            # ValueError: a UnicodeError from the IDNA codec
+            self.connect_task = None
+            self.metrics.inc('upstream_connect_errors')
+            logger.warning('Cannot connect to upstream %s:%d: %r',
+                           key[0], key[1], e)
+            self.recorder.set_close_reason('connect failed: %r' % e)
+            self.reply_error(
+                504 if isinstance(e, asyncio.TimeoutError) else 502)
+            return
+        self.connect_task = None
+        self.metrics.inc('upstream_connects')
+        self.metrics.observe('upstream_connect_seconds',
+                             time.monotonic() - started)
+        if self.closed:
+            upstream.transport.close()
+            return
+        self.attach_upstream(upstream)
+        self.resume_client('connect')
+        if not self.request.is_connect():
+            return
+        if flags.args.man_in_the_middle and self.request.port == 443:
+            # start_tls resumes reading once the TLS layer is in place
+            self.transport.pause_reading()
+            self.write_client(CONNECTION_ESTABLISHED_MESSAGE)
+            self.recorder.update(status=200)
+            await self.intercept()
+        else:
+            self.write_client(CONNECTION_ESTABLISHED_MESSAGE)
+            self.recorder.update(status=200)
+
+    def attach_upstream(self, upstream: UpstreamProtocol):
+        self.upstream = upstream
+        upstream.handler = self
+        upstream.transport.set_write_buffer_limits(
+            flags.args.high_watermark, flags.args.low_watermark)
+        if not self.request.is_connect():
+            self.new_response()
+            self.upstream_reusable = True
+        backlog, self.upstream_backlog = self.upstream_backlog, []
+        for data in backlog:
+            self.send_upstream(data)
+
+    async def intercept(self):
+        host = self.request.host
+        self.intercepting = True
+        self.set_deadline('handshake')
+        future = self.loop.create_future()
+        context = CertificateHelper.get_context(
+            host, lambda ctx: self.loop.call_soon_threadsafe(
+                set_result_once, future, ctx))
+        self.metrics.inc('cert_cache_misses' if context is None
+                         else 'cert_cache_hits')
+        if context is None:
+            context = await future
+        if context is None or self.closed or self.upstream is None:
+            self.recorder.set_close_reason('no certificate for %s' % host)
+            self.abort()
+            return
+        started = time.monotonic()
+        try:
+            client, upstream = await asyncio.gather(
+                self.loop.start_tls(self.transport, self, context,
+                                    server_side=True),
+                # start_tls takes no session, the upstream isn't resumed
+                self.loop.start_tls(self.upstream.transport, self.upstream,
+                                    tls.client_context(),
+                                    server_hostname=host))
+        except (OSError, ssl.SSLError, ConnectionError) as e:
+            logger.info('TLS interception of %s failed: %r', host, e)
+            self.recorder.set_close_reason('handshake failed: %r' % e)
+            self.abort()
+            return
+        self.metrics.observe('tls_handshake_seconds',
+                             time.monotonic() - started)
+        self.metrics.inc(
+            'tls_client_resumptions'
+            if client.get_extra_info('ssl_object').session_reused
+            else 'tls_client_full_handshakes')
+        # the upstream session counters are left alone: the upstream is
+        # never resumed here, they'd only count intercepted tunnels
+        if self.closed or self.upstream is None:
+            return
+        self.set_deadline('idle')
+        self.transport = client
+        self.upstream.transport = upstream
+        self.intercepting = False
+        for transport in (client, upstream):
+            transport.set_write_buffer_limits(flags.args.high_watermark,
+                                              flags.args.low_watermark)
+        backlog, self.client_backlog = self.client_backlog, []
+        for data in backlog:
+            self.write_client(data)
+        backlog, self.upstream_backlog = self.upstream_backlog, []
+        for data in backlog:
+            self.send_upstream(data)
+
+    def send_upstream(self, data):
+        if self.upstream is None or self.intercepting:
+            self.upstream_backlog.append(data)
+            return
+        # counted as sent once the transport has it
+        self.metrics.inc('upstream_bytes_sent', len(data))
+        self.upstream.transport.write(data)
+
+    def write_client(self, data):
+        self.bytes_to_client += len(data)
+        self.metrics.inc('client_bytes_sent', len(data))
+        self.transport.write(data)
+
+    def upstream_data(self, data):
+        self.last_activity = time.monotonic()
+        self.bytes_down += len(data)
+        self.metrics.inc('upstream_bytes_received', len(data))
+        if self.intercepting:
+            self.client_backlog.append(data)
+            return
+        try:
+            self.feed_response(memoryview(data))
+        except HttpParserError as e:
+            logger.warning('Invalid response from upstream %s:%d: %s',
+                           self.request.host, self.request.port, e)
+            self.recorder.set_close_reason('invalid response: %s' % e)
+            if self.response and not self.response.is_headers_completed():
+                self.reply_error(e.status)
+            else:
+                self.abort()
+
+    def upstream_eof(self):
+        self.recorder.set_close_reason('upstream closed')
+        if not self.closed:
+            self.transport.close()
+
+    def upstream_lost(self, exc):
+        self.upstream = None
+        if exc is not None:
+            self.recorder.set_close_reason(
+                '%s: %s' % (type(exc).__name__, exc))
+        if not self.closed:
+            self.transport.close()
+
+    def feed_response(self, data):
+        while len(data):
+            if self.response is None:
+                # a tunnel, or an upstream that can't be reused anymore
+                self.write_client(data)
+                return
+            in_head = not self.response.is_headers_completed()
+            n = self.response.parse(data)
+            if not in_head:
+                self.write_client(data[:n])
+            elif self.response.is_headers_completed():
+                if not self.response.is_interim():
+                    self.recorder.update(status=self.response.status)
+                self.write_client(self.response.raw_head)
+            data = data[n:]
+            if self.response.is_completed():
+                if self.response.is_interim():
+                    self.new_response()
+                else:
+                    self.finish_exchange(extra=len(data) > 0)
+
+    def new_response(self):
+        self.response = HttpParser(RESPONSE_PARSER)
+        self.response.request_method = self.request.method
+
+    def finish_exchange(self, extra: bool):
+        self.recorder.finish(self.bytes_up, self.bytes_to_client,
+                             'complete')
+        if (
+            self.upstream_reusable
+            and not extra
+            and self.request.is_completed()
+            and self.request.is_keep_alive()
+            and self.response.is_keep_alive()
+            and self.upstream.transport.get_write_buffer_size() == 0
+        ):
+            self.server.pool.checkin(self.upstream)
+            self.upstream = None
+            self.request = HttpParser()
+            self.resume_client('upstream')
+        self.response = None
+        self.upstream_reusable = False
+        if self.server.draining:
+            self.drain()
+
+    def is_idle(self):
+        return (
+            self.upstream is None
+            and self.connect_task is None
+            and not self.request.is_started()
+        )
+
+    def drain(self):
+        # close flushes the response being written
+        if self.is_idle() and not self.closed:
+            self.recorder.set_close_reason('drain')
+            self.transport.close()
+
+    def reply_error(self, status: int):
+        self.recorder.update(status=status)
+        self.upstream_backlog = []
+        if not self.closed:
+            self.write_client(error_response(status))
+            self.transport.close()
+        if self.upstream:
+            self.upstream.transport.close()
+
+    def abort(self):
+        # drop both sides without flushing
+        if not self.closed:
+            self.transport.abort()
+        if self.upstream:
+            self.upstream.transport.abort()
+
+
+class AsyncProxyServer:
+    """Serve the proxy from an asyncio loop, uvloop if it is installed.
+
+    It is faster than the selector engine at plain forwarding, but the
+    selector engine only features are not available: the response cache,
+    splice, compression, capture, worker threads, client rate limits and
+    the lag watchdog. The selector engine stays the default until they
+    are. ``slot`` and SIGQUIT work as in TcpServer.
+    """
+
+    def __init__(self, addr: str, port: int, slot: Optional[int] = None):
+        self.addr = addr
+        self.port = port
+        self.slot = slot
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.server: Optional[asyncio.AbstractServer] = None
+        self.metrics_server: Optional[MetricsServer] = None
+        self.stopped: Optional[asyncio.Future] = None
+        self.draining = False
+        self.pool: Optional[AsyncUpstreamPool] = None
+        self.handlers: Set[ClientProtocol] = set()
+        self.access_log: Optional[AccessLog] = None
+        if flags.args.access_log:
+            self.access_log = AccessLog(flags.args.access_log)
+        self.timeouts = {
+            'header': flags.args.header_timeout,
+            'idle': flags.args.idle_timeout,
+            'handshake': flags.args.handshake_timeout,
+        }
+        self.rules: Optional[Rules] = None
+        if flags.args.rules:
+            self.rules = Rules(flags.args.rules,
+                               flags.args.rules_reload_interval)
+        self.metrics = WorkerMetrics({
+            'active_handlers': lambda: len(self.handlers),
+            'pending_bytes': self.pending_bytes,
+        })
+        registry.add(self.metrics)
+
+    def pending_bytes(self):
+        return sum(h.transport.get_write_buffer_size()
+                   for h in list(self.handlers) if h.transport)
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.pool = AsyncUpstreamPool(self.loop, flags.args.pool_max_idle,
+                                      flags.args.pool_idle_timeout)
+        self.server = await self.loop.create_server(
+            lambda: ClientProtocol(self), self.addr, self.port,
+            reuse_address=True, reuse_port=self.slot is not None,
+            backlog=socket.SOMAXCONN)
+        logger.info('Start %s server at %s, port %d',
+                    'uvloop' if uvloop else 'asyncio', self.addr, self.port)
+        self.stopped = self.loop.create_future()
+        if threading.current_thread() is threading.main_thread():
+            self.loop.add_signal_handler(signal.SIGQUIT, self.drain)
+            self.loop.add_signal_handler(
+                signal.SIGUSR2, profiler.start, flags.args.profile_seconds,
+                flags.args.profile_dir)
+        notify_ready()
+        try:
+            await self.stopped
+        finally:
+            self.server.close()
+            self.pool.close()
+
+    def drain(self):
+        if self.draining:
+            return
+        logger.info('Stop accepting, drain %d handlers', len(self.handlers))
+        self.draining = True
+        self.server.close()
+        if self.metrics_server:
+            self.metrics_server.stop()
+        for handler in list(self.handlers):
+            handler.drain()
+        self.loop.create_task(self.wait_drained())
+
+    async def wait_drained(self):
+        deadline = self.loop.time() + flags.args.drain_timeout
+        while self.handlers and self.loop.time() < deadline:
+            await asyncio.sleep(0.1)
+        for handler in list(self.handlers):
+            handler.recorder.set_close_reason('drain timeout')
+            handler.abort()
+        # let connection_lost write the access records
+        await asyncio.sleep(0)
+        set_result_once(self.stopped, None)
+
+    def run(self):
+        if flags.args.cache or flags.args.splice or flags.args.compress or \
+                flags.args.threads > 1 or flags.args.client_rate or \
+                flags.args.lag_threshold != DEFAULT_LAG_THRESHOLD or \
+                flags.args.capture_dir:
+            logger.warning('--cache, --splice, --compress, --threads, '
+                           '--client-rate, --lag-threshold and --capture-dir '
+                           'need the selector engine')
+        metrics_port = flags.args.metrics_port
+        if metrics_port:
+            if self.slot is not None:
+                metrics_port += self.slot
+            self.metrics_server = MetricsServer(
+                flags.args.metrics_host, metrics_port,
+                reuse_port=self.slot is not None)
+            self.metrics_server.start()
+        if self.access_log:
+            self.access_log.start()
+        if self.rules:
+            self.rules.start()
+        if uvloop is not None:
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if self.rules:
+                self.rules.stop()
+            if self.access_log:
+                self.access_log.close()
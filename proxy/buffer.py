@@ -0,0 +1,194 @@
+"""
+    buffer.py: zero-copy buffers for the connections
+"""
+
+from collections import deque
+from itertools import islice
+from typing import Deque, List, Optional
+import os
+import ssl
+
+from .constants import BUFFER_SIZE, RECV_BUFFER_POOL_SIZE, \
+    SEND_QUEUE_POOL_SIZE
+
+try:
+    IOV_MAX = min(os.sysconf('SC_IOV_MAX'), 64)
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 16
+
+# reads smaller than this are copied out of the receive buffer, which
+# goes back to the pool, instead of pinning a whole BUFFER_SIZE bytearray
+# until they are flushed
+SMALL_READ_SIZE = BUFFER_SIZE // 4
+
+
+class BufferPool:
+    """Receive buffers and send queues shared by all the connections.
+
+    A connection only holds them while it has data in flight, an idle
+    keep-alive connection holds neither. list.pop and list.append are
+    atomic, the worker threads share the pool without a lock.
+    """
+
+    def __init__(self, buffer_size: int, max_buffers: int, max_queues: int):
+        self.buffer_size = buffer_size
+        self.max_buffers = max_buffers
+        self.max_queues = max_queues
+        self.buffers: List[bytearray] = []
+        self.queues: List[Deque] = []
+
+    def get_buffer(self, size: int) -> bytearray:
+        if size == self.buffer_size:
+            try:
+                return self.buffers.pop()
+            except IndexError:
+                pass
+        return bytearray(size)
+
+    def put_buffer(self, buf: bytearray):
+        """``buf`` must not be referenced by any chunk."""
+        if len(buf) == self.buffer_size and \
+                len(self.buffers) < self.max_buffers:
+            self.buffers.append(buf)
+
+    def get_queue(self) -> Deque:
+        try:
+            return self.queues.pop()
+        except IndexError:
+            return deque()
+
+    def put_queue(self, queue: Deque):
+        queue.clear()
+        if len(self.queues) < self.max_queues:
+            self.queues.append(queue)
+
+
+buffer_pool = BufferPool(BUFFER_SIZE, RECV_BUFFER_POOL_SIZE,
+                         SEND_QUEUE_POOL_SIZE)
+
+
+def recv_chunks(sock, buffer_size: int = BUFFER_SIZE,
+                limit: int = 0) -> Optional[List]:
+    """Read from ``sock`` until it would block, or ``limit`` bytes if set.
+
+    A large read is a memoryview of the buffer it was received into, so
+    the payload is not copied again until the kernel sends it, and the
+    buffer is left to the chunk. Returns None on end of file, raises
+    BlockingIOError/SSLWantReadError if there is nothing to read.
+    """
+    chunks = []
+    total = 0
+    buf = buffer_pool.get_buffer(buffer_size)
+    try:
+        while True:
+            size = min(buffer_size, limit - total) if limit else buffer_size
+            n = sock.recv_into(buf, size)
+            if n == 0:
+                break
+            if n < SMALL_READ_SIZE:
+                chunks.append(memoryview(memoryview(buf)[:n].tobytes()))
+            else:
+                chunks.append(memoryview(buf)[:n])
+                buf = buffer_pool.get_buffer(buffer_size)
+            total += n
+            if limit and total >= limit:
+                break
+    except (ssl.SSLWantReadError, BlockingIOError):
+        if not chunks:
+            raise
+    finally:
+        # the last read would have blocked, or was copied out
+        buffer_pool.put_buffer(buf)
+    return chunks or None
+
+
+class MemoryBudget:
+    """Pending bytes accounted across all the buffer chains of a worker."""
+
+    __slots__ = ('limit', 'used')
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+
+    def is_exceeded(self):
+        return self.limit > 0 and self.used > self.limit
+
+
+class BufferChain:
+    """A queue of pending chunks flushed with scatter-gather sends."""
+
+    __slots__ = ('chunks', 'size', 'budget')
+
+    def __init__(self, budget: Optional[MemoryBudget] = None):
+        # from the pool, only while there is something to send
+        self.chunks: Optional[Deque[memoryview]] = None
+        self.size = 0
+        self.budget = budget
+
+    def __len__(self):
+        return self.size
+
+    def push(self, data):
+        if not isinstance(data, memoryview):
+            data = memoryview(data)
+        if len(data) == 0:
+            return
+        if self.chunks is None:
+            self.chunks = buffer_pool.get_queue()
+        self.chunks.append(data)
+        self.size += len(data)
+        if self.budget:
+            self.budget.used += len(data)
+
+    def consume(self, n: int):
+        self.size -= n
+        if self.budget:
+            self.budget.used -= n
+        while n > 0:
+            head = self.chunks[0]
+            if len(head) <= n:
+                self.chunks.popleft()
+                n -= len(head)
+            else:
+                self.chunks[0] = head[n:]
+                n = 0
+        if not self.chunks:
+            self.release()
+
+    def send(self, sock) -> int:
+        """Send as much as possible, returns the number of bytes sent."""
+        total = 0
+        while self.chunks:
+            if isinstance(sock, ssl.SSLSocket) or len(self.chunks) == 1:
+                # there is no sendmsg on a TLS socket
+                attempted = len(self.chunks[0])
+                send = sock.send
+                args = (self.chunks[0],)
+            else:
+                iov = list(islice(self.chunks, IOV_MAX))
+                attempted = sum(len(v) for v in iov)
+                send = sock.sendmsg
+                args = (iov,)
+            try:
+                n = send(*args)
+            except (ssl.SSLWantWriteError, BlockingIOError):
+                if total:
+                    break
+                raise
+            self.consume(n)
+            total += n
+            if n < attempted:
+                break
+        return total
+
+    def clear(self):
+        if self.budget:
+            self.budget.used -= self.size
+        self.size = 0
+        self.release()
+
+    def release(self):
+        if self.chunks is not None:
+            buffer_pool.put_queue(self.chunks)
+            self.chunks = None
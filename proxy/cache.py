@@ -0,0 +1,411 @@
+"""
+    cache.py: HTTP response cache with a memory and a disk tier
+"""
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+from typing import Callable, Dict, List, Optional
+import hashlib
+import json
+import logging
+import mmap
+import os
+import threading
+import time
+
+from .constants import CRLF, GET_METHOD
+from .http_parser import HttpParser, RESPONSE_PARSER
+
+logger = logging.getLogger(__name__)
+
+CACHEABLE_STATUS = (200, 203, 300, 301, 404, 410)
+# heuristic freshness for responses with a Last-Modified only
+HEURISTIC_FRACTION = 0.1
+MAX_HEURISTIC_LIFETIME = 24 * 3600
+# the stored headers a 304 doesn't replace: the framing, the hop-by-hop
+# ones, and the age, computed when serving
+NOT_REFRESHED = (b'content-length', b'transfer-encoding', b'connection',
+                 b'keep-alive', b'proxy-connection', b'te', b'trailer',
+                 b'upgrade', b'age')
+
+
+def parse_cache_control(value: Optional[bytes]) -> Dict[str, Optional[str]]:
+    directives: Dict[str, Optional[str]] = {}
+    if not value:
+        return directives
+    for item in value.decode('latin-1').split(','):
+        name, sep, arg = item.strip().partition('=')
+        if name:
+            directives[name.lower()] = arg.strip('"') if sep else None
+    return directives
+
+
+def parse_seconds(value: Optional[str]) -> Optional[int]:
+    try:
+        return max(int(value), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_http_date(value: Optional[bytes]) -> Optional[float]:
+    if not value:
+        return None
+    try:
+        return parsedate_to_datetime(value.decode('latin-1')).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def header_name(line: bytes) -> bytes:
+    return line.split(b':', 1)[0].strip().lower()
+
+
+def refreshed_head(head: bytes, response: HttpParser) -> bytes:
+    """The stored head with the headers of a 304 response replacing
+    theirs."""
+    updated = {bytes(name).lower() for name, _ in response.header_list}
+    updated.difference_update(NOT_REFRESHED)
+    lines = head.split(CRLF)[:-1]
+    kept = [lines[0]]
+    kept += [line for line in lines[1:] if header_name(line) not in updated]
+    kept += [bytes(name) + b': ' + bytes(value)
+             for name, value in response.header_list
+             if bytes(name).lower() in updated]
+    return CRLF.join(kept) + CRLF
+
+
+def cache_key(request: HttpParser) -> str:
+    target = request.target.decode('latin-1')
+    scheme, sep, rest = target.partition('://')
+    if sep:
+        slash = rest.find('/')
+        target = rest[slash:] if slash >= 0 else '/'
+    return '%s:%d%s' % (request.host.lower(), request.port, target)
+
+
+class CacheEntry:
+
+    def __init__(self, key: str, head: bytes, body: Optional[bytes],
+                 size: int, expires: float, etag: Optional[bytes],
+                 last_modified: Optional[bytes],
+                 accept_encoding: Optional[bytes]):
+        self.key = key
+        self.head = head
+        # kept in memory until the body is on disk
+        self.body = body
+        self.size = size
+        self.expires = expires
+        self.etag = etag
+        self.last_modified = last_modified
+        # the response varies on it, None if it doesn't
+        self.accept_encoding = accept_encoding
+        self.stored_at = time.time()
+        self.path: Optional[str] = None
+
+    def is_fresh(self):
+        return time.time() < self.expires
+
+    def memory_cost(self):
+        return len(self.head) + self.size
+
+    def has_validator(self):
+        return self.etag is not None or self.last_modified is not None
+
+    def to_meta(self):
+        def text(value):
+            return value.decode('latin-1') if value is not None else None
+        return {
+            'key': self.key, 'head': text(self.head), 'size': self.size,
+            'expires': self.expires, 'etag': text(self.etag),
+            'last_modified': text(self.last_modified),
+            'accept_encoding': text(self.accept_encoding),
+            'stored_at': self.stored_at,
+        }
+
+    @classmethod
+    def from_meta(cls, meta):
+        def raw(value):
+            return value.encode('latin-1') if value is not None else None
+        entry = cls(meta['key'], raw(meta['head']), None, meta['size'],
+                    meta['expires'], raw(meta['etag']),
+                    raw(meta['last_modified']), raw(meta['accept_encoding']))
+        entry.stored_at = meta['stored_at']
+        return entry
+
+
+class HttpCache:
+    """A shared cache of complete responses to GET requests.
+
+    Entries live in a byte-bounded memory LRU, least recently used ones
+    are demoted to a larger disk tier if ``disk_dir`` is set. Disk bodies
+    are served from memory maps, so hits go from the page cache to the
+    client socket. Disk writes and deletions run on a background thread,
+    a ``.meta`` file next to each body lets the disk tier survive restarts.
+
+    ``claim`` collapses concurrent misses: the first handler fetches, the
+    others are called back once it is done and look the key up again.
+    """
+
+    def __init__(self, memory_size: int, max_object_size: int,
+                 disk_dir: Optional[str] = None, disk_size: int = 0):
+        self.memory_size = memory_size
+        self.max_object_size = max_object_size
+        self.disk_dir = disk_dir
+        self.disk_size = disk_size if disk_dir else 0
+        self.lock = threading.Lock()
+        self.memory: OrderedDict = OrderedDict()
+        self.memory_used = 0
+        self.disk: OrderedDict = OrderedDict()
+        self.disk_used = 0
+        self.inflight: Dict[str, List[Callable]] = {}
+        self.executor = None
+        if self.disk_size > 0:
+            os.makedirs(disk_dir, exist_ok=True)
+            self.executor = ThreadPoolExecutor(max_workers=1,
+                                               thread_name_prefix='cache')
+            self.load_disk_index()
+
+    def load_disk_index(self):
+        metas = []
+        for name in os.listdir(self.disk_dir):
+            if not name.endswith('.meta'):
+                continue
+            path = os.path.join(self.disk_dir, name)
+            try:
+                with open(path) as f:
+                    metas.append(CacheEntry.from_meta(json.load(f)))
+            except (OSError, ValueError, KeyError):
+                continue
+        for entry in sorted(metas, key=lambda e: e.stored_at):
+            entry.path = self.body_path(entry.key)
+            if os.path.exists(entry.path):
+                self.disk[entry.key] = entry
+                self.disk_used += entry.size
+        self.evict_disk()
+        logger.info('Loaded %d cached responses from %s',
+                    len(self.disk), self.disk_dir)
+
+    def body_path(self, key: str) -> str:
+        digest = hashlib.sha1(key.encode()).hexdigest()
+        return os.path.join(self.disk_dir, digest)
+
+    def lookup(self, request: HttpParser) -> Optional[CacheEntry]:
+        key = cache_key(request)
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None:
+                self.memory.move_to_end(key)
+            else:
+                entry = self.disk.get(key)
+                if entry is not None:
+                    self.disk.move_to_end(key)
+        if entry is None:
+            return None
+        if entry.accept_encoding is not None and entry.accept_encoding != \
+                request.get_header(b'accept-encoding', b''):
+            return None
+        return entry
+
+    def claim(self, key: str, callback: Optional[Callable] = None) -> bool:
+        """Return True if the caller should fetch key itself.
+
+        Otherwise key is being fetched, ``callback`` is called once the
+        fetch is done.
+        """
+        with self.lock:
+            waiters = self.inflight.get(key)
+            if waiters is None:
+                self.inflight[key] = []
+                return True
+            if callback is not None:
+                waiters.append(callback)
+            return False
+
+    def release(self, key: str):
+        with self.lock:
+            waiters = self.inflight.pop(key, [])
+        for callback in waiters:
+            callback()
+
+    def freshness(self, request: HttpParser, response: HttpParser):
+        """Return the expiry time of response, None if it can't be stored."""
+        if request.method != GET_METHOD or \
+                response.status not in CACHEABLE_STATUS or \
+                response.chunked is False and response.content_length is None:
+            return None
+        request_cc = parse_cache_control(request.get_header(b'cache-control'))
+        cc = parse_cache_control(response.get_header(b'cache-control'))
+        if 'no-store' in request_cc or 'no-store' in cc or 'private' in cc:
+            return None
+        if request.get_header(b'authorization') is not None and \
+                'public' not in cc and 's-maxage' not in cc:
+            return None
+        if response.get_header(b'set-cookie') is not None:
+            return None
+        vary = response.get_header(b'vary', b'').lower()
+        if vary and vary.replace(b' ', b'') != b'accept-encoding':
+            return None
+        expires = self.expiry(response)
+        if expires <= time.time() and response.get_header(b'etag') is None \
+                and response.get_header(b'last-modified') is None:
+            # nothing to serve it fresh or to revalidate it with
+            return None
+        return expires
+
+    @staticmethod
+    def expiry(response: HttpParser) -> float:
+        cc = parse_cache_control(response.get_header(b'cache-control'))
+        now = time.time()
+        date = parse_http_date(response.get_header(b'date')) or now
+        age = parse_seconds(
+            (response.get_header(b'age') or b'').decode('latin-1')) or 0
+        lifetime = parse_seconds(cc.get('s-maxage'))
+        if lifetime is None:
+            lifetime = parse_seconds(cc.get('max-age'))
+        if lifetime is None and response.get_header(b'expires') is not None:
+            expires = parse_http_date(response.get_header(b'expires'))
+            lifetime = max(expires - date, 0) if expires else 0
+        if lifetime is None:
+            last_modified = parse_http_date(
+                response.get_header(b'last-modified'))
+            if last_modified is not None:
+                lifetime = min((date - last_modified) * HEURISTIC_FRACTION,
+                               MAX_HEURISTIC_LIFETIME)
+            else:
+                lifetime = 0
+        if 'no-cache' in cc:
+            lifetime = 0
+        return now + max(lifetime - age, 0)
+
+    def store(self, request: HttpParser, response: HttpParser,
+              expires: float, body_chunks: List):
+        key = cache_key(request)
+        size = sum(len(c) for c in body_chunks)
+        # the Age header is computed when the entry is served
+        lines = [bytes(response.start_line)]
+        for name, value in response.header_list:
+            if bytes(name).lower() != b'age':
+                lines.append(bytes(name) + b': ' + bytes(value))
+        head = CRLF.join(lines) + CRLF
+        vary = response.get_header(b'vary')
+        entry = CacheEntry(
+            key, head, b''.join(body_chunks), size, expires,
+            response.get_header(b'etag'),
+            response.get_header(b'last-modified'),
+            request.get_header(b'accept-encoding', b'') if vary else None)
+        with self.lock:
+            self.remove(key)
+            if size <= self.memory_size // 8 or not self.disk_size:
+                self.memory[key] = entry
+                self.memory_used += entry.memory_cost()
+                self.evict_memory()
+            else:
+                self.demote(entry)
+                self.evict_disk()
+        logger.debug('Cached %s, %d bytes', key, size)
+
+    def refresh(self, entry: CacheEntry, response: HttpParser):
+        """Update entry from a 304 response: its headers, its freshness,
+        and its age, which starts over."""
+        head = refreshed_head(entry.head, response)
+        age = parse_seconds(
+            (response.get_header(b'age') or b'').decode('latin-1')) or 0
+        # the freshness of the updated response, as received
+        updated = HttpParser(RESPONSE_PARSER)
+        updated.parse(head + b'Age: %d\r\n' % age + CRLF)
+        with self.lock:
+            if self.memory.get(entry.key) is entry:
+                self.memory_used += len(head) - len(entry.head)
+            entry.head = head
+            entry.etag = updated.get_header(b'etag')
+            entry.last_modified = updated.get_header(b'last-modified')
+            entry.expires = self.expiry(updated)
+            entry.stored_at = time.time() - age
+            self.evict_memory()
+        if entry.path and self.executor:
+            self.executor.submit(self.write_meta, entry)
+
+    def remove(self, key: str):
+        entry = self.memory.pop(key, None)
+        if entry is not None:
+            self.memory_used -= entry.memory_cost()
+        entry = self.disk.pop(key, None)
+        if entry is not None:
+            self.disk_used -= entry.size
+            self.executor.submit(self.delete_files, entry.path)
+
+    def evict_memory(self):
+        while self.memory_used > self.memory_size and self.memory:
+            key, entry = self.memory.popitem(last=False)
+            self.memory_used -= entry.memory_cost()
+            if entry.is_fresh() or entry.has_validator():
+                self.demote(entry)
+        self.evict_disk()
+
+    def demote(self, entry: CacheEntry):
+        if not self.disk_size or entry.size > self.disk_size:
+            return
+        entry.path = self.body_path(entry.key)
+        self.disk[entry.key] = entry
+        self.disk_used += entry.size
+        self.executor.submit(self.write_body, entry)
+
+    def evict_disk(self):
+        while self.disk_used > self.disk_size and self.disk:
+            key, entry = self.disk.popitem(last=False)
+            self.disk_used -= entry.size
+            self.executor.submit(self.delete_files, entry.path)
+
+    def write_body(self, entry: CacheEntry):
+        body = entry.body
+        if body is None:
+            return
+        tmppath = entry.path + '.tmp'
+        try:
+            with open(tmppath, 'wb') as f:
+                f.write(body)
+            os.replace(tmppath, entry.path)
+            self.write_meta(entry)
+        except OSError as e:
+            logger.warning('Cannot write cached %s: %s', entry.key, e)
+            with self.lock:
+                if self.disk.get(entry.key) is entry:
+                    del self.disk[entry.key]
+                    self.disk_used -= entry.size
+            return
+        # from now on the body is served from the file
+        entry.body = None
+
+    def write_meta(self, entry: CacheEntry):
+        with open(entry.path + '.meta.tmp', 'w') as f:
+            json.dump(entry.to_meta(), f)
+        os.replace(entry.path + '.meta.tmp', entry.path + '.meta')
+
+    @staticmethod
+    def delete_files(path: str):
+        for name in (path, path + '.meta'):
+            try:
+                os.unlink(name)
+            except OSError:
+                pass
+
+    @staticmethod
+    def open_body(entry: CacheEntry) -> memoryview:
+        body = entry.body
+        if body is not None:
+            return memoryview(body)
+        if entry.size == 0:
+            return memoryview(b'')
+        with open(entry.path, 'rb') as f:
+            # the mapping stays valid after close, and after an eviction
+            # unlinked the file, until the last view on it is released
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(mapped)
+
+    def serve(self, entry: CacheEntry):
+        """Return the head and the body to send for a hit."""
+        body = self.open_body(entry)
+        age = int(time.time() - entry.stored_at)
+        head = entry.head + b'Age: %d\r\n\r\n' % age
+        return head, body
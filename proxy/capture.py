@@ -0,0 +1,440 @@
+"""
+    capture.py: record the traffic to HAR or pcapng files, off the loop
+"""
+
+from collections import deque, namedtuple
+from typing import List, Optional, Sequence
+import base64
+import ipaddress
+import json
+import logging
+import os
+import random
+import struct
+import threading
+import time
+
+from .constants import CAPTURE_MAX_BODY, CAPTURE_FLUSH_INTERVAL, CRLF
+
+logger = logging.getLogger(__name__)
+
+# a request and its response, ``response_head`` is None when the exchange
+# didn't complete; the addresses are socket addresses, or None
+HttpEvent = namedtuple('HttpEvent', (
+    'stream', 'client', 'server', 'host', 'port', 'scheme', 'started',
+    'duration', 'request_head', 'request_body', 'response_head',
+    'response_body', 'truncated'))
+# bytes of a tunnel that isn't parsed, direction 0 is from the client
+DataEvent = namedtuple('DataEvent', (
+    'stream', 'client', 'server', 'host', 'port', 'time', 'direction',
+    'data'))
+
+
+class CaptureRing:
+    """Events of a worker on their way to the writer thread.
+
+    A single producer, the worker, and a single consumer, the writer:
+    the deque's append and popleft are atomic, and each side only moves
+    its own byte counter, so neither takes a lock. An event that would
+    take the queued bytes above ``max_bytes`` is dropped, the worker
+    never waits for the disk.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.events: deque = deque()
+        self.pushed = 0
+        self.popped = 0
+
+    def push(self, event, size: int) -> bool:
+        if self.pushed - self.popped + size > self.max_bytes:
+            return False
+        self.events.append((event, size))
+        self.pushed += size
+        return True
+
+    def pop(self):
+        """Raise IndexError when empty."""
+        event, size = self.events.popleft()
+        self.popped += size
+        return event
+
+
+class Exchange:
+    """What a handler captures of a request and its response."""
+
+    __slots__ = ('scheme', 'started', 'wall', 'request_head', 'request_body',
+                 'response_head', 'response_body', 'body_size', 'truncated')
+
+    def __init__(self, scheme: str, request_head: bytes):
+        self.scheme = scheme
+        self.started = time.monotonic()
+        self.wall = time.time()
+        self.request_head = bytes(request_head)
+        self.request_body: List[bytes] = []
+        self.response_head: Optional[bytes] = None
+        self.response_body: List[bytes] = []
+        self.body_size = 0
+        self.truncated = False
+
+    def add_body(self, body: List[bytes], data):
+        if self.body_size + len(data) > CAPTURE_MAX_BODY:
+            self.truncated = True
+            return
+        # the receive buffers are reused, the data is copied
+        body.append(bytes(data))
+        self.body_size += len(data)
+
+    def add_request_body(self, data):
+        self.add_body(self.request_body, data)
+
+    def add_response_body(self, data):
+        self.add_body(self.response_body, data)
+
+    def event(self, stream: int, client, server, host: str,
+              port: int) -> HttpEvent:
+        return HttpEvent(
+            stream, client, server, host, port, self.scheme, self.wall,
+            time.monotonic() - self.started, self.request_head,
+            b''.join(self.request_body), self.response_head,
+            b''.join(self.response_body), self.truncated)
+
+    def size(self) -> int:
+        return len(self.request_head) + len(self.response_head or b'') + \
+            self.body_size
+
+
+def parse_head(head: bytes):
+    """The start line and the headers of a raw head."""
+    lines = head.decode('latin-1').split('\r\n')
+    headers = []
+    for line in lines[1:]:
+        if line:
+            name, _, value = line.partition(':')
+            headers.append((name.strip(), value.strip()))
+    return lines[0], headers
+
+
+def get_header(headers, name: str) -> Optional[str]:
+    for key, value in headers:
+        if key.lower() == name:
+            return value
+    return None
+
+
+def dechunk(body: bytes) -> bytes:
+    """The data of a chunked body, as much of it as is well formed."""
+    data = []
+    pos = 0
+    while pos < len(body):
+        end = body.find(CRLF, pos)
+        if end < 0:
+            break
+        try:
+            size = int(body[pos:end].split(b';', 1)[0], 16)
+        except ValueError:
+            break
+        if size == 0:
+            break
+        data.append(body[end + 2:end + 2 + size])
+        pos = end + 2 + size + 2
+    return b''.join(data)
+
+
+def har_content(body: bytes, mime: str) -> dict:
+    content = {'size': len(body), 'mimeType': mime}
+    try:
+        content['text'] = body.decode('utf-8')
+    except UnicodeDecodeError:
+        content['text'] = base64.b64encode(body).decode()
+        content['encoding'] = 'base64'
+    return content
+
+
+class HarWriter:
+    """A HAR 1.2 log. The entries are appended, and the end of the
+    document is written after each batch, then overwritten by the next
+    one, so the file is valid JSON between batches."""
+
+    extension = 'har'
+    trailer = '\n]}}\n'
+
+    def __init__(self, f):
+        self.f = f
+        self.entries = 0
+        self.trailer_at: Optional[int] = None
+        f.write('{"log": {"version": "1.2", "creator": {"name": "proxy", '
+                '"version": "1.0"}, "entries": [\n')
+
+    def write(self, event):
+        if not isinstance(event, HttpEvent):
+            # tunnel bytes have no place in HAR
+            return
+        if self.trailer_at is not None:
+            self.f.seek(self.trailer_at)
+            self.f.truncate()
+            self.trailer_at = None
+        request_line, request_headers = parse_head(event.request_head)
+        method, _, rest = request_line.partition(' ')
+        target, _, version = rest.rpartition(' ')
+        url = target
+        if target.startswith('/'):
+            default_port = 443 if event.scheme == 'https' else 80
+            authority = event.host if event.port == default_port else \
+                '%s:%d' % (event.host, event.port)
+            url = '%s://%s%s' % (event.scheme, authority, target)
+        request = {
+            'method': method, 'url': url, 'httpVersion': version,
+            'headers': [{'name': n, 'value': v} for n, v in request_headers],
+            'queryString': [], 'cookies': [],
+            'headersSize': len(event.request_head),
+            'bodySize': len(event.request_body),
+        }
+        if event.request_body:
+            request['postData'] = {
+                'mimeType': get_header(request_headers, 'content-type') or '',
+                'text': event.request_body.decode('utf-8', 'replace')}
+        status, reason, response_version, response_headers = 0, '', '', []
+        body = event.response_body
+        if event.response_head is not None:
+            status_line, response_headers = parse_head(event.response_head)
+            response_version, _, rest = status_line.partition(' ')
+            code, _, reason = rest.partition(' ')
+            status = int(code) if code.isdigit() else 0
+            encoding = get_header(response_headers, 'transfer-encoding')
+            if encoding and 'chunked' in encoding.lower():
+                body = dechunk(body)
+        content = har_content(
+            body, get_header(response_headers, 'content-type') or '')
+        if event.truncated:
+            content['comment'] = 'truncated'
+        duration = round(event.duration * 1000, 3)
+        entry = {
+            'startedDateTime': time.strftime(
+                '%Y-%m-%dT%H:%M:%S', time.gmtime(event.started)) +
+            '.%03dZ' % (event.started % 1 * 1000),
+            'time': duration,
+            'request': request,
+            'response': {
+                'status': status, 'statusText': reason,
+                'httpVersion': response_version,
+                'headers': [{'name': n, 'value': v}
+                            for n, v in response_headers],
+                'cookies': [], 'content': content, 'redirectURL': '',
+                'headersSize': len(event.response_head or b''),
+                'bodySize': len(event.response_body),
+            },
+            'cache': {},
+            'timings': {'send': 0, 'wait': duration, 'receive': 0},
+            'connection': str(event.stream),
+        }
+        if event.server:
+            entry['serverIPAddress'] = event.server[0]
+        self.f.write((',\n' if self.entries else '') + json.dumps(entry))
+        self.entries += 1
+
+    def sync(self):
+        if self.trailer_at is None:
+            self.trailer_at = self.f.tell()
+            self.f.write(self.trailer)
+
+
+# TCP segments of at most this many bytes, within the IP length field
+MAX_SEGMENT = 65000
+IPV4_HEADER = struct.Struct('!BBHHHBBH4s4s')
+IPV6_HEADER = struct.Struct('!IHBB16s16s')
+TCP_HEADER = struct.Struct('!HHIIBBHHH')
+TCP_PSH_ACK = 0x18
+LINKTYPE_RAW = 101
+
+
+def ipv4_checksum(header: bytes) -> int:
+    total = sum(struct.unpack('!10H', header))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return ~total & 0xffff
+
+
+class PcapngWriter:
+    """Packets made up for the captured bytes, on raw IP links.
+
+    Each client connection is a TCP stream between the client and the
+    upstream's address, whose sequence numbers follow the bytes, so
+    Wireshark follows the streams and decodes the HTTP inside. The
+    checksums of the segments are left at 0.
+    """
+
+    extension = 'pcapng'
+
+    def __init__(self, f):
+        self.f = f
+        # next sequence number of each (stream, direction)
+        self.seqs = {}
+        # section header, no options, length unknown
+        self.block(0x0A0D0D0A, struct.pack('<IHHq', 0x1A2B3C4D, 1, 0, -1))
+        # interface 0, microsecond timestamps
+        self.block(1, struct.pack('<HHI', LINKTYPE_RAW, 0, 0))
+
+    def block(self, block_type: int, body: bytes):
+        body += b'\0' * (-len(body) % 4)
+        length = len(body) + 12
+        self.f.write(struct.pack('<II', block_type, length) + body +
+                     struct.pack('<I', length))
+
+    @staticmethod
+    def endpoints(client, server, port: int):
+        def packed(addr):
+            return ipaddress.ip_address(addr[0].split('%', 1)[0]).packed
+        src = packed(client) if client else bytes(4)
+        dst = packed(server) if server else bytes(4)
+        if len(src) != len(dst):
+            # a mixed pair is written as IPv6, the IPv4 side mapped
+            src, dst = (b'\0' * 10 + b'\xff\xff' + a if len(a) == 4 else a
+                        for a in (src, dst))
+        return (src, client[1] if client else 0,
+                dst, server[1] if server else port)
+
+    def write(self, event):
+        src, sport, dst, dport = self.endpoints(
+            event.client, event.server, event.port)
+        if isinstance(event, DataEvent):
+            self.segments(event.stream, event.direction, event.time,
+                          src, sport, dst, dport, event.data)
+            return
+        self.segments(event.stream, 0, event.started, src, sport, dst, dport,
+                      event.request_head + event.request_body)
+        if event.response_head is not None:
+            self.segments(event.stream, 1, event.started + event.duration,
+                          src, sport, dst, dport,
+                          event.response_head + event.response_body)
+
+    def segments(self, stream: int, direction: int, when: float,
+                 src: bytes, sport: int, dst: bytes, dport: int,
+                 data: bytes):
+        if direction:
+            src, sport, dst, dport = dst, dport, src, sport
+        timestamp = int(when * 1000000)
+        for pos in range(0, len(data), MAX_SEGMENT):
+            payload = data[pos:pos + MAX_SEGMENT]
+            seq = self.seqs.get((stream, direction), 1)
+            ack = self.seqs.get((stream, 1 - direction), 1)
+            self.seqs[stream, direction] = (seq + len(payload)) & 0xffffffff
+            tcp = TCP_HEADER.pack(sport, dport, seq, ack, 5 << 4,
+                                  TCP_PSH_ACK, 65535, 0, 0)
+            if len(src) == 4:
+                ip = IPV4_HEADER.pack(0x45, 0, 20 + len(tcp) + len(payload),
+                                      0, 0x4000, 64, 6, 0, src, dst)
+                ip = ip[:10] + struct.pack('!H', ipv4_checksum(ip)) + ip[12:]
+            else:
+                ip = IPV6_HEADER.pack(6 << 28, len(tcp) + len(payload), 6,
+                                      64, src, dst)
+            packet = ip + tcp + payload
+            self.block(6, struct.pack(
+                '<IIIII', 0, timestamp >> 32, timestamp & 0xffffffff,
+                len(packet), len(packet)) + packet)
+
+    def sync(self):
+        pass
+
+
+WRITERS = {'har': HarWriter, 'pcapng': PcapngWriter}
+
+
+class Capture:
+    """Capture the exchanges, and the bytes of the tunnels that aren't
+    parsed, of the hosts in ``hosts`` (all if empty) and their subdomains,
+    a ``sample`` fraction of them.
+
+    The workers push events to their CaptureRing, a thread writes them
+    every CAPTURE_FLUSH_INTERVAL to ``directory``, a new file once the
+    current one is ``file_size`` bytes, the ``files`` newest are kept.
+    """
+
+    def __init__(self, directory: str, fmt: str, hosts: Sequence[str],
+                 sample: float, file_size: int, files: int):
+        self.directory = directory
+        self.writer_class = WRITERS[fmt]
+        self.hosts = tuple(h.lower().strip('.') for h in hosts)
+        self.suffixes = tuple('.' + h for h in self.hosts)
+        self.sample = sample
+        self.file_size = file_size
+        self.files = files
+        self.rings: List[CaptureRing] = []
+        self.paths: deque = deque()
+        self.index = 0
+        self.f = None
+        self.writer = None
+        self.stopped = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    def ring(self, max_bytes: int) -> CaptureRing:
+        """A ring for a worker, all are made before ``start``."""
+        ring = CaptureRing(max_bytes)
+        self.rings.append(ring)
+        return ring
+
+    def wants(self, host: Optional[str]) -> bool:
+        if self.hosts:
+            host = (host or '').lower()
+            if host not in self.hosts and not host.endswith(self.suffixes):
+                return False
+        return self.sample >= 1 or random.random() < self.sample
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.thread = threading.Thread(target=self.run, name='capture',
+                                       daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(CAPTURE_FLUSH_INTERVAL):
+            self.drain()
+        self.drain()
+        self.close_file()
+
+    def drain(self):
+        for ring in self.rings:
+            while True:
+                try:
+                    event = ring.pop()
+                except IndexError:
+                    break
+                try:
+                    self.write(event)
+                except (OSError, ValueError) as e:
+                    logger.warning('Cannot write a capture: %s', e)
+        if self.writer is not None:
+            self.writer.sync()
+            self.f.flush()
+
+    def write(self, event):
+        if self.writer is None:
+            self.open_file()
+        self.writer.write(event)
+        if self.f.tell() >= self.file_size:
+            self.close_file()
+
+    def open_file(self):
+        self.index += 1
+        path = os.path.join(self.directory, 'capture-%d-%04d.%s' % (
+            os.getpid(), self.index, self.writer_class.extension))
+        binary = self.writer_class is PcapngWriter
+        self.f = open(path, 'wb' if binary else 'w')
+        self.writer = self.writer_class(self.f)
+        self.paths.append(path)
+        while len(self.paths) > self.files:
+            try:
+                os.remove(self.paths.popleft())
+            except OSError as e:
+                logger.warning('Cannot remove an old capture: %s', e)
+
+    def close_file(self):
+        if self.writer is not None:
+            self.writer.sync()
+            self.f.close()
+            self.writer = self.f = None
+
+    def close(self, timeout: float = 5.0):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
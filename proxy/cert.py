@@ -2,10 +2,71 @@
 
 import os
 from subprocess import Popen, PIPE
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+import ipaddress
+import logging
+import secrets
 import ssl
+import tempfile
 import threading
 
+try:
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.x509.oid import NameOID
+except ImportError:
+    x509 = None
+
+try:
+    from publicsuffixlist import PublicSuffixList
+except ImportError:
+    PublicSuffixList = None
+
+from .constants import CERT_VALIDITY_DAYS, DEFAULT_CERT_CACHE_SIZE
+
 cwd = os.path.dirname(__file__)
+logger = logging.getLogger(__name__)
+
+# parsed once, cert_name runs on the event loops
+public_suffixes = PublicSuffixList() if PublicSuffixList is not None \
+    else None
+
+
+def is_ip_address(hostname):
+    try:
+        ipaddress.ip_address(hostname)
+    except ValueError:
+        return False
+    return True
+
+
+def cert_name(hostname):
+    """The name the certificate for hostname is minted for.
+
+    Sibling subdomains share a wildcard certificate of their parent when
+    the parent is a private domain: clients refuse wildcards covering a
+    public suffix like co.uk or github.io. Telling them apart takes the
+    list of publicsuffixlist, without it each host gets its own
+    certificate.
+    """
+    if public_suffixes is None or is_ip_address(hostname):
+        return hostname
+    parent = hostname.partition('.')[2]
+    if not parent or not public_suffixes.is_private(parent):
+        return hostname
+    return '*.' + parent
+
+
+def check_dependencies():
+    """Log what interception does without the optional dependencies."""
+    if x509 is None:
+        logger.warning('cryptography is not installed, certificates are '
+                       'minted by openssl subprocesses, one per name')
+    if public_suffixes is None:
+        logger.warning('publicsuffixlist is not installed, no wildcard '
+                       'certificates are minted, each host gets its own')
 
 
 class CertificateHelper:
@@ -14,22 +75,164 @@ class CertificateHelper:
     cacert = f'{cwd}/certs/root.ca.pem'
     certkey = f'{cwd}/certs/private.key'
     lock = threading.Lock()
+    # name -> server SSLContext, least recently used first
+    contexts: OrderedDict = OrderedDict()
+    context_cache_size = DEFAULT_CERT_CACHE_SIZE
+    # name -> callbacks waiting for the context being minted
+    pending: dict = {}
+    executor = ThreadPoolExecutor(max_workers=2,
+                                  thread_name_prefix='cert')
+    ca = None
+
+    @classmethod
+    def get_certpath(cls, name):
+        # the cert directory is the on-disk index shared by all the
+        # processes, wildcard certs are stored as _.example.com.crt
+        filename = name.replace('*', '_')
+        return "%s/%s.crt" % (cls.certdir.rstrip('/'), filename)
+
+    @classmethod
+    def is_fresh(cls, certpath):
+        try:
+            mtime = os.path.getmtime(certpath)
+        except OSError:
+            return False
+        age = datetime.datetime.now().timestamp() - mtime
+        # leave a margin so that clients never see an expired cert
+        return age < (CERT_VALIDITY_DAYS - 30) * 24 * 3600
 
     @classmethod
     def generate_cert(cls, hostname):
-        certpath = "%s/%s.crt" % (cls.certdir.rstrip('/'), hostname)
-        if os.path.exists(certpath):
+        name = cert_name(hostname)
+        certpath = cls.get_certpath(name)
+        if cls.is_fresh(certpath):
             return certpath
-        cnfpath = "%s/%s.cnf" % (cls.certdir.rstrip('/'), hostname)
-        with open(cnfpath, 'w') as f:
-            content = 'subjectAltName=DNS:%s' % hostname
-            f.write(content)
-        p1 = Popen(["openssl", "req", "-new", "-key", cls.certkey,
-                    "-subj", "/CN=%s" % hostname], stdout=PIPE)
-        cmd = ('openssl x509 -req -days 365 -CA %s'
-               ' -CAkey %s -CAcreateserial'
-               ' -sha256 -extfile %s -out %s') % (
-                   cls.cacert, cls.cakey, cnfpath, certpath)
-        p2 = Popen(cmd, stdin=p1.stdout, stderr=PIPE, shell=True)
-        outs, errs = p2.communicate()
+        if x509 is not None:
+            data = cls.mint_cert(name)
+        else:
+            data = cls.mint_cert_with_openssl(name)
+        # write and rename, so that concurrent processes never read a
+        # partial file
+        fd, tmppath = tempfile.mkstemp(dir=cls.certdir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmppath, certpath)
+        logger.info('Minted certificate for %s', name)
         return certpath
+
+    @classmethod
+    def subject_alt_names(cls, name):
+        if is_ip_address(name):
+            return [('IP', name)]
+        names = [('DNS', name)]
+        if name.startswith('*.'):
+            names.append(('DNS', name[2:]))
+        return names
+
+    @classmethod
+    def mint_cert(cls, name):
+        if cls.ca is None:
+            with open(cls.cacert, 'rb') as f:
+                ca_cert = x509.load_pem_x509_certificate(f.read())
+            with open(cls.cakey, 'rb') as f:
+                ca_key = serialization.load_pem_private_key(f.read(), None)
+            with open(cls.certkey, 'rb') as f:
+                key = serialization.load_pem_private_key(f.read(), None)
+            cls.ca = (ca_cert, ca_key, key)
+        ca_cert, ca_key, key = cls.ca
+        sans = []
+        for kind, value in cls.subject_alt_names(name):
+            if kind == 'IP':
+                sans.append(x509.IPAddress(ipaddress.ip_address(value)))
+            else:
+                sans.append(x509.DNSName(value))
+        now = datetime.datetime.now(datetime.timezone.utc)
+        cert = x509.CertificateBuilder().subject_name(
+            x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, name)])
+        ).issuer_name(
+            ca_cert.subject
+        ).public_key(
+            key.public_key()
+        ).serial_number(
+            x509.random_serial_number()
+        ).not_valid_before(
+            now - datetime.timedelta(days=1)
+        ).not_valid_after(
+            now + datetime.timedelta(days=CERT_VALIDITY_DAYS)
+        ).add_extension(
+            x509.SubjectAlternativeName(sans), critical=False
+        ).sign(ca_key, hashes.SHA256())
+        return cert.public_bytes(serialization.Encoding.PEM)
+
+    @classmethod
+    def mint_cert_with_openssl(cls, name):
+        # fallback when cryptography is not installed, a fork and exec of
+        # two processes per certificate, see check_dependencies
+        sans = ','.join('%s:%s' % san for san in cls.subject_alt_names(name))
+        with tempfile.NamedTemporaryFile('w', suffix='.cnf') as cnf:
+            cnf.write('subjectAltName=%s\n' % sans)
+            cnf.flush()
+            p1 = Popen(["openssl", "req", "-new", "-key", cls.certkey,
+                        "-subj", "/CN=%s" % name], stdout=PIPE)
+            p2 = Popen(["openssl", "x509", "-req",
+                        "-days", str(CERT_VALIDITY_DAYS),
+                        "-CA", cls.cacert, "-CAkey", cls.cakey,
+                        "-set_serial", str(secrets.randbits(63)),
+                        "-sha256", "-extfile", cnf.name],
+                       stdin=p1.stdout, stdout=PIPE, stderr=PIPE)
+            p1.stdout.close()
+            outs, errs = p2.communicate()
+            p1.wait()
+        if p2.returncode != 0:
+            raise ssl.SSLError('openssl failed for %s: %s' % (
+                name, errs.decode(errors='replace')))
+        return outs
+
+    @classmethod
+    def create_server_context(cls, hostname):
+        certfile = cls.generate_cert(hostname)
+        ctx = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        ctx.load_cert_chain(certfile, keyfile=cls.certkey)
+        # In server mode, no certificate is requested from the client
+        ctx.verify_mode = ssl.CERT_NONE
+        return ctx
+
+    @classmethod
+    def get_context(cls, hostname, callback):
+        """Return the server context for hostname if it is cached.
+
+        Otherwise return None, the context is minted on the pool and
+        ``callback(context)`` is called from a pool thread, with None if
+        minting failed. Concurrent requests for a name share one mint.
+        """
+        name = cert_name(hostname)
+        with cls.lock:
+            ctx = cls.contexts.get(name)
+            if ctx is not None:
+                cls.contexts.move_to_end(name)
+                return ctx
+            callbacks = cls.pending.get(name)
+            if callbacks is not None:
+                callbacks.append(callback)
+                return None
+            cls.pending[name] = [callback]
+        future = cls.executor.submit(cls.create_server_context, hostname)
+        future.add_done_callback(
+            lambda f: cls.on_context_created(name, f))
+        return None
+
+    @classmethod
+    def on_context_created(cls, name, future):
+        try:
+            ctx = future.result()
+        except Exception as e:
+            logger.error('Cannot create certificate for %s: %r', name, e)
+            ctx = None
+        with cls.lock:
+            if ctx is not None:
+                cls.contexts[name] = ctx
+                while len(cls.contexts) > cls.context_cache_size:
+                    cls.contexts.popitem(last=False)
+            callbacks = cls.pending.pop(name, [])
+        for callback in callbacks:
+            callback(ctx)
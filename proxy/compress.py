@@ -0,0 +1,266 @@
+"""
+    compress.py: compress response bodies on the fly, off the event loop
+"""
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Sequence
+import logging
+import zlib
+
+from .cache import parse_cache_control
+from .constants import (CRLF, HEAD_METHOD, GZIP_LEVEL, BROTLI_QUALITY,
+                        ZSTD_LEVEL)
+from .http_parser import HttpParser
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+# headers that don't hold for the compressed body
+DROPPED_HEADERS = (b'content-length', b'transfer-encoding', b'accept-ranges',
+                   b'content-md5')
+
+
+class GzipEncoder:
+    name = b'gzip'
+
+    def __init__(self):
+        self.obj = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + 15)
+
+    def compress(self, data: bytes) -> bytes:
+        # a sync flush per batch, what has been received reaches the client
+        return self.obj.compress(data) + self.obj.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        return self.obj.flush()
+
+
+class BrotliEncoder:
+    name = b'br'
+
+    def __init__(self):
+        self.obj = brotli.Compressor(quality=BROTLI_QUALITY)
+
+    def compress(self, data: bytes) -> bytes:
+        return self.obj.process(data) + self.obj.flush()
+
+    def finish(self) -> bytes:
+        return self.obj.finish()
+
+
+class ZstdEncoder:
+    name = b'zstd'
+
+    def __init__(self):
+        self.obj = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+
+    def compress(self, data: bytes) -> bytes:
+        return self.obj.compress(data) + \
+            self.obj.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self) -> bytes:
+        return self.obj.flush()
+
+
+# in order of preference
+ENCODERS = [encoder for encoder, module in (
+    (BrotliEncoder, brotli), (ZstdEncoder, zstandard), (GzipEncoder, zlib))
+    if module is not None]
+
+
+def parse_accept_encoding(value: Optional[bytes]) -> Dict[bytes, float]:
+    codings: Dict[bytes, float] = {}
+    for item in (value or b'').lower().split(b','):
+        name, _, params = item.partition(b';')
+        name = name.strip()
+        if not name:
+            continue
+        q = 1.0
+        for param in params.split(b';'):
+            key, _, arg = param.strip().partition(b'=')
+            if key == b'q':
+                try:
+                    q = float(arg)
+                except ValueError:
+                    q = 0.0
+        codings[name] = q
+    return codings
+
+
+def is_compressible(content_type: Optional[bytes],
+                    types: Sequence[bytes]) -> bool:
+    """``types`` are media types, or prefixes ending with a slash."""
+    if not content_type:
+        return False
+    mime = content_type.split(b';', 1)[0].strip().lower()
+    for t in types:
+        if mime == t or (t.endswith(b'/') and mime.startswith(t)):
+            return True
+    return mime.endswith((b'+json', b'+xml'))
+
+
+def compressed_head(response: HttpParser, encoding: bytes) -> bytes:
+    lines = [bytes(response.start_line)]
+    vary = None
+    for name, value in response.header_list:
+        lower = bytes(name).lower()
+        if lower in DROPPED_HEADERS:
+            continue
+        if lower == b'vary':
+            vary = bytes(value)
+            continue
+        if lower == b'etag' and not bytes(value).startswith(b'W/'):
+            # the representation changed, a strong validator would lie
+            value = b'W/' + bytes(value)
+        lines.append(bytes(name) + b': ' + bytes(value))
+    if vary is None:
+        vary = b'Accept-Encoding'
+    elif vary != b'*' and b'accept-encoding' not in vary.lower():
+        vary += b', Accept-Encoding'
+    lines += [b'Vary: ' + vary, b'Content-Encoding: ' + encoding,
+              b'Transfer-Encoding: chunked']
+    return CRLF.join(lines) + CRLF * 2
+
+
+def chunk(data: bytes) -> bytes:
+    return b'%x\r\n' % len(data) + data + CRLF
+
+
+class Compression:
+    """Decide which responses to compress, and run the encoders.
+
+    A response is compressed when the client accepts an encoding we have
+    and the origin sent an uncompressed 200 with a compressible type and
+    a length, or a chunked body, of at least ``min_size`` bytes.
+    """
+
+    def __init__(self, min_size: int, types: Sequence[bytes], threads: int):
+        self.min_size = min_size
+        self.types = types
+        self.executor = ThreadPoolExecutor(max_workers=threads,
+                                           thread_name_prefix='compress')
+
+    def choose(self, request: HttpParser, response: HttpParser):
+        """Return the encoder class to use, None to pass the body as is."""
+        if (
+            response.status != 200
+            or request.method == HEAD_METHOD
+            # chunked framing needs HTTP/1.1 on both sides
+            or request.version != b'HTTP/1.1'
+            or response.version != b'HTTP/1.1'
+            or (response.content_length is None and not response.chunked)
+            or (response.content_length is not None and
+                response.content_length < self.min_size)
+            or response.get_header(b'content-encoding',
+                                   b'identity').lower() != b'identity'
+            or 'no-transform' in parse_cache_control(
+                response.get_header(b'cache-control'))
+            or not is_compressible(response.get_header(b'content-type'),
+                                   self.types)
+        ):
+            return None
+        accepted = parse_accept_encoding(
+            request.get_header(b'accept-encoding'))
+        default = accepted.get(b'*', 0.0)
+        for encoder in ENCODERS:
+            if accepted.get(encoder.name, default) > 0:
+                return encoder
+        return None
+
+    def stream(self, encoder, event_manager,
+               on_output: Callable[[Optional[bytes], bool], None]):
+        return CompressionStream(self.executor, encoder(), event_manager,
+                                 on_output)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+
+class CompressionStream:
+    """Compress a body in order, one batch at a time, on the pool.
+
+    The data fed while a batch is being compressed makes the next batch,
+    so a fast origin gets larger batches. ``on_output(data, final)`` is
+    called on the event loop, ``data`` framed as chunks, or None if the
+    encoder failed.
+    """
+
+    def __init__(self, executor: ThreadPoolExecutor, encoder,
+                 event_manager,
+                 on_output: Callable[[Optional[bytes], bool], None]):
+        self.executor = executor
+        self.encoder = encoder
+        self.event_manager = event_manager
+        self.on_output = on_output
+        self.pending: List = []
+        self.pending_size = 0
+        self.busy = False
+        self.finishing = False
+        self.closed = False
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def feed(self, data: memoryview):
+        if data:
+            self.pending.append(data)
+            self.pending_size += len(data)
+            self.schedule()
+
+    def finish(self):
+        self.finishing = True
+        self.schedule()
+
+    def schedule(self):
+        if self.busy or self.closed or not (self.pending or self.finishing):
+            return
+        data = b''.join(self.pending)
+        self.pending = []
+        self.pending_size = 0
+        self.busy = True
+        final = self.finishing
+        future = self.executor.submit(self.run, data, final)
+        future.add_done_callback(
+            lambda f: self.event_manager.call_soon_threadsafe(
+                self.on_done, f, final))
+
+    def run(self, data: bytes, final: bool) -> bytes:
+        # on a pool thread
+        out = self.encoder.compress(data) if data else b''
+        if final:
+            out += self.encoder.finish()
+        self.bytes_in += len(data)
+        self.bytes_out += len(out)
+        output = chunk(out) if out else b''
+        if final:
+            output += b'0\r\n\r\n'
+        return output
+
+    def on_done(self, future: Future, final: bool):
+        self.busy = False
+        if self.closed:
+            return
+        try:
+            output = future.result()
+        except Exception as e:
+            logger.error('Cannot compress a response: %r', e)
+            self.closed = True
+            self.on_output(None, True)
+            return
+        if final:
+            self.closed = True
+        self.on_output(output, final)
+        if not final:
+            self.schedule()
+
+    def close(self):
+        self.closed = True
+        self.pending = []
+        self.pending_size = 0
@@ -1,30 +1,49 @@
 """
     connection.py: TCP connection class
 """
-from typing import Union
+from typing import Optional, Union
 import socket
 import ssl
 import logging
+import time
 
-from .constants import BUFFER_SIZE
+from .constants import BUFFER_SIZE, EVENT_READ, EVENT_WRITE
+from .buffer import BufferChain, recv_chunks
 from .cert import CertificateHelper
+from . import tls
 
 logger = logging.getLogger(__name__)
 
 
 class TcpConnection:
 
+    __slots__ = ('sock', 'addr', 'read_closed', 'read_paused',
+                 'read_throttled', 'closed', 'buffer', 'tag', 'handler_id',
+                 'selected_event', 'event_manager', 'event_data',
+                 'ssl_enable', 'handshaking', 'handshake_event',
+                 'handshake_started', 'connecting', 'pipe')
+
     def __init__(self, sock, addr, tag='client'):
         self.sock: Union[socket.socket, ssl.SSLSocket] = sock
         self.addr = addr
         self.read_closed = False
+        self.read_paused = False
+        # over its rate, apart from the backpressure
+        self.read_throttled = False
         self.closed = False
-        self.buffer: bytes = b''
+        self.buffer = BufferChain()
         self.tag = tag
         self.handler_id = None
         self.selected_event = 0
+        self.event_manager = None
+        self.event_data = None
         self.ssl_enable = False
-        self.old_selected_sock = None
+        self.handshaking = False
+        self.handshake_event = 0
+        self.handshake_started = 0.0
+        self.connecting = False
+        # the splice channel writing into this connection
+        self.pipe = None
 
     def get_id(self):
         return self.sock.fileno()
@@ -35,63 +54,115 @@ class TcpConnection:
     def set_handler_id(self, handler_id):
         self.handler_id = handler_id
 
-    def wrap_socket(self, host):
+    def get_interest(self):
+        if self.connecting:
+            return EVENT_WRITE
+        if self.handshaking:
+            return self.handshake_event
+        event = 0 if self.read_closed or self.read_paused or \
+            self.read_throttled else EVENT_READ
+        if self.has_buffer():
+            event |= EVENT_WRITE
+        return event
+
+    def update_interest(self):
+        # the selector is only touched when the interest really changes
+        if self.event_manager:
+            self.event_manager.update(self)
+
+    def pause_reading(self):
+        if not self.read_paused:
+            self.read_paused = True
+            self.update_interest()
+
+    def resume_reading(self):
+        if self.read_paused:
+            self.read_paused = False
+            self.update_interest()
+            self.requeue()
+
+    def throttle(self):
+        if not self.read_throttled:
+            self.read_throttled = True
+            self.update_interest()
+
+    def unthrottle(self):
+        if self.read_throttled:
+            self.read_throttled = False
+            self.update_interest()
+            self.requeue()
+
+    def requeue(self):
+        # the input already decrypted won't wake up the selector
+        if self.event_manager:
+            self.event_manager.requeue(self)
+
+    def wrap_socket(self, host, context: Optional[ssl.SSLContext] = None,
+                    session: Optional[ssl.SSLSession] = None):
         if self.ssl_enable or self.is_closed():
             return
-        ctx = ssl.create_default_context()
         if self.tag == 'client':
-            certfile = CertificateHelper.generate_cert(host)
-            ctx.load_cert_chain(certfile, keyfile=CertificateHelper.certkey)
-            ctx.check_hostname = False
-            # In server mode, no certificate is requested from the client
-            ctx.verify_mode = ssl.CERT_NONE
-            # do_handshake_on_connect should only be used for blocking sockets,
-            # so we need to set blocking and set unblocking (and the events)
-            # after the handshake is done
-            self.sock.setblocking(True)
+            ctx = context or CertificateHelper.create_server_context(host)
             self.sock = ctx.wrap_socket(
                 self.sock,
-                do_handshake_on_connect=True,
+                do_handshake_on_connect=False,
                 server_side=True)
-            self.sock.setblocking(False)
+            self.handshake_event = EVENT_READ
         else:
-            self.sock.setblocking(True)
+            ctx = context or tls.client_context()
             self.sock = ctx.wrap_socket(
                 self.sock,
                 server_hostname=host,
-                do_handshake_on_connect=True)
-            self.sock.setblocking(False)
+                do_handshake_on_connect=False,
+                session=session)
+            self.handshake_event = EVENT_WRITE
+        # the handshake is driven by the event loop, see do_handshake
+        self.handshake_started = time.monotonic()
         self.ssl_enable = True
+        self.handshaking = True
+        self.update_interest()
 
-    def recv(self, buffer_size: int = BUFFER_SIZE):
-        if self.is_closed():
-            return None
-        data = b''
+    def do_handshake(self):
+        """Make progress on the TLS handshake, returns True once done."""
         try:
-            while True:
-                buf = self.sock.recv(buffer_size)
-                if len(buf) == 0:
-                    break
-                data += buf
-        except (ssl.SSLWantReadError, BlockingIOError) as e:
-            logger.error(e)
-            if len(data) == 0:
-                raise e
-        logger.info('Receive %d bytes, %s fd %d',
-                    len(data), self.tag, self.fileno())
-        if len(data) == 0:
+            self.sock.do_handshake()
+        except ssl.SSLWantReadError:
+            self.handshake_event = EVENT_READ
+        except ssl.SSLWantWriteError:
+            self.handshake_event = EVENT_WRITE
+        else:
+            self.handshaking = False
+            logger.debug('TLS handshake done, %s fd %d',
+                         self.tag, self.fileno())
+        self.update_interest()
+        return not self.handshaking
+
+    def recv(self, buffer_size: int = BUFFER_SIZE, limit: int = 0):
+        if self.is_closed():
             return None
-        return data
+        return recv_chunks(self.sock, buffer_size, limit)
+
+    def has_buffered_input(self):
+        # decrypted bytes left in the TLS layer, the selector doesn't see
+        # them
+        return self.ssl_enable and not self.handshaking and \
+            not self.closed and self.sock.pending() > 0
 
     def close(self):
-        logger.info('Close %s fd %d', self.tag, self.fileno())
+        logger.debug('Close %s fd %d', self.tag, self.fileno())
+        if self.event_manager:
+            self.event_manager.unregister(self)
         self.sock.close()
+        self.buffer.clear()
+        if self.pipe:
+            self.pipe.close()
         self.read_closed = False
         self.closed = True
 
     def flush_close(self):
         if self.has_buffer():
             self.read_closed = True
+            self.update_interest()
         else:
             self.close()
 
@@ -99,22 +170,28 @@ class TcpConnection:
         if self.is_closed():
             return 0
         n = 0
-        if len(self.buffer) > 0:
-            n = self.sock.send(self.buffer)
-            if self.tag == 'upstream':
-                logger.debug('upstream %d, send: %s',
-                             self.sock.fileno(), self.buffer[:n])
-            self.buffer = self.buffer[n:]
-        logger.info('Send %d bytes, %s fd %d', n, self.tag, self.fileno())
-        if self.read_closed and not self.has_buffer():
-            self.close()
+        if self.has_buffer():
+            n = self.buffer.send(self.sock)
+        if not self.has_buffer():
+            if self.read_closed:
+                self.close()
+            else:
+                self.update_interest()
         return n
 
-    def push_buffer(self, data: bytes):
-        self.buffer += data
+    def push_buffer(self, data):
+        was_empty = not self.has_buffer()
+        self.buffer.push(data)
+        if was_empty and self.has_buffer():
+            self.update_interest()
 
     def has_buffer(self):
-        return len(self.buffer) > 0
+        return self.pending_bytes() > 0
+
+    def pending_bytes(self):
+        if self.pipe:
+            return len(self.buffer) + self.pipe.pending
+        return len(self.buffer)
 
     def is_closed(self):
         return self.closed
@@ -0,0 +1,169 @@
+"""
+    connector.py: non-blocking upstream connections
+"""
+
+from typing import Callable, List, Optional
+import errno
+import logging
+import os
+import socket
+
+from .connection import TcpConnection
+from .constants import HAPPY_EYEBALLS_DELAY
+from .resolver import Resolver
+
+logger = logging.getLogger(__name__)
+
+
+def interleave_addresses(addrinfos: List) -> List:
+    """Alternate address families, starting with the preferred one."""
+    if not addrinfos:
+        return []
+    first_family = addrinfos[0][0]
+    first = [a for a in addrinfos if a[0] == first_family]
+    others = [a for a in addrinfos if a[0] != first_family]
+    result = []
+    while first or others:
+        if first:
+            result.append(first.pop(0))
+        if others:
+            result.append(others.pop(0))
+    return result
+
+
+class UpstreamConnector:
+    """Connect to an upstream without blocking the worker loop.
+
+    Addresses are tried Happy Eyeballs style (RFC 8305): a new attempt is
+    started every HAPPY_EYEBALLS_DELAY seconds, or as soon as the previous
+    one fails, alternating IPv6 and IPv4. The first connected socket wins
+    and ``callback(conn, error)`` is called with it, or with the error once
+    every address failed or the timeout fired.
+
+    The attempts are registered with ``data``, which has to forward their
+    readiness to ``on_ready``. With a ``source_address`` the sockets are
+    bound to it, and only the addresses of its family are tried.
+    """
+
+    def __init__(self, event_manager, resolver: Resolver, host: str,
+                 port: int, data, callback: Callable, timeout: float,
+                 source_address: Optional[str] = None):
+        self.event_manager = event_manager
+        self.resolver = resolver
+        self.host = host
+        self.port = port
+        self.data = data
+        self.callback = callback
+        self.timeout = timeout
+        self.source_address = source_address
+        self.addresses: List = []
+        self.attempts: List[TcpConnection] = []
+        self.error: Optional[Exception] = None
+        self.attempt_timer = None
+        self.timeout_timer = None
+        self.done = False
+
+    def start(self):
+        self.timeout_timer = self.event_manager.call_later(
+            self.timeout, self.on_timeout)
+        result = self.resolver.resolve(
+            self.host, self.port,
+            lambda result: self.event_manager.call_soon_threadsafe(
+                self.on_resolved, result))
+        if result is not None:
+            self.on_resolved(result)
+
+    def on_resolved(self, result):
+        if self.done:
+            return
+        addrinfos, error = result
+        if error is not None:
+            self.finish(None, error)
+            return
+        if self.source_address:
+            family = socket.AF_INET6 if ':' in self.source_address \
+                else socket.AF_INET
+            addrinfos = [a for a in addrinfos if a[0] == family]
+            if not addrinfos:
+                self.finish(None, OSError(
+                    errno.EADDRNOTAVAIL, 'no address of the family of %s' %
+                    self.source_address))
+                return
+        self.addresses = interleave_addresses(addrinfos)
+        self.start_next_attempt()
+
+    def start_next_attempt(self):
+        if self.done:
+            return
+        if self.attempt_timer:
+            self.attempt_timer.cancel()
+            self.attempt_timer = None
+        while self.addresses:
+            family, type_, proto, _, sockaddr = self.addresses.pop(0)
+            sock = socket.socket(family, type_, proto)
+            sock.setblocking(False)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if self.source_address:
+                try:
+                    sock.bind((self.source_address, 0))
+                except OSError as e:
+                    self.error = e
+                    sock.close()
+                    continue
+            err = sock.connect_ex(sockaddr)
+            if err not in (0, errno.EINPROGRESS):
+                self.error = OSError(err, os.strerror(err))
+                sock.close()
+                continue
+            conn = TcpConnection(sock, self.host, 'upstream')
+            conn.connecting = True
+            self.attempts.append(conn)
+            self.event_manager.register(conn, self.data)
+            if self.addresses:
+                self.attempt_timer = self.event_manager.call_later(
+                    HAPPY_EYEBALLS_DELAY, self.start_next_attempt)
+            return
+        if not self.attempts:
+            self.finish(None, self.error or OSError(
+                errno.EHOSTUNREACH, 'no address to connect to'))
+
+    def on_ready(self, conn: TcpConnection):
+        err = conn.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        self.attempts.remove(conn)
+        if err != 0:
+            self.error = OSError(err, os.strerror(err))
+            logger.debug('Connect to %s:%d failed: %s',
+                         self.host, self.port, self.error)
+            conn.close()
+            self.start_next_attempt()
+            return
+        conn.connecting = False
+        self.finish(conn, None)
+
+    def on_timeout(self):
+        self.timeout_timer = None
+        self.finish(None, TimeoutError(
+            'connect to %s:%d timed out' % (self.host, self.port)))
+
+    def cancel(self):
+        self.done = True
+        self.cleanup()
+
+    def cleanup(self):
+        for conn in self.attempts:
+            conn.close()
+        self.attempts = []
+        self.addresses = []
+        if self.attempt_timer:
+            self.attempt_timer.cancel()
+        if self.timeout_timer:
+            self.timeout_timer.cancel()
+
+    def finish(self, conn: Optional[TcpConnection], error):
+        if self.done:
+            return
+        self.done = True
+        self.cleanup()
+        if conn is not None:
+            conn.update_interest()
+        self.callback(conn, error)
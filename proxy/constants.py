@@ -6,15 +6,69 @@ import selectors
 
 EVENT_READ = selectors.EVENT_READ
 EVENT_WRITE = selectors.EVENT_WRITE
-BUFFER_SIZE = 4096
-DEFAULT_SELECTOR_SELECT_TIMEOUT = 25 / 1000
+BUFFER_SIZE = 64 * 1024
+RECV_BUFFER_POOL_SIZE = 64
+SEND_QUEUE_POOL_SIZE = 1024
+TIMER_RESOLUTION = 10 / 1000
+TIMER_WHEEL_SIZE = 4096
+DEFAULT_HIGH_WATERMARK = 256 * 1024
+DEFAULT_LOW_WATERMARK = 64 * 1024
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_METRICS_HOST = '127.0.0.1'
+DEFAULT_WORKERS = 1
+DEFAULT_THREADS = 1
+ACCEPT_BATCH_SIZE = 128
+DEFAULT_READ_BUDGET = 256 * 1024
+RATE_LIMIT_RESUME = 0.1
+DEFAULT_DRAIN_TIMEOUT = 30
+WORKER_RESTART_DELAY = 1
+DEFAULT_MEMORY_BUDGET = 256 * 1024 * 1024
+DEFAULT_CERT_CACHE_SIZE = 1024
+DEFAULT_TLS_SESSION_CACHE_SIZE = 1024
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_IDLE_TIMEOUT = 60
+DEFAULT_HEADER_TIMEOUT = 30
+DEFAULT_HANDSHAKE_TIMEOUT = 10
+HAPPY_EYEBALLS_DELAY = 0.25
+DEFAULT_DNS_CACHE_SIZE = 4096
+DEFAULT_DNS_TTL = 60
+DEFAULT_DNS_NEGATIVE_TTL = 5
+DEFAULT_DNS_WORKERS = 8
+DEFAULT_POOL_MAX_IDLE = 8
+DEFAULT_POOL_IDLE_TIMEOUT = 30
+DEFAULT_MAX_HEADER_SIZE = 64 * 1024
+DEFAULT_CACHE_MEMORY_SIZE = 64 * 1024 * 1024
+DEFAULT_CACHE_DISK_SIZE = 1024 * 1024 * 1024
+DEFAULT_CACHE_MAX_OBJECT_SIZE = 16 * 1024 * 1024
+DEFAULT_COMPRESS_MIN_SIZE = 1024
+DEFAULT_COMPRESS_TYPES = ('text/,application/json,application/javascript,'
+                          'application/xml,image/svg+xml')
+DEFAULT_COMPRESS_THREADS = 2
+DEFAULT_RULES_RELOAD_INTERVAL = 5
+DEFAULT_PROFILE_SECONDS = 30
+MAX_PROFILE_SECONDS = 60
+PROFILE_INTERVAL = 0.01
+DEFAULT_LAG_THRESHOLD = 0.1
+LAG_RECORDS = 100
+DEFAULT_CAPTURE_FORMAT = 'har'
+DEFAULT_CAPTURE_BUFFER_SIZE = 64 * 1024 * 1024
+DEFAULT_CAPTURE_FILE_SIZE = 100 * 1024 * 1024
+DEFAULT_CAPTURE_FILES = 10
+CAPTURE_MAX_BODY = 1024 * 1024
+CAPTURE_FLUSH_INTERVAL = 0.2
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 4
+ZSTD_LEVEL = 3
+CERT_VALIDITY_DAYS = 365
 CRLF = b'\r\n'
 CONNECT_METHOD = 'CONNECT'
 GET_METHOD = 'GET'
+HEAD_METHOD = 'HEAD'
 
 CONNECTION_ESTABLISHED_MESSAGE = b'HTTP/1.1 200 Connection Established\r\n\r\n'
 
 DEFAULT_LOG_FILE = "proxy.log"
+DEFAULT_ACCESS_LOG_FILE = "access.log"
 DEFAULT_LOG_FORMAT = '%(asctime)s - pid:%(process)d [%(levelname)-.1s] %(module)s.%(funcName)s:%(lineno)d - %(message)s'
 DEFAULT_LOG_LEVEL = 'INFO'
 
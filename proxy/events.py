@@ -2,45 +2,136 @@
     events.py: events manager
 """
 
+from collections import deque
+from typing import Dict, List
+import os
 import selectors
+import socket
 
 from .connection import TcpConnection
-from .constants import DEFAULT_SELECTOR_SELECT_TIMEOUT
+from .constants import EVENT_READ
+from .timer import Timer, TimerWheel
 
 
 class EventManager:
+    """Keep the selector in sync with the interest of the connections.
 
-    def __init__(self):
-        self.selector = selectors.SelectSelector()
+    The DefaultSelector is epoll on Linux. Connections call ``update``
+    only when their interest changes (buffer empty/non-empty, read side
+    closed), so a loop iteration costs O(ready sockets) instead of
+    O(registered sockets).
+    """
 
-    def set_event(self, conn, event, data):
-        if conn.selected_event == 0:
-            self.selector.register(conn.sock, event, data)
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        # callbacks scheduled from other threads, the waker makes select
+        # return as soon as one is queued
+        self.callbacks = deque()
+        self.wakeup_pending = False
+        if hasattr(os, 'eventfd'):
+            self.waker_r = self.waker_w = os.eventfd(
+                0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
         else:
-            self.selector.modify(conn.sock, event, data)
-        conn.selected_event = event
+            self.waker_r, self.waker_w = socket.socketpair()
+            self.waker_r.setblocking(False)
+            self.waker_w.setblocking(False)
+        self.selector.register(self.waker_r, EVENT_READ, data=None)
+        self.timers = TimerWheel()
+        # connections with input the selector can't see, decrypted TLS
+        # records, handled in the next turn
+        self.requeued: List[TcpConnection] = []
 
-    def add_event(self, conn: TcpConnection, event, data):
-        if conn.selected_event == 0:
-            conn.selected_event = event
-            self.selector.register(conn.sock, conn.selected_event, data)
-        else:
-            conn.selected_event |= event
-            self.selector.modify(conn.sock, conn.selected_event, data)
+    def call_later(self, delay, callback, *args) -> Timer:
+        return self.timers.call_later(delay, callback, *args)
+
+    def call_soon_threadsafe(self, callback, *args):
+        self.callbacks.append((callback, args))
+        self.wakeup()
 
-    def remove_event(self, conn: TcpConnection, event, data):
-        conn.selected_event &= (~event)
+    def wakeup(self):
+        """Make select return, from any thread."""
+        if self.wakeup_pending:
+            # a burst of handoffs costs a single write
+            return
+        self.wakeup_pending = True
+        try:
+            if isinstance(self.waker_w, int):
+                os.eventfd_write(self.waker_w, 1)
+            else:
+                self.waker_w.send(b'\0')
+        except BlockingIOError:
+            # the loop is already woken up
+            pass
+
+    def run_callbacks(self):
+        try:
+            if isinstance(self.waker_r, int):
+                os.eventfd_read(self.waker_r)
+            else:
+                while self.waker_r.recv(4096):
+                    pass
+        except BlockingIOError:
+            pass
+        # cleared after reading, so a wakeup's write is never consumed
+        # with the flag still set: the wakeups in between left their
+        # callbacks in the queue, run below, the later ones write again
+        self.wakeup_pending = False
+        for _ in range(len(self.callbacks)):
+            callback, args = self.callbacks.popleft()
+            callback(*args)
+
+    def register(self, conn: TcpConnection, data):
+        conn.event_manager = self
+        conn.event_data = data
+        self.update(conn)
+
+    def update(self, conn: TcpConnection):
+        event = conn.get_interest()
+        if event == conn.selected_event:
+            return
         if conn.selected_event == 0:
-            self.selector.unregister(conn.sock)
+            self.selector.register(conn, event, conn.event_data)
+        elif event == 0:
+            self.selector.unregister(conn)
         else:
-            self.selector.modify(conn.sock, conn.selected_event, data)
+            self.selector.modify(conn, event, conn.event_data)
+        conn.selected_event = event
+
+    def requeue(self, conn: TcpConnection):
+        if conn.has_buffered_input():
+            self.requeued.append(conn)
 
     def unregister(self, conn: TcpConnection):
         if conn.selected_event != 0:
-            self.selector.unregister(conn.sock)
+            self.selector.unregister(conn)
             conn.selected_event = 0
+        conn.event_manager = None
+
+    def wait(self) -> List:
+        """Sleep until a connection is ready, the next timer, or a
+        wakeup, and return what the selector reported."""
+        timeout = 0 if self.requeued else self.timers.timeout()
+        return self.selector.select(timeout=timeout)
+
+    def dispatch(self, events: List) -> Dict[TcpConnection, int]:
+        """Run the callbacks and the due timers, and return the ready
+        connections and their events.
 
-    def select_events(self):
-        events = self.selector.select(timeout=DEFAULT_SELECTOR_SELECT_TIMEOUT)
-        return events
+        The requeued connections come after the ones the selector
+        reported, if they still want to read.
+        """
+        ready = {}
+        for key, mask in events:
+            if key.data is None:
+                self.run_callbacks()
+            else:
+                ready[key.fileobj] = mask
+        self.timers.expire()
+        requeued, self.requeued = self.requeued, []
+        for conn in requeued:
+            if not conn.is_closed() and conn.get_interest() & EVENT_READ:
+                ready[conn] = ready.get(conn, 0) | EVENT_READ
+        return ready
 
+    def select_events(self) -> Dict[TcpConnection, int]:
+        return self.dispatch(self.wait())
@@ -13,8 +13,8 @@ class FlagParser:
     def add_argument(self, *args, **kwargs):
         self.parser.add_argument(*args, **kwargs)
 
-    def parse_args(self):
-        self.args = self.parser.parse_args()
+    def parse_args(self, args=None):
+        self.args = self.parser.parse_args(args)
         return self.args
 
 
@@ -2,117 +2,971 @@
     http_handler.py: handle the lifecycle http protocol
 """
 
-import socket
-from typing import Optional
-from collections import deque
-import threading
+import ssl
+from http import HTTPStatus
+from typing import List, Optional
+import errno
+import itertools
 import logging
+import socket
+import time
 
 from .connection import TcpConnection
-from .http_parser import HttpParser
-from .constants import CONNECTION_ESTABLISHED_MESSAGE
+from .connector import UpstreamConnector
+from .http_parser import HttpParser, HttpParserError, RESPONSE_PARSER
+from .access_log import AccessRecorder
+from .timer import Timer
+from .ratelimit import TokenBucket
+from .cache import CacheEntry, cache_key, parse_cache_control
+from .compress import CompressionStream, compressed_head
+from .rules import DENY, ROUTE
+from .capture import DataEvent, Exchange
+from .constants import CONNECTION_ESTABLISHED_MESSAGE, CRLF, GET_METHOD
 from .flag import flags
 from .cert import CertificateHelper
+from . import splice, tls
 
 
 logger = logging.getLogger(__name__)
 
+# file descriptors are reused as soon as they are closed, so handlers get
+# their own ids
+handler_ids = itertools.count(1)
+
+
+def error_response(status: int) -> bytes:
+    return (b'HTTP/1.1 %d %s\r\n'
+            b'Content-Length: 0\r\nConnection: close\r\n\r\n') % (
+                status, HTTPStatus(status).phrase.encode())
+
+
+def conditional_head(request: HttpParser, entry: CacheEntry) -> bytes:
+    lines = [bytes(request.start_line)]
+    for name, value in request.header_list:
+        lines.append(bytes(name) + b': ' + bytes(value))
+    if entry.etag is not None:
+        lines.append(b'If-None-Match: ' + entry.etag)
+    if entry.last_modified is not None:
+        lines.append(b'If-Modified-Since: ' + entry.last_modified)
+    return CRLF.join(lines) + CRLF * 2
+
 
 class HttpProxyHandler:
 
-    def __init__(self, client: TcpConnection, work_queue: deque,
-                 lock: threading.Lock):
+    # a handler per client, most of them idle, the slots keep them small
+    __slots__ = ('client', 'worker', 'upstream', 'connector',
+                 'upstream_backlog', 'request', 'response',
+                 'upstream_reusable', 'id', 'wrap_client_pending',
+                 'client_context', 'high_watermark', 'low_watermark', 'cache',
+                 'cache_key', 'cache_chunks', 'cache_size', 'cache_expires',
+                 'cache_entry', 'cache_waited', 'compression',
+                 'compress_stream', 'compress_tail', 'tunnel_host',
+                 'tls_session_key', 'client_pending', 'splice_pending',
+                 'splicing', 'bytes_up', 'bytes_down', 'bytes_to_client',
+                 'metrics', 'connect_started', 'recorder', 'timeouts',
+                 'deadline', 'deadline_reason', 'last_activity', 'rate_limit',
+                 'throttle_timer', 'egress', 'capture', 'capture_peer')
+
+    def __init__(self, client: TcpConnection, worker):
         self.client = client
-        self.work_queue = work_queue
-        self.lock = lock
+        self.worker = worker
         self.upstream: Optional[TcpConnection] = None
+        self.connector: Optional[UpstreamConnector] = None
+        # data for the upstream while it is being connected
+        self.upstream_backlog: Optional[List] = None
         self.request = HttpParser()
-        self.id = self.client.get_id()
+        self.response: Optional[HttpParser] = None
+        # False once the upstream can't be handed back to the pool
+        self.upstream_reusable = False
+        self.id = next(handler_ids)
         self.client.set_handler_id(self.id)
-        self.wrap_client_after_flush = False
+        self.client.buffer.budget = worker.memory_budget
+        self.wrap_client_pending = False
+        self.client_context: Optional[ssl.SSLContext] = None
+        self.high_watermark = flags.args.high_watermark
+        self.low_watermark = flags.args.low_watermark
+        self.cache = worker.cache
+        # the key this handler fetches for the cache, and what it captured
+        self.cache_key: Optional[str] = None
+        self.cache_chunks: Optional[List] = None
+        self.cache_size = 0
+        self.cache_expires = 0.0
+        # the stale entry being revalidated
+        self.cache_entry: Optional[CacheEntry] = None
+        self.cache_waited = False
+        self.compression = worker.compression
+        self.compress_stream: Optional[CompressionStream] = None
+        # upstream data after a compressed response, until it is written
+        self.compress_tail: Optional[List] = None
+        # the CONNECT host of a tunnel whose requests are parsed
+        self.tunnel_host: Optional[str] = None
+        # the upstream whose TLS session is to be cached, once resumable
+        self.tls_session_key = None
+        # client data held while waiting for another handler's fetch
+        self.client_pending: Optional[List] = None
+        self.splice_pending = False
+        self.splicing = False
+        self.bytes_up = 0
+        self.bytes_down = 0
+        # what the client is sent: relayed, cached, compressed or errors
+        self.bytes_to_client = 0
+        self.metrics = worker.metrics
+        self.connect_started = 0.0
+        self.recorder = AccessRecorder(worker.access_log, self.id,
+                                       client.addr)
+        # a single timer per handler, for whatever the handler waits on
+        self.timeouts = worker.timeouts
+        self.deadline: Optional[Timer] = None
+        self.deadline_reason: Optional[str] = None
+        self.last_activity = time.monotonic()
+        self.set_deadline('header')
+        # the bytes relayed for the client, both ways, when rate limited
+        rate = flags.args.client_rate
+        self.rate_limit = TokenBucket(rate, rate) if rate > 0 else None
+        self.throttle_timer: Optional[Timer] = None
+        # the local address to connect from, routed by the rules
+        self.egress: Optional[str] = None
+        # what is captured of the current exchange, and the upstream
+        # address of a tunnel whose bytes are captured
+        self.capture: Optional[Exchange] = None
+        self.capture_peer = None
+
+    def upstream_key(self):
+        return self.request.host, self.request.port, self.egress
 
     def connect_upstream(self):
         assert self.request.host and self.request.port
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.connect((self.request.host, self.request.port))
-        sock.setblocking(False)
-        logger.info('Connect to upstream %s:%d, fd %d',
-                    self.request.host, self.request.port, sock.fileno())
-        self.upstream = TcpConnection(sock, self.request.host, 'upstream')
+        if not self.request.is_connect():
+            upstream = self.worker.upstream_pool.checkout(self.upstream_key())
+            if upstream:
+                self.metrics.inc('upstream_reuses')
+                self.worker.event_manager.register(upstream, self)
+                self.on_upstream_connected(upstream, None)
+                return
+        # nothing can be forwarded before the upstream is connected
+        self.client.pause_reading()
+        self.connect_started = time.monotonic()
+        self.connector = UpstreamConnector(
+            self.worker.event_manager, self.worker.resolver,
+            self.request.host, self.request.port,
+            self, self.on_upstream_connected, flags.args.connect_timeout,
+            self.egress)
+        self.connector.start()
+
+    def on_upstream_connected(self, upstream: Optional[TcpConnection],
+                              error: Optional[Exception]):
+        if self.connector:
+            self.connector = None
+            if upstream is None:
+                self.metrics.inc('upstream_connect_errors')
+            else:
+                self.metrics.inc('upstream_connects')
+                self.metrics.observe('upstream_connect_seconds',
+                                     time.monotonic() - self.connect_started)
+        if self.client.is_closed():
+            if upstream:
+                upstream.close()
+            self.check_closed()
+            return
+        if upstream is None:
+            logger.warning('Cannot connect to upstream %s:%d: %s',
+                           self.request.host, self.request.port, error)
+            self.set_close_reason('connect failed: %s' % error)
+            self.reply_error(504 if isinstance(error, TimeoutError) else 502)
+            self.check_closed()
+            return
+        logger.debug('Connect to upstream %s:%d, fd %d',
+                     self.request.host, self.request.port, upstream.fileno())
+        self.upstream = upstream
         self.upstream.set_handler_id(self.id)
-        if self.request.has_buffer():
-            self.pipe_data_to_upstream(self.request.get_buffer())
+        if self.throttle_timer:
+            self.upstream.throttle()
+        self.upstream.buffer.budget = self.worker.memory_budget
+        backlog, self.upstream_backlog = self.upstream_backlog or (), None
+        for data in backlog:
+            self.pipe_data_to_upstream(data)
+        self.client.resume_reading()
+        if not self.request.is_connect():
+            self.new_response()
+            self.upstream_reusable = True
+            return
         self.pipe_data_to_client(CONNECTION_ESTABLISHED_MESSAGE)
-        with self.lock:
-            self.work_queue.append(self.upstream)
+        self.update_record(status=200)
         if flags.args.man_in_the_middle and self.request.port == 443:
-            if self.client.has_buffer():
-                self.wrap_client_after_flush = True
-            else:
-                self.client.wrap_socket(self.request.host)
-            self.upstream.wrap_socket(self.request.host)
+            # the client must not be read until its TLS layer is in place
+            self.client.pause_reading()
+            self.wrap_client_pending = True
+            self.client_context = CertificateHelper.get_context(
+                self.request.host,
+                lambda ctx: self.worker.event_manager.call_soon_threadsafe(
+                    self.on_client_context, ctx))
+            self.metrics.inc('cert_cache_misses' if self.client_context is None
+                             else 'cert_cache_hits')
+            self.maybe_wrap_client()
+            self.tls_session_key = self.request.host, self.request.port
+            self.upstream.wrap_socket(
+                self.request.host,
+                session=tls.sessions.get(self.tls_session_key))
+            self.set_deadline('handshake')
+            if self.compression or self.worker.capture:
+                self.start_interception()
+        elif self.worker.capture and \
+                self.worker.capture.wants(self.request.host):
+            # the bytes have to go through the loop to be captured
+            self.capture_peer = self.upstream_peer()
+        elif flags.args.splice and splice.is_available() and \
+                self.rate_limit is None:
+            # what is already buffered in userspace has to go first
+            self.client.pause_reading()
+            self.upstream.pause_reading()
+            self.splice_pending = True
+            self.maybe_start_splice()
+
+    def start_interception(self):
+        # the requests in the tunnel are handled as plain ones, all on the
+        # upstream of the tunnel
+        self.tunnel_host = self.request.host
+        self.finish_record('intercepted')
+        self.request = HttpParser(default_port=443)
+
+    def on_client_context(self, ctx: Optional[ssl.SSLContext]):
+        if self.client.is_closed():
+            return
+        if ctx is None:
+            self.set_close_reason('no certificate for %s' % (
+                self.tunnel_host or self.request.host))
+            self.close()
+            self.check_closed()
+            return
+        self.client_context = ctx
+        self.maybe_wrap_client()
+
+    def maybe_wrap_client(self):
+        # wrap once the connection established message is flushed and the
+        # certificate is ready
+        if (
+            self.wrap_client_pending
+            and self.client_context is not None
+            and not self.client.has_buffer()
+        ):
+            self.wrap_client_pending = False
+            self.client.wrap_socket(self.tunnel_host or self.request.host,
+                                    self.client_context)
+            self.client.resume_reading()
 
-    def read_from_fd(self, fd):
-        if fd == self.client.fileno():
+    def maybe_start_splice(self):
+        if (
+            not self.splice_pending
+            or self.client.has_buffer()
+            or self.upstream.has_buffer()
+        ):
+            return
+        self.splice_pending = False
+        try:
+            self.upstream.pipe = splice.SpliceChannel(self.client,
+                                                      self.upstream)
+            self.client.pipe = splice.SpliceChannel(self.upstream,
+                                                    self.client)
+            self.splicing = True
+        except OSError as e:
+            logger.info('Cannot splice the tunnel to %s:%d: %s',
+                        self.request.host, self.request.port, e)
+            self.stop_splice()
+        self.client.resume_reading()
+        self.upstream.resume_reading()
+
+    def stop_splice(self):
+        # back to the userspace path, only before any byte was spliced
+        self.splicing = False
+        for conn in (self.client, self.upstream):
+            if conn.pipe:
+                conn.pipe.close()
+                conn.pipe = None
+
+    def splice_from(self, source: TcpConnection):
+        sink = self.upstream if source is self.client else self.client
+        channel = sink.pipe
+        try:
+            n = channel.fill()
+        except OSError as e:
+            if e.errno not in splice.UNSUPPORTED_ERRORS or \
+                    self.client.pipe.total or self.upstream.pipe.total:
+                raise
+            logger.info('Cannot splice the tunnel to %s:%d: %s',
+                        self.request.host, self.request.port, e)
+            self.stop_splice()
+            return self.read_from(source)
+        if n < 0:
+            source.pause_reading()
+        elif source is self.client:
+            self.bytes_up += n
+            self.metrics.inc('client_bytes_received', n)
+        else:
+            self.bytes_down += n
+            self.bytes_to_client += n
+            self.metrics.inc('upstream_bytes_received', n)
+        return self.splice_to(sink)
+
+    def splice_to(self, sink: TcpConnection):
+        channel = sink.pipe
+        n = channel.drain()
+        if n > 0:
+            self.metrics.inc('client_bytes_sent' if sink is self.client
+                             else 'upstream_bytes_sent', n)
+        if channel.is_done():
+            if sink.is_read_closed():
+                sink.close()
+            elif not channel.shutdown:
+                # pass the half-close on, the other direction keeps going
+                channel.shutdown = True
+                try:
+                    sink.sock.shutdown(socket.SHUT_WR)
+                except OSError as e:
+                    if e.errno != errno.ENOTCONN:
+                        raise
+            if self.client.pipe.shutdown and self.upstream.pipe.shutdown:
+                self.set_close_reason('tunnel closed')
+                self.close()
+                return n
+        elif channel.is_full():
+            channel.source.pause_reading()
+        elif not channel.eof:
+            channel.source.resume_reading()
+        sink.update_interest()
+        return n
+
+    def set_deadline(self, reason: str):
+        if self.deadline:
+            self.deadline.cancel()
+        self.deadline_reason = reason
+        self.deadline = self.worker.event_manager.call_later(
+            self.timeouts[reason], self.on_deadline)
+
+    def cancel_deadline(self):
+        if self.deadline:
+            self.deadline.cancel()
+            self.deadline = None
+
+    def on_deadline(self):
+        self.deadline = None
+        if self.is_closed():
+            return
+        reason = self.deadline_reason
+        if reason == 'idle':
+            # activity only stamps last_activity, the timer is moved here
+            remaining = self.last_activity + self.timeouts['idle'] - \
+                time.monotonic()
+            if remaining > 0:
+                self.deadline = self.worker.event_manager.call_later(
+                    remaining, self.on_deadline)
+                return
+        logger.debug('Handler %s: %s timeout', self.id, reason)
+        self.set_close_reason('%s timeout' % reason)
+        if reason == 'header' and not self.client.is_closed():
+            self.reply_error(408)
+            # in case the client doesn't read the response
+            self.set_deadline('idle')
+        else:
+            self.close()
+        self.check_closed()
+
+    def read_from(self, conn: TcpConnection):
+        self.last_activity = time.monotonic()
+        if conn.connecting:
+            return self.connector.on_ready(conn)
+        if conn.handshaking:
+            return self.continue_handshake(conn)
+        if self.splicing:
+            return self.splice_from(conn)
+        if conn is self.client:
             return self.recv_from_client()
-        elif self.upstream and fd == self.upstream.fileno():
+        elif conn is self.upstream:
             return self.recv_from_upstream()
 
-    def write_to_fd(self, fd):
-        if fd == self.client.fileno():
+    def write_to(self, conn: TcpConnection):
+        self.last_activity = time.monotonic()
+        if conn.connecting:
+            return self.connector.on_ready(conn)
+        if conn.handshaking:
+            return self.continue_handshake(conn)
+        if self.splicing:
+            return self.splice_to(conn)
+        if conn is self.client:
             return self.send_to_client()
-        elif self.upstream and fd == self.upstream.fileno():
+        elif conn is self.upstream:
             return self.send_to_upstream()
 
+    def continue_handshake(self, conn: TcpConnection):
+        if not conn.do_handshake():
+            return False
+        self.metrics.observe('tls_handshake_seconds',
+                             time.monotonic() - conn.handshake_started)
+        resumed = conn.sock.session_reused
+        if conn is self.client:
+            self.metrics.inc('tls_client_resumptions' if resumed
+                             else 'tls_client_full_handshakes')
+        else:
+            self.metrics.inc('tls_session_hits' if resumed
+                             else 'tls_session_misses')
+            self.save_tls_session()
+        if not (
+            self.wrap_client_pending
+            or self.client.handshaking
+            or self.upstream.handshaking
+        ):
+            self.set_deadline('idle')
+        # application data may have arrived with the last handshake
+        # records, it sits in the TLS buffer and won't wake up the selector
+        try:
+            return self.read_from(conn)
+        except ssl.SSLWantReadError:
+            return False
+
+    def save_tls_session(self):
+        # a TLS 1.3 ticket comes with the first records after the handshake
+        if tls.SessionCache.is_resumable(self.upstream.sock):
+            tls.sessions.put(self.tls_session_key, self.upstream.sock.session)
+            self.tls_session_key = None
+
+    def read_limit(self) -> int:
+        """The most to read in one turn, 0 for no limit."""
+        limit = self.worker.read_budget
+        if self.rate_limit is not None:
+            tokens = max(self.rate_limit.available(), 1)
+            limit = min(limit, tokens) if limit else tokens
+        return limit
+
+    def charge(self, n: int):
+        bucket = self.rate_limit
+        if bucket is None:
+            return
+        bucket.consume(n)
+        if bucket.is_empty() and self.throttle_timer is None:
+            for conn in (self.client, self.upstream):
+                if conn:
+                    conn.throttle()
+            self.throttle_timer = self.worker.event_manager.call_later(
+                bucket.resume_delay(), self.on_throttle_end)
+
+    def on_throttle_end(self):
+        self.throttle_timer = None
+        if self.is_closed():
+            return
+        for conn in (self.client, self.upstream):
+            if conn and not conn.is_closed():
+                conn.unthrottle()
+
     def recv_from_client(self):
-        data = self.client.recv()
-        if data is None:
+        chunks = self.client.recv(limit=self.read_limit())
+        if chunks is None:
+            self.set_close_reason('client closed')
             self.close_client()
             # also close the upstream
             self.close_upstream()
             return True
-        if self.request.is_completed():
-            assert self.upstream
-            self.pipe_data_to_upstream(data)
-        else:
-            self.request.parse(data)
-            if not self.upstream and self.request.has_host():
-                self.connect_upstream()
+        n = sum(len(data) for data in chunks)
+        self.bytes_up += n
+        self.metrics.inc('client_bytes_received', n)
+        self.charge(n)
+        try:
+            for data in chunks:
+                self.feed_request(data)
+        except HttpParserError as e:
+            logger.debug('Invalid request from client %s: %s',
+                         self.client.addr, e)
+            self.set_close_reason('invalid request: %s' % e)
+            self.reply_error(e.status)
+            return True
         return False
 
+    def feed_request(self, data):
+        while len(data):
+            if self.client_pending is not None:
+                self.client_pending.append(data)
+                return
+            if self.client.is_closed() or self.client.is_read_closed():
+                return
+            if self.request.is_completed():
+                if not self.request.is_connect():
+                    # pipelined requests, the responses can't be told apart
+                    self.upstream_reusable = False
+                elif self.capture_peer is not None:
+                    self.capture_data(0, data)
+                self.pipe_data_to_upstream(data)
+                return
+            in_head = not self.request.is_headers_completed()
+            if in_head and self.deadline_reason != 'header':
+                self.set_deadline('header')
+            n = self.request.parse(data)
+            if not in_head:
+                self.pipe_data_to_upstream(data[:n])
+                if self.capture is not None:
+                    self.capture.add_request_body(data[:n])
+            elif self.request.is_headers_completed():
+                self.on_request_head()
+            data = data[n:]
+
+    def on_request_head(self):
+        if not self.request.has_host():
+            raise HttpParserError('no host in request')
+        self.recorder.start(self.request)
+        self.set_deadline('idle')
+        capture = self.worker.capture
+        if self.tunnel_host is not None:
+            if self.request.is_connect():
+                raise HttpParserError('CONNECT in an intercepted tunnel')
+            if capture and capture.wants(self.tunnel_host):
+                self.capture = Exchange('https', self.request.raw_head)
+            self.pipe_data_to_upstream(self.request.raw_head)
+            self.new_response()
+            return
+        if self.worker.rules and not self.check_rules():
+            return
+        if capture and not self.request.is_connect() and \
+                capture.wants(self.request.host):
+            self.capture = Exchange('http', self.request.raw_head)
+        if not self.request.is_connect():
+            head = self.request.raw_head
+            if self.cache and self.request.method == GET_METHOD and \
+                    self.request.is_completed():
+                head = self.lookup_cache()
+                if head is None:
+                    return
+            self.pipe_data_to_upstream(head)
+        if not self.upstream:
+            self.connect_upstream()
+
+    def check_rules(self) -> bool:
+        """Apply the rules to the host, False if the request is denied."""
+        action, egress = self.worker.rules.decide(self.request.host)
+        if action == DENY:
+            self.metrics.inc('rule_denials')
+            self.set_close_reason('denied by rule')
+            self.reply_error(403)
+            return False
+        if action == ROUTE:
+            self.metrics.inc('rule_routes')
+        self.egress = egress
+        return True
+
+    def lookup_cache(self) -> Optional[bytes]:
+        """Serve the request from the cache if possible.
+
+        Return the request head to forward, or None if the request was
+        answered or waits for a fetch of the same key.
+        """
+        request = self.request
+        waited, self.cache_waited = self.cache_waited, False
+        if any(request.get_header(name) is not None for name in (
+                b'if-none-match', b'if-modified-since', b'range')):
+            # the client revalidates its own copy, or wants a part of it
+            return request.raw_head
+        cc = parse_cache_control(request.get_header(b'cache-control'))
+        bypass = 'no-cache' in cc or cc.get('max-age') == '0' or \
+            b'no-cache' in request.get_header(b'pragma', b'')
+        entry = None if bypass else self.cache.lookup(request)
+        if entry is not None and entry.is_fresh():
+            self.update_record(cache='hit')
+            self.serve_from_cache(entry)
+            self.finish_cached_request()
+            return None
+        key = cache_key(request)
+        waiter = None
+        if not bypass and not waited:
+            waiter = lambda: self.worker.event_manager.call_soon_threadsafe(
+                self.on_cache_released)
+        if not self.cache.claim(key, waiter):
+            if waiter is None:
+                return request.raw_head
+            # collapse with the fetch in flight
+            self.client_pending = []
+            self.client.pause_reading()
+            return None
+        self.cache_key = key
+        self.update_record(cache='miss')
+        if entry is not None and entry.has_validator():
+            self.cache_entry = entry
+            return conditional_head(request, entry)
+        return request.raw_head
+
+    def on_cache_released(self):
+        if self.client.is_closed():
+            self.check_closed()
+            return
+        self.cache_waited = True
+        pending, self.client_pending = self.client_pending, None
+        try:
+            self.on_request_head()
+            for data in pending:
+                self.feed_request(data)
+        except HttpParserError as e:
+            self.reply_error(e.status)
+        if self.connector is None and self.client_pending is None:
+            self.client.resume_reading()
+        self.check_closed()
+
+    def serve_from_cache(self, entry: CacheEntry):
+        head, body = self.cache.serve(entry)
+        logger.debug('Serve %s from cache', entry.key)
+        self.update_record(status=int(head[9:12]))
+        if self.capture is not None:
+            self.capture.response_head = bytes(head)
+            self.capture.add_response_body(body)
+        self.pipe_data_to_client(head)
+        if len(body):
+            self.pipe_data_to_client(body)
+
+    def finish_cached_request(self):
+        self.finish_record('complete')
+        if self.request.is_keep_alive():
+            self.request = HttpParser()
+            self.set_deadline('idle')
+            if self.worker.draining:
+                self.drain()
+        else:
+            self.close_client()
+
     def recv_from_upstream(self):
         assert self.upstream
-        data = self.upstream.recv()
-        if data is None:
+        chunks = self.upstream.recv(limit=self.read_limit())
+        if chunks is None:
+            self.set_close_reason('upstream closed')
+            if self.compress_tail is not None:
+                # the response is complete but its last chunks are still
+                # compressed, the client is closed once they are written
+                self.upstream.flush_close()
+                return True
             self.close_upstream()
             # also close the client
             self.close_client()
             return True
-        self.pipe_data_to_client(data)
+        if self.tls_session_key is not None:
+            self.save_tls_session()
+        n = sum(len(data) for data in chunks)
+        self.bytes_down += n
+        self.metrics.inc('upstream_bytes_received', n)
+        self.charge(n)
+        try:
+            for data in chunks:
+                self.feed_response(data)
+        except HttpParserError as e:
+            logger.warning('Invalid response from upstream %s:%d: %s',
+                           self.request.host, self.request.port, e)
+            self.set_close_reason('invalid response: %s' % e)
+            if self.response and not self.response.is_headers_completed():
+                self.reply_error(e.status)
+            else:
+                self.close()
+            return True
         return False
 
+    def feed_response(self, data):
+        while len(data):
+            if self.compress_tail is not None:
+                self.compress_tail.append(data)
+                return
+            if self.response is None:
+                # a tunnel, or an upstream that can't be reused anymore
+                if self.capture_peer is not None:
+                    self.capture_data(1, data)
+                self.pipe_data_to_client(data)
+                return
+            in_head = not self.response.is_headers_completed()
+            n = self.response.parse(data)
+            if self.compress_stream is not None:
+                # the body goes through the parser's on_body
+                self.apply_compress_backpressure()
+            elif not in_head:
+                self.pipe_data_to_client(data[:n])
+                if self.cache_chunks is not None:
+                    self.capture_body(data[:n])
+                if self.capture is not None:
+                    self.capture.add_response_body(data[:n])
+            elif self.response.is_headers_completed():
+                self.on_response_head()
+            data = data[n:]
+            if self.response.is_completed():
+                if self.response.is_interim():
+                    self.new_response()
+                elif self.compress_stream is not None:
+                    # the exchange ends once the last chunk is written
+                    self.compress_tail = [data] if len(data) else []
+                    self.compress_stream.finish()
+                    return
+                else:
+                    self.finish_exchange(extra=len(data) > 0)
+
+    def on_response_head(self):
+        response = self.response
+        if not response.is_interim():
+            self.update_record(status=response.status)
+            if self.capture is not None:
+                # the body of a compressed response isn't captured
+                self.capture.response_head = response.raw_head
+        if self.cache_key is None or response.is_interim():
+            head = response.raw_head
+            if self.compression and not response.is_interim():
+                head = self.maybe_compress(response)
+            self.pipe_data_to_client(head)
+            return
+        entry, self.cache_entry = self.cache_entry, None
+        if entry is not None and response.status == 304:
+            # not modified, the client gets the cached copy instead
+            self.cache.refresh(entry, response)
+            self.update_record(cache='revalidated')
+            self.serve_from_cache(entry)
+            return
+        self.pipe_data_to_client(response.raw_head)
+        expires = self.cache.freshness(self.request, response)
+        if expires is not None and (
+                response.content_length is None or
+                response.content_length <= self.cache.max_object_size):
+            self.cache_chunks = []
+            self.cache_size = 0
+            self.cache_expires = expires
+
+    def maybe_compress(self, response: HttpParser) -> bytes:
+        """Return the head to send, set up the compression if it applies."""
+        encoder = self.compression.choose(self.request, response)
+        if encoder is None:
+            return response.raw_head
+        self.compress_stream = self.compression.stream(
+            encoder, self.worker.event_manager, self.on_compressed)
+        response.on_body = self.compress_stream.feed
+        self.update_record(encoding=encoder.name.decode())
+        return compressed_head(response, encoder.name)
+
+    def on_compressed(self, data: Optional[bytes], final: bool):
+        stream = self.compress_stream
+        if self.client.is_closed() or stream is None:
+            self.check_closed()
+            return
+        if data is None:
+            self.set_close_reason('compression failed')
+            self.close()
+            self.check_closed()
+            return
+        if data:
+            self.pipe_data_to_client(data)
+        if not final:
+            self.release_compress_backpressure()
+            return
+        self.compress_stream = None
+        self.metrics.inc('compressed_bytes_in', stream.bytes_in)
+        self.metrics.inc('compressed_bytes_out', stream.bytes_out)
+        tail, self.compress_tail = self.compress_tail, None
+        upstream_closed = self.upstream.is_closed() or \
+            self.upstream.is_read_closed()
+        self.finish_exchange(extra=len(tail) > 0 or upstream_closed)
+        for data in tail:
+            self.feed_response(data)
+        if upstream_closed:
+            self.close_client()
+        self.check_closed()
+
+    def apply_compress_backpressure(self):
+        stream = self.compress_stream
+        if stream.pending_size >= self.high_watermark and \
+                not self.upstream.read_paused:
+            self.upstream.pause_reading()
+
+    def release_compress_backpressure(self):
+        if self.compress_stream.pending_size <= self.low_watermark:
+            self.release_backpressure(self.client, self.upstream)
+
+    def end_compression(self):
+        if self.compress_stream:
+            self.compress_stream.close()
+            self.compress_stream = None
+        self.compress_tail = None
+
+    def capture_body(self, data):
+        # the body is kept as received, with its transfer encoding
+        self.cache_size += len(data)
+        if self.cache_size > self.cache.max_object_size:
+            self.cache_chunks = None
+        else:
+            self.cache_chunks.append(data)
+
+    def end_cache_fetch(self, completed: bool = False):
+        key, self.cache_key = self.cache_key, None
+        chunks, self.cache_chunks = self.cache_chunks, None
+        self.cache_entry = None
+        if key is None:
+            return
+        if completed and chunks is not None:
+            self.cache.store(self.request, self.response,
+                             self.cache_expires, chunks)
+        self.cache.release(key)
+
+    def new_response(self):
+        self.response = HttpParser(RESPONSE_PARSER)
+        self.response.request_method = self.request.method
+
+    def finish_exchange(self, extra: bool):
+        """Hand the upstream back to the pool once the response is done."""
+        assert self.upstream and self.response
+        self.end_cache_fetch(completed=True)
+        self.finish_record('complete')
+        keep_alive = (
+            not extra
+            and self.request.is_completed()
+            and self.request.is_keep_alive()
+            and self.response.is_keep_alive()
+        )
+        if keep_alive and self.tunnel_host is not None:
+            # the upstream belongs to the tunnel, it isn't pooled
+            self.request = HttpParser(default_port=443)
+        elif (
+            keep_alive
+            and self.upstream_reusable
+            and not self.upstream.has_buffer()
+        ):
+            self.worker.upstream_pool.checkin(
+                self.upstream_key(), self.upstream)
+            self.upstream = None
+            self.request = HttpParser()
+        self.response = None
+        self.upstream_reusable = False
+        if self.worker.draining:
+            self.drain()
+
     def send_to_client(self):
         n = self.client.flush()
-        if self.wrap_client_after_flush:
-            if not self.client.has_buffer():
-                self.client.wrap_socket(self.request.host)
-                self.wrap_client_after_flush = False
+        self.metrics.inc('client_bytes_sent', n)
+        self.release_backpressure(self.client, self.upstream)
+        self.maybe_wrap_client()
+        self.maybe_start_splice()
         return n
 
     def send_to_upstream(self):
         assert self.upstream
-        return self.upstream.flush()
+        n = self.upstream.flush()
+        self.metrics.inc('upstream_bytes_sent', n)
+        self.release_backpressure(self.upstream, self.client)
+        self.maybe_start_splice()
+        return n
 
     def pipe_data_to_client(self, data):
+        self.bytes_to_client += len(data)
         self.client.push_buffer(data)
+        self.apply_backpressure(self.client, self.upstream)
 
     def pipe_data_to_upstream(self, data):
-        assert self.upstream
+        if self.upstream is None:
+            if self.upstream_backlog is None:
+                self.upstream_backlog = []
+            self.upstream_backlog.append(data)
+            return
         self.upstream.push_buffer(data)
+        self.apply_backpressure(self.upstream, self.client)
+
+    def apply_backpressure(self, sink: TcpConnection,
+                           source: Optional[TcpConnection]):
+        """Stop reading from source while sink has too much pending."""
+        if source is None or source.read_paused:
+            return
+        pending = sink.pending_bytes()
+        if pending >= self.high_watermark or (
+                pending > self.low_watermark and
+                self.worker.memory_budget.is_exceeded()):
+            source.pause_reading()
+
+    def release_backpressure(self, sink: TcpConnection,
+                             source: Optional[TcpConnection]):
+        if source is None or not source.read_paused:
+            return
+        if sink.pending_bytes() <= self.low_watermark:
+            source.resume_reading()
+
+    def reply_error(self, status: int):
+        self.update_record(status=status)
+        self.upstream_backlog = None
+        self.pipe_data_to_client(error_response(status))
+        self.close_client()
+        self.close_upstream()
+
+    def update_record(self, **fields):
+        self.recorder.update(**fields)
+
+    def finish_record(self, reason: Optional[str] = None):
+        self.recorder.finish(self.bytes_up, self.bytes_to_client, reason)
+        if self.capture is not None:
+            self.end_capture()
+
+    def upstream_peer(self):
+        try:
+            return self.upstream.sock.getpeername() if self.upstream else None
+        except OSError:
+            return None
+
+    def end_capture(self):
+        exchange, self.capture = self.capture, None
+        event = exchange.event(self.id, self.recorder.client_addr,
+                               self.upstream_peer(), self.request.host,
+                               self.request.port)
+        self.push_capture(event, exchange.size())
+
+    def capture_data(self, direction: int, data):
+        event = DataEvent(self.id, self.recorder.client_addr,
+                          self.capture_peer, self.request.host,
+                          self.request.port, time.time(), direction,
+                          bytes(data))
+        self.push_capture(event, len(data))
+
+    def push_capture(self, event, size: int):
+        if self.worker.capture_ring.push(event, size):
+            self.metrics.inc('capture_events')
+        else:
+            self.metrics.inc('capture_drops')
+
+    def set_close_reason(self, reason: str):
+        self.recorder.set_close_reason(reason)
+
+    def is_idle(self):
+        """Between two requests, with nothing in flight."""
+        return (
+            self.upstream is None
+            and self.connector is None
+            and self.client_pending is None
+            and not self.request.is_started()
+        )
+
+    def drain(self):
+        # a response being written is flushed first
+        if self.is_idle() and not self.client.is_closed():
+            self.set_close_reason('drain')
+            self.close_client()
 
     def close_client(self):
         self.client.flush_close()
 
     def close_upstream(self):
+        self.end_cache_fetch()
+        self.end_compression()
+        if self.connector:
+            self.connector.cancel()
+            self.connector = None
         if self.upstream:
             self.upstream.flush_close()
+
+    def close(self):
+        # drop both sides without flushing, used when a socket errors out
+        self.end_cache_fetch()
+        self.end_compression()
+        if self.connector:
+            self.connector.cancel()
+            self.connector = None
+        if not self.client.is_closed():
+            self.client.close()
+        if self.upstream and not self.upstream.is_closed():
+            self.upstream.close()
+
+    def is_closed(self):
+        return self.client.is_closed() and (
+            self.upstream is None or self.upstream.is_closed())
+
+    def check_closed(self):
+        # for callbacks and timers, the worker checks after socket events
+        if self.is_closed():
+            self.worker.remove_handler(self)
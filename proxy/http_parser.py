@@ -2,51 +2,328 @@
     http_parser.py: parse http request and response
 """
 
-from .constants import CRLF, CONNECT_METHOD, GET_METHOD
+from types import MappingProxyType
+from typing import Callable, Dict, List, Mapping, Optional, Sequence, Tuple
+
+from .constants import (CRLF, CONNECT_METHOD, HEAD_METHOD,
+                        DEFAULT_MAX_HEADER_SIZE)
+
+REQUEST_PARSER = 1
+RESPONSE_PARSER = 2
+
+# parser states
+STATE_HEAD = 1
+STATE_BODY = 2
+STATE_BODY_UNTIL_CLOSE = 3
+STATE_CHUNK_SIZE = 4
+STATE_CHUNK_DATA = 5
+STATE_CHUNK_DATA_END = 6
+STATE_TRAILERS = 7
+STATE_COMPLETE = 8
+
+MAX_CHUNK_SIZE_LINE = 4096
+WHITESPACE = b' \t'
+
+# the headers of a parser until its head is parsed, most parsers of idle
+# keep-alive connections never get one
+NO_HEADERS: Mapping[bytes, bytes] = MappingProxyType({})
+
+
+class HttpParserError(Exception):
+    """A malformed message, ``status`` is the status code to answer."""
+
+    def __init__(self, message: str, status: int = 400):
+        super().__init__(message)
+        self.status = status
+
+
+def split_authority(authority: str, default_port: int) -> Tuple[str, int]:
+    authority = authority.rpartition('@')[2]
+    if authority.startswith('['):
+        host, _, rest = authority[1:].partition(']')
+        port = rest[1:] if rest.startswith(':') else ''
+    elif authority.count(':') == 1:
+        host, _, port = authority.partition(':')
+    else:
+        host, port = authority, ''
+    if not host:
+        raise HttpParserError('missing host')
+    try:
+        return host, int(port) if port else default_port
+    except ValueError:
+        raise HttpParserError('invalid port %r' % port)
 
 
 class HttpParser:
+    """A resumable HTTP/1.x parser.
+
+    ``parse`` only scans the bytes it is given and returns how many of
+    them belong to the current message. It stops at the end of the head,
+    so that the caller can forward ``raw_head`` before the body, and at the
+    end of the message, the rest of the data is the next message.
+
+    The start line and the headers are memoryviews into ``raw_head``,
+    decoded body bytes are passed to ``on_body`` if set.
+    """
+
+    __slots__ = ('type', 'max_header_size', 'default_port', 'state',
+                 'method', 'target', 'version', 'status', 'reason', 'host',
+                 'port', 'request_method', 'raw_head', 'start_line',
+                 'header_list', 'headers', 'content_length', 'chunked',
+                 'body_read', 'on_body', '_buffer', '_remaining', '_line')
 
-    def __init__(self):
-        self.host = None
-        self.port = None
-        self._buffer = b''
-        self.completed = False
+    def __init__(self, parser_type: int = REQUEST_PARSER,
+                 max_header_size: int = DEFAULT_MAX_HEADER_SIZE,
+                 default_port: int = 80):
+        self.type = parser_type
+        self.max_header_size = max_header_size
+        # for origin-form requests, 443 inside an intercepted tunnel
+        self.default_port = default_port
+        self.state = STATE_HEAD
+        self.method: Optional[str] = None
+        self.target: Optional[bytes] = None
+        self.version: Optional[bytes] = None
+        self.status: Optional[int] = None
+        self.reason: Optional[bytes] = None
+        self.host: Optional[str] = None
+        self.port: Optional[int] = None
+        # for responses, the method of the request they answer
+        self.request_method: Optional[str] = None
+        self.raw_head: Optional[bytes] = None
+        self.start_line: Optional[memoryview] = None
+        self.header_list: Sequence[Tuple[memoryview, memoryview]] = ()
+        self.headers: Mapping[bytes, bytes] = NO_HEADERS
+        self.content_length: Optional[int] = None
+        self.chunked = False
+        self.body_read = 0
+        self.on_body: Optional[Callable[[memoryview], None]] = None
+        # a partial head or chunk line, allocated when one is split
+        self._buffer: Optional[bytearray] = None
+        self._remaining = 0
+        self._line: Optional[bytearray] = None
 
-    def parse(self, data: bytes):
+    def parse(self, data) -> int:
+        """Feed data, return the number of bytes consumed."""
+        if not isinstance(data, memoryview):
+            data = memoryview(data)
+        if self.state == STATE_HEAD:
+            return self.parse_head(data)
+        consumed = 0
+        while consumed < len(data) and self.state != STATE_COMPLETE:
+            consumed += self.parse_body(data[consumed:])
+        return consumed
+
+    def parse_head(self, data: memoryview) -> int:
+        if self._buffer is None:
+            self._buffer = bytearray()
+        # only the new bytes, plus 3 for a CRLFCRLF split across reads, are
+        # scanned
+        scan_from = max(len(self._buffer) - 3, 0)
         self._buffer += data
-        if self._buffer.endswith(CRLF * 2):
-            if self._buffer.startswith(CONNECT_METHOD.encode()):
-                a, self._buffer = self._buffer.split(CRLF * 2, 1)
-                t1, t2, t3 = a.split(b' ', 2)
-                host, port = t2.split(b':')
-                self.host, self.port = host.decode(), int(port)
-                self.completed = True
-            elif self._buffer.startswith(GET_METHOD.encode()):
-                ts = self._buffer.split(CRLF)
-                _, path, _ = ts[0].split(b' ')
-                self.port = 80
-                if path.startswith(b'https://'):
-                    self.port = 443
-                    self.host = path.split(b'/')[2].decode()
-                elif path.startswith(b'http://'):
-                    self.host = path.split(b'/')[2].decode()
-                if self.host is None:
-                    for line in ts[1:]:
-                        h, v = line.split(b':')
-                        if h.lower() == b'host':
-                            self.host = v.decode()
-                            break
-                self.completed = True
+        if self.type == REQUEST_PARSER:
+            # robustness, empty lines before the request line are ignored
+            while self._buffer[:2] == CRLF:
+                del self._buffer[:2]
+                scan_from = 0
+        end = self._buffer.find(CRLF * 2, scan_from)
+        if end < 0:
+            if len(self._buffer) > self.max_header_size:
+                raise HttpParserError('header too large', 431)
+            return len(data)
+        end += 4
+        if end > self.max_header_size:
+            raise HttpParserError('header too large', 431)
+        consumed = len(data) - (len(self._buffer) - end)
+        self.raw_head = bytes(self._buffer[:end])
+        self._buffer = None
+        self.process_head()
+        return consumed
+
+    def process_head(self):
+        raw = self.raw_head
+        view = memoryview(raw)
+        end = len(raw) - 4
+        pos = raw.find(CRLF, 0, end)
+        if pos < 0:
+            pos = end
+        self.start_line = view[:pos]
+        self.parse_start_line(raw[:pos])
+        header_list: List[Tuple[memoryview, memoryview]] = []
+        headers: Dict[bytes, bytes] = {}
+        self.header_list = header_list
+        self.headers = headers
+        while pos < end:
+            start = pos + 2
+            pos = raw.find(CRLF, start, end)
+            if pos < 0:
+                pos = end
+            colon = raw.find(b':', start, pos)
+            if colon <= start or raw[colon - 1] in WHITESPACE or \
+                    raw[start] in WHITESPACE:
+                raise HttpParserError('invalid header line')
+            v_start, v_end = colon + 1, pos
+            while v_start < v_end and raw[v_start] in WHITESPACE:
+                v_start += 1
+            while v_end > v_start and raw[v_end - 1] in WHITESPACE:
+                v_end -= 1
+            header_list.append((view[start:colon], view[v_start:v_end]))
+            name = raw[start:colon].lower()
+            value = raw[v_start:v_end]
+            if name in headers:
+                headers[name] += b', ' + value
+            else:
+                headers[name] = value
+        if self.type == REQUEST_PARSER:
+            self.find_host()
+        self.find_body_length()
+
+    def parse_start_line(self, line: bytes):
+        parts = line.split(b' ', 2)
+        if self.type == REQUEST_PARSER:
+            if len(parts) != 3 or not parts[0].isalpha() or \
+                    not parts[2].startswith(b'HTTP/'):
+                raise HttpParserError('invalid request line')
+            self.method = parts[0].decode()
+            self.target = parts[1]
+            self.version = parts[2]
+        else:
+            if len(parts) < 2 or not parts[0].startswith(b'HTTP/') or \
+                    not parts[1].isdigit() or len(parts[1]) != 3:
+                raise HttpParserError('invalid status line', 502)
+            self.version = parts[0]
+            self.status = int(parts[1])
+            self.reason = parts[2] if len(parts) == 3 else b''
+
+    def find_host(self):
+        target = self.target.decode('latin-1')
+        if self.method == CONNECT_METHOD:
+            self.host, self.port = split_authority(target, 443)
+            return
+        scheme, sep, rest = target.partition('://')
+        if sep:
+            default_port = 443 if scheme.lower() == 'https' else 80
+            authority = rest.split('/', 1)[0].split('?', 1)[0]
+            self.host, self.port = split_authority(authority, default_port)
+        elif b'host' in self.headers:
+            self.host, self.port = split_authority(
+                self.headers[b'host'].decode('latin-1'), self.default_port)
+
+    def find_body_length(self):
+        transfer_encoding = self.headers.get(b'transfer-encoding')
+        content_length = self.headers.get(b'content-length')
+        if self.type == RESPONSE_PARSER:
+            if self.status < 200 or self.status in (204, 304) or \
+                    self.request_method == HEAD_METHOD or (
+                        self.request_method == CONNECT_METHOD and
+                        self.status < 300):
+                if self.status == 101:
+                    # switching protocols, the rest is opaque
+                    self.state = STATE_BODY_UNTIL_CLOSE
+                else:
+                    self.state = STATE_COMPLETE
+                return
+        if transfer_encoding is not None:
+            codings = transfer_encoding.lower().split(b',')
+            if codings[-1].strip() == b'chunked':
+                self.chunked = True
+                self.state = STATE_CHUNK_SIZE
+            elif self.type == REQUEST_PARSER:
+                raise HttpParserError('unsupported transfer encoding')
+            else:
+                self.state = STATE_BODY_UNTIL_CLOSE
+            return
+        if content_length is not None:
+            values = {v.strip() for v in content_length.split(b',')}
+            if len(values) != 1 or not next(iter(values)).isdigit():
+                raise HttpParserError(
+                    'invalid content length',
+                    400 if self.type == REQUEST_PARSER else 502)
+            self.content_length = int(values.pop())
+            self._remaining = self.content_length
+            self.state = STATE_BODY if self._remaining else STATE_COMPLETE
+        elif self.type == REQUEST_PARSER:
+            self.state = STATE_COMPLETE
+        else:
+            self.state = STATE_BODY_UNTIL_CLOSE
+
+    def emit_body(self, data: memoryview):
+        self.body_read += len(data)
+        if self.on_body:
+            self.on_body(data)
+
+    def parse_body(self, data: memoryview) -> int:
+        if self.state == STATE_BODY_UNTIL_CLOSE:
+            self.emit_body(data)
+            return len(data)
+        if self.state in (STATE_BODY, STATE_CHUNK_DATA):
+            n = min(self._remaining, len(data))
+            self.emit_body(data[:n])
+            self._remaining -= n
+            if self._remaining == 0:
+                if self.state == STATE_BODY:
+                    self.state = STATE_COMPLETE
+                else:
+                    self.state = STATE_CHUNK_DATA_END
+                    self._remaining = 2
+            return n
+        if self.state == STATE_CHUNK_DATA_END:
+            n = min(self._remaining, len(data))
+            if data[:n] != CRLF[2 - self._remaining:2 - self._remaining + n]:
+                raise HttpParserError('invalid chunk end')
+            self._remaining -= n
+            if self._remaining == 0:
+                self.state = STATE_CHUNK_SIZE
+            return n
+        # chunk size and trailer lines
+        end = bytes(data[:MAX_CHUNK_SIZE_LINE]).find(b'\n')
+        n = len(data) if end < 0 else end + 1
+        if self._line is None:
+            self._line = bytearray()
+        self._line += data[:n]
+        if len(self._line) > max(MAX_CHUNK_SIZE_LINE, self.max_header_size):
+            raise HttpParserError('chunk line too long')
+        if end < 0:
+            return n
+        line = bytes(self._line).rstrip(b'\r\n')
+        self._line = None
+        if self.state == STATE_CHUNK_SIZE:
+            size = line.split(b';', 1)[0].strip()
+            try:
+                self._remaining = int(size, 16)
+            except ValueError:
+                raise HttpParserError('invalid chunk size')
+            self.state = STATE_CHUNK_DATA if self._remaining \
+                else STATE_TRAILERS
+        elif not line:
+            self.state = STATE_COMPLETE
+        return n
+
+    def get_header(self, name: bytes,
+                   default: Optional[bytes] = None) -> Optional[bytes]:
+        return self.headers.get(name.lower(), default)
+
+    def is_keep_alive(self):
+        connection = self.headers.get(b'connection', b'').lower()
+        if self.version == b'HTTP/1.1':
+            return b'close' not in connection
+        return b'keep-alive' in connection
+
+    def is_interim(self):
+        # 1xx responses other than 101 are followed by the final one
+        return self.status is not None and self.status < 200 and \
+            self.status != 101
+
+    def is_connect(self):
+        return self.method == CONNECT_METHOD
 
     def has_host(self):
         return self.host is not None and self.port is not None
 
-    def is_completed(self):
-        return self.completed
+    def is_started(self):
+        return self.state != STATE_HEAD or bool(self._buffer)
 
-    def has_buffer(self):
-        return len(self._buffer) > 0
+    def is_headers_completed(self):
+        return self.state != STATE_HEAD
 
-    def get_buffer(self):
-        return self._buffer
+    def is_completed(self):
+        return self.state == STATE_COMPLETE
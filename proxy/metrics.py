@@ -0,0 +1,238 @@
+"""
+    metrics.py: counters and histograms exported in Prometheus text format
+"""
+
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Tuple
+from urllib.parse import parse_qs
+import logging
+import math
+import socket
+import threading
+
+from .constants import DEFAULT_PROFILE_SECONDS, MAX_PROFILE_SECONDS
+from .profiler import ProfilerBusy, profiler
+from . import watchdog
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1.0, 2.5, 5.0, 10.0)
+LOOP_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                0.025, 0.05, 0.1, 0.25, 1.0)
+
+COUNTERS = (
+    ('client_bytes_received', 'Bytes received from clients.'),
+    ('client_bytes_sent', 'Bytes sent to clients.'),
+    ('upstream_bytes_received', 'Bytes received from upstreams.'),
+    ('upstream_bytes_sent', 'Bytes sent to upstreams.'),
+    ('handlers', 'Client connections handled.'),
+    ('upstream_connects', 'Upstream connections established.'),
+    ('upstream_connect_errors', 'Upstream connections that failed.'),
+    ('upstream_reuses', 'Requests sent on a pooled upstream connection.'),
+    ('cert_cache_hits', 'Server TLS contexts found in the cache.'),
+    ('cert_cache_misses', 'Server TLS contexts that had to be minted.'),
+    ('tls_client_resumptions', 'Client TLS sessions resumed.'),
+    ('tls_client_full_handshakes', 'Client TLS handshakes not resumed.'),
+    ('tls_session_hits', 'Upstream TLS sessions resumed from the cache, '
+     'selector engine only.'),
+    ('tls_session_misses', 'Upstream TLS handshakes not resumed, selector '
+     'engine only.'),
+    ('compressed_bytes_in', 'Response bytes compressed by the proxy.'),
+    ('compressed_bytes_out', 'Bytes the proxy compressed them into.'),
+    ('rule_denials', 'Requests denied by the rules.'),
+    ('rule_routes', 'Requests routed to a local address by the rules.'),
+    ('loop_lags', 'Loop iterations longer than the lag threshold.'),
+    ('capture_events', 'Exchanges and tunnel reads queued for capture.'),
+    ('capture_drops', 'Captures dropped, the capture buffer being full.'),
+)
+
+HISTOGRAMS = (
+    ('upstream_connect_seconds', 'Time to connect to an upstream.',
+     LATENCY_BUCKETS),
+    ('tls_handshake_seconds', 'Time to complete a TLS handshake.',
+     LATENCY_BUCKETS),
+    ('loop_iteration_seconds',
+     'Time spent handling the events of one loop iteration.', LOOP_BUCKETS),
+)
+
+GAUGES = (
+    ('active_handlers', 'Client connections being handled.'),
+    ('pending_bytes', 'Bytes buffered for sending.'),
+)
+
+
+class Histogram:
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        # the last slot is for the values above the largest bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class WorkerMetrics:
+    """The metrics of a worker.
+
+    Only the worker thread updates them, so there is no lock, readers
+    may see an update half done, which is fine for monitoring. Gauges
+    are callables evaluated when the metrics are collected.
+    """
+
+    def __init__(self, gauges: Dict[str, Callable[[], float]]):
+        self.counters = {name: 0 for name, _ in COUNTERS}
+        self.histograms = {name: Histogram(buckets)
+                           for name, _, buckets in HISTOGRAMS}
+        self.gauges = gauges
+
+    def inc(self, name: str, value: int = 1):
+        self.counters[name] += value
+
+    def observe(self, name: str, value: float):
+        self.histograms[name].observe(value)
+
+
+class MetricsRegistry:
+
+    def __init__(self, prefix: str = 'proxy'):
+        self.prefix = prefix
+        self.workers: List[WorkerMetrics] = []
+        self.lock = threading.Lock()
+
+    def add(self, metrics: WorkerMetrics):
+        with self.lock:
+            self.workers.append(metrics)
+
+    def collect(self) -> str:
+        """Sum the metrics of every worker, in Prometheus text format."""
+        with self.lock:
+            workers = list(self.workers)
+        lines = []
+        for name, text in COUNTERS:
+            full_name = '%s_%s_total' % (self.prefix, name)
+            value = sum(m.counters[name] for m in workers)
+            lines += ['# HELP %s %s' % (full_name, text),
+                      '# TYPE %s counter' % full_name,
+                      '%s %d' % (full_name, value)]
+        for name, text in GAUGES:
+            full_name = '%s_%s' % (self.prefix, name)
+            value = sum(m.gauges[name]() for m in workers)
+            lines += ['# HELP %s %s' % (full_name, text),
+                      '# TYPE %s gauge' % full_name,
+                      '%s %s' % (full_name, value)]
+        for name, text, buckets in HISTOGRAMS:
+            full_name = '%s_%s' % (self.prefix, name)
+            counts = [0] * (len(buckets) + 1)
+            total = 0.0
+            for m in workers:
+                histogram = m.histograms[name]
+                counts = [a + b for a, b in zip(counts, histogram.counts)]
+                total += histogram.sum
+            lines += ['# HELP %s %s' % (full_name, text),
+                      '# TYPE %s histogram' % full_name]
+            cumulative = 0
+            for bound, count in zip(buckets, counts):
+                cumulative += count
+                lines.append('%s_bucket{le="%s"} %d' % (
+                    full_name, bound, cumulative))
+            cumulative += counts[-1]
+            lines += ['%s_bucket{le="+Inf"} %d' % (full_name, cumulative),
+                      '%s_sum %f' % (full_name, total),
+                      '%s_count %d' % (full_name, cumulative)]
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+
+class MetricsServer:
+    """Serve ``/metrics`` on a local port, from a background thread.
+
+    Two debug paths come along: ``/debug/profile?seconds=N`` samples the
+    process for N seconds, at most ``MAX_PROFILE_SECONDS``, and answers
+    with the collapsed stacks, and ``/debug/lag`` lists the last slow loop
+    iterations as JSON lines.
+    """
+
+    def __init__(self, addr: str, port: int,
+                 metrics_registry: MetricsRegistry = registry,
+                 reuse_port: bool = False):
+        self.addr = addr
+        self.port = port
+        self.reuse_port = reuse_port
+        self.registry = metrics_registry
+        self.server = None
+
+    def start(self):
+        metrics_registry = self.registry
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                path, _, query = self.path.partition('?')
+                if path == '/metrics':
+                    self.reply(metrics_registry.collect(),
+                               'text/plain; version=0.0.4')
+                elif path == '/debug/profile':
+                    try:
+                        seconds = float(parse_qs(query).get(
+                            'seconds', [DEFAULT_PROFILE_SECONDS])[0])
+                    except ValueError:
+                        self.send_error(400)
+                        return
+                    if not math.isfinite(seconds) or seconds <= 0:
+                        self.send_error(400, 'seconds must be positive')
+                        return
+                    try:
+                        stacks = profiler.profile(
+                            min(seconds, MAX_PROFILE_SECONDS))
+                    except ProfilerBusy as e:
+                        self.send_error(409, str(e))
+                        return
+                    self.reply(stacks, 'text/plain')
+                elif path == '/debug/lag':
+                    self.reply(watchdog.format_records(),
+                               'application/x-ndjson')
+                else:
+                    self.send_error(404)
+
+            def reply(self, text: str, content_type: str):
+                body = text.encode()
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        family = socket.AF_INET6 if ':' in self.addr else socket.AF_INET
+        reuse_port = self.reuse_port
+
+        class Server(ThreadingHTTPServer):
+            address_family = family
+            daemon_threads = True
+
+            def server_bind(self):
+                if reuse_port:
+                    self.socket.setsockopt(socket.SOL_SOCKET,
+                                           socket.SO_REUSEPORT, 1)
+                super().server_bind()
+
+        self.server = Server((self.addr, self.port), Handler)
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  name='metrics', daemon=True)
+        thread.start()
+        logger.info('Serve metrics at http://%s:%d/metrics',
+                    self.addr, self.port)
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
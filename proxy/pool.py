@@ -0,0 +1,95 @@
+"""
+    pool.py: idle keep-alive upstream connections
+"""
+
+from collections import deque
+from typing import Dict, Deque, Optional, Tuple
+import logging
+import socket
+
+from .connection import TcpConnection
+
+logger = logging.getLogger(__name__)
+
+PoolKey = Tuple[str, int, Optional[str]]
+
+
+class UpstreamPool:
+    """Idle upstream connections of a worker, keyed by (host, port) and
+    the local address they are connected from, None for the default.
+
+    At most ``max_idle`` connections are kept per key, each for at most
+    ``idle_timeout`` seconds. Idle connections are not registered with the
+    selector, a connection closed by the origin in the meantime is caught
+    by the health check on checkout.
+    """
+
+    def __init__(self, event_manager, max_idle: int, idle_timeout: float):
+        self.event_manager = event_manager
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.idle: Dict[PoolKey, Deque] = {}
+
+    def checkout(self, key: PoolKey) -> Optional[TcpConnection]:
+        conns = self.idle.get(key)
+        while conns:
+            # the most recently used one is the most likely to be alive
+            conn, timer = conns.pop()
+            timer.cancel()
+            if self.is_healthy(conn):
+                if not conns:
+                    del self.idle[key]
+                logger.debug('Reuse upstream %s:%d, fd %d',
+                             key[0], key[1], conn.fileno())
+                return conn
+            conn.close()
+        self.idle.pop(key, None)
+        return None
+
+    def checkin(self, key: PoolKey, conn: TcpConnection):
+        if self.max_idle <= 0:
+            conn.close()
+            return
+        if conn.event_manager:
+            conn.event_manager.unregister(conn)
+        conn.read_paused = False
+        conn.read_throttled = False
+        conns = self.idle.setdefault(key, deque())
+        if len(conns) >= self.max_idle:
+            oldest, timer = conns.popleft()
+            timer.cancel()
+            oldest.close()
+        timer = self.event_manager.call_later(
+            self.idle_timeout, self.expire, key, conn)
+        conns.append((conn, timer))
+
+    def expire(self, key: PoolKey, conn: TcpConnection):
+        conns = self.idle.get(key)
+        if not conns:
+            return
+        for item in conns:
+            if item[0] is conn:
+                conns.remove(item)
+                break
+        if not conns:
+            del self.idle[key]
+        conn.close()
+
+    @staticmethod
+    def is_healthy(conn: TcpConnection):
+        # an idle connection must have nothing to read: no EOF, no error
+        # and no unsolicited bytes
+        try:
+            conn.sock.recv(1, socket.MSG_PEEK)
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+        return False
+
+    def close(self):
+        for conns in self.idle.values():
+            for conn, timer in conns:
+                timer.cancel()
+                conn.close()
+        self.idle.clear()
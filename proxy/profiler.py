@@ -0,0 +1,107 @@
+"""
+    profiler.py: a sampling profiler writing collapsed stacks
+"""
+
+from collections import Counter
+from typing import Dict, Optional
+import logging
+import os
+import sys
+import threading
+import time
+
+from .constants import PROFILE_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+
+class ProfilerBusy(Exception):
+    pass
+
+
+def code_label(code) -> str:
+    filename = '/'.join(code.co_filename.split(os.sep)[-2:])
+    return '%s (%s)' % (getattr(code, 'co_qualname', code.co_name), filename)
+
+
+def collapse_stack(frame, labels: Optional[Dict] = None) -> str:
+    """The frames from the outermost, separated by semicolons."""
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        if labels is None:
+            stack.append(code_label(code))
+        else:
+            label = labels.get(code)
+            if label is None:
+                label = labels[code] = code_label(code)
+            stack.append(label)
+        frame = frame.f_back
+    return ';'.join(reversed(stack))
+
+
+class SamplingProfiler:
+    """Sample the stacks of every thread, for a while, on demand.
+
+    The result is in the collapsed stacks format, a line per distinct
+    stack, ``thread;outer;...;inner count``, which flamegraph.pl, inferno
+    and speedscope read. Nothing runs between profiles, and while one
+    runs the cost is a copy of the stacks every PROFILE_INTERVAL.
+    """
+
+    def __init__(self, interval: float = PROFILE_INTERVAL):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.running = False
+        # the labels of the code objects seen, reused across samples
+        self.labels: Dict = {}
+
+    def profile(self, seconds: float) -> str:
+        """Sample from the calling thread for ``seconds``."""
+        with self.lock:
+            if self.running:
+                raise ProfilerBusy('a profile is already running')
+            self.running = True
+        try:
+            counts: Counter = Counter()
+            me = threading.get_ident()
+            deadline = time.monotonic() + seconds
+            while time.monotonic() < deadline:
+                names = {t.ident: t.name for t in threading.enumerate()}
+                for ident, frame in sys._current_frames().items():
+                    if ident == me:
+                        continue
+                    stack = collapse_stack(frame, self.labels)
+                    counts['%s;%s' % (names.get(ident, ident), stack)] += 1
+                time.sleep(self.interval)
+        finally:
+            with self.lock:
+                self.running = False
+        return ''.join('%s %d\n' % item for item in counts.most_common())
+
+    def start(self, seconds: float, directory: str) -> bool:
+        """Profile in the background, then write the stacks to a file of
+        ``directory``. False if a profile is already running."""
+        if self.running:
+            return False
+        path = os.path.join(directory, 'profile-%d-%s.folded' % (
+            os.getpid(), time.strftime('%Y%m%d-%H%M%S')))
+        thread = threading.Thread(target=self.write_profile,
+                                  args=(seconds, path), name='profiler',
+                                  daemon=True)
+        thread.start()
+        return True
+
+    def write_profile(self, seconds: float, path: str):
+        logger.info('Profile for %g seconds', seconds)
+        try:
+            stacks = self.profile(seconds)
+            with open(path, 'w') as f:
+                f.write(stacks)
+        except (OSError, ProfilerBusy) as e:
+            logger.error('Cannot profile: %s', e)
+            return
+        logger.info('Wrote the profile to %s', path)
+
+
+profiler = SamplingProfiler()
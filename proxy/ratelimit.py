@@ -0,0 +1,45 @@
+"""
+    ratelimit.py: token buckets to cap the rate of a client
+"""
+
+import time
+
+from .constants import RATE_LIMIT_RESUME
+
+
+class TokenBucket:
+    """``rate`` tokens a second, at most ``burst`` of them saved up.
+
+    A token is a byte. Reads are cut to the tokens available, so the
+    bucket only runs dry, it never goes into debt by more than a read.
+    """
+
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp')
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+
+    def available(self) -> int:
+        now = time.monotonic()
+        self.tokens = min(self.tokens + (now - self.stamp) * self.rate,
+                          self.burst)
+        self.stamp = now
+        return int(self.tokens)
+
+    def consume(self, n: int):
+        self.tokens -= n
+
+    def is_empty(self):
+        return self.tokens < 1
+
+    def resume_delay(self) -> float:
+        """Seconds until reading is worth it again.
+
+        Waiting for a fraction of a second of tokens, instead of a single
+        one, keeps a throttled client from waking the loop for each byte.
+        """
+        target = min(self.rate * RATE_LIMIT_RESUME, self.burst)
+        return max(target - self.tokens, 0) / self.rate
@@ -0,0 +1,121 @@
+"""
+    resolver.py: cached name resolution off the event loop
+"""
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional, Tuple
+import ipaddress
+import logging
+import socket
+import threading
+import time
+
+from .constants import (DEFAULT_DNS_CACHE_SIZE, DEFAULT_DNS_TTL,
+                        DEFAULT_DNS_NEGATIVE_TTL, DEFAULT_DNS_WORKERS)
+
+logger = logging.getLogger(__name__)
+
+
+def with_port(addrinfos, port):
+    result = []
+    for family, type_, proto, canonname, sockaddr in addrinfos:
+        sockaddr = (sockaddr[0], port) + tuple(sockaddr[2:])
+        result.append((family, type_, proto, canonname, sockaddr))
+    return result
+
+
+class Resolver:
+    """Resolve host names on a thread pool.
+
+    Answers are cached for ``ttl`` seconds, failures for ``negative_ttl``
+    seconds, and the cache holds at most ``max_size`` names, least recently
+    used first out. The system resolver does not expose the record TTLs,
+    so ``ttl`` is an upper bound chosen by the operator. Concurrent
+    lookups of the same name share a single getaddrinfo call.
+
+    ``getaddrinfo`` can be replaced, e.g. by a local stand-in.
+    """
+
+    def __init__(self, max_size: int = DEFAULT_DNS_CACHE_SIZE,
+                 ttl: float = DEFAULT_DNS_TTL,
+                 negative_ttl: float = DEFAULT_DNS_NEGATIVE_TTL,
+                 max_workers: int = DEFAULT_DNS_WORKERS,
+                 getaddrinfo: Callable = socket.getaddrinfo):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.getaddrinfo = getaddrinfo
+        # host -> (expires, addrinfos, error)
+        self.cache: OrderedDict = OrderedDict()
+        # host -> callbacks waiting for the lookup in flight
+        self.pending: dict = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers,
+                                           thread_name_prefix='resolver')
+
+    def resolve(self, host: str, port: int,
+                callback: Callable) -> Optional[Tuple]:
+        """Return ``(addrinfos, error)`` if the answer is known.
+
+        Otherwise return None and call ``callback((addrinfos, error))``
+        from a pool thread once the lookup is done.
+        """
+        try:
+            ipaddress.ip_address(host)
+        except ValueError:
+            pass
+        else:
+            # literal addresses never hit the pool
+            return self.lookup(host, port)
+        with self.lock:
+            entry = self.cache.get(host)
+            if entry is not None:
+                expires, addrinfos, error = entry
+                if expires > time.monotonic():
+                    self.cache.move_to_end(host)
+                    if error is not None:
+                        return None, error
+                    return with_port(addrinfos, port), None
+                del self.cache[host]
+            callbacks = self.pending.get(host)
+            if callbacks is not None:
+                callbacks.append((port, callback))
+                return None
+            self.pending[host] = [(port, callback)]
+        self.executor.submit(self.run_lookup, host)
+        return None
+
+    def lookup(self, host: str, port: int):
+        try:
+            return self.getaddrinfo(host, port,
+                                    type=socket.SOCK_STREAM), None
+        except Exception as e:
+            # gaierror mostly, but a label over 63 characters raises
+            # UnicodeError, and a stand-in may raise anything
+            return None, e
+
+    def run_lookup(self, host: str):
+        addrinfos, error = None, None
+        try:
+            addrinfos, error = self.lookup(host, 0)
+            ttl = self.ttl if error is None else self.negative_ttl
+            with self.lock:
+                self.cache[host] = (time.monotonic() + ttl, addrinfos, error)
+                self.cache.move_to_end(host)
+                while len(self.cache) > self.max_size:
+                    self.cache.popitem(last=False)
+        except Exception as e:
+            error = e
+        finally:
+            # the waiters are answered whatever happened, a name left in
+            # pending would hold every later lookup of it
+            with self.lock:
+                callbacks = self.pending.pop(host, [])
+        if error is not None:
+            logger.debug('Cannot resolve %s: %r', host, error)
+        for port, callback in callbacks:
+            if error is not None:
+                callback((None, error))
+            else:
+                callback((with_port(addrinfos, port), None))
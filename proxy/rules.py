@@ -0,0 +1,410 @@
+"""
+    rules.py: allow, deny and route decisions per host
+
+    python -m proxy.rules compile rules.txt rules.bin
+    python -m proxy.rules lookup rules.bin example.com [...]
+
+The text format has one rule per line, ``#`` starts a comment:
+
+    deny ads.example.com        the host only
+    deny .tracker.example       the domain and its subdomains
+    deny *.cdn.example          the subdomains only
+    deny 198.51.100.0/24        hosts given as an address in the network
+    allow www.tracker.example
+    route .corp.example 192.0.2.10      connect from this local address
+    default deny                allow when missing
+
+The most specific rule wins: for a name the exact rule of the host, then
+the rule of its closest parent domain, for an address the longest prefix.
+CIDR rules don't apply to the addresses names resolve to.
+
+The compiled form is a reversed-label trie in flat arrays, each node has
+an open addressing table of its children, so a lookup reads a few bytes
+per label. It is loaded with mmap, the worker processes of the prefork
+mode share its pages, and compiling a text file to it is the way to use
+large lists. Only compiled files are reloaded when they change, a text
+file is compiled once, at start.
+"""
+
+from typing import Dict, List, Optional, Tuple
+import argparse
+import bisect
+import ipaddress
+import logging
+import mmap
+import os
+import struct
+import sys
+import threading
+import zlib
+
+logger = logging.getLogger(__name__)
+
+ALLOW = 1
+DENY = 2
+ROUTE = 3
+
+MAGIC = b'PXRULES1'
+# magic, default, then the count and the offset of each section: nodes,
+# child slots, labels, routes, IPv4 and IPv6 networks
+HEADER = struct.Struct('<8sI12I')
+# label offset, children slot offset, children table size, value of the
+# host itself, value of its subdomains, label length
+NODE = struct.Struct('<IIIHHB')
+SLOT = struct.Struct('<I')
+CIDR4 = struct.Struct('<4sBH')
+CIDR6 = struct.Struct('<16sBH')
+
+ACTIONS = {'allow': ALLOW, 'deny': DENY, 'route': ROUTE}
+# the values of the routes follow ROUTE in the 16 bits of a node's fields
+MAX_ROUTES = 0xffff - ROUTE + 1
+
+
+class RulesError(ValueError):
+    pass
+
+
+class _Node:
+    __slots__ = ('children', 'exact', 'sub')
+
+    def __init__(self):
+        self.children: Optional[Dict[bytes, '_Node']] = None
+        self.exact = 0
+        self.sub = 0
+
+
+def _table_size(count: int) -> int:
+    # a power of two at most half full
+    size = 2
+    while size < count * 2:
+        size *= 2
+    return size
+
+
+def compile_rules(lines) -> bytes:
+    """Compile the rules of the text format to their binary form."""
+    root = _Node()
+    routes: List[str] = []
+    route_values: Dict[str, int] = {}
+    networks: Dict[Tuple[int, bytes, int], int] = {}
+    default = ALLOW
+    for number, line in enumerate(lines, 1):
+        words = line.split('#', 1)[0].split()
+        if not words:
+            continue
+        try:
+            if words[0] == 'default':
+                if len(words) != 2 or words[1] not in ('allow', 'deny'):
+                    raise RulesError('expected default allow|deny')
+                default = ACTIONS[words[1]]
+                continue
+            action = ACTIONS.get(words[0])
+            if action is None:
+                raise RulesError('unknown action %r' % words[0])
+            if len(words) != (3 if action == ROUTE else 2):
+                raise RulesError('wrong number of fields')
+            value = action
+            if action == ROUTE:
+                address = str(ipaddress.ip_address(words[2]))
+                if address not in route_values:
+                    if len(routes) == MAX_ROUTES:
+                        raise RulesError('more than %d route addresses' %
+                                         MAX_ROUTES)
+                    route_values[address] = ROUTE + len(routes)
+                    routes.append(address)
+                value = route_values[address]
+            pattern = words[1].lower().rstrip('.')
+            network = None
+            if pattern[-1:].isdigit() or ':' in pattern:
+                try:
+                    network = ipaddress.ip_network(pattern, strict=False)
+                except ValueError:
+                    pass
+            if network is not None:
+                key = (network.version, network.network_address.packed,
+                       network.prefixlen)
+                networks[key] = value
+                continue
+            subdomains_only = pattern.startswith('*.')
+            with_subdomains = pattern.startswith('.')
+            name = pattern[2:] if subdomains_only else \
+                pattern[1:] if with_subdomains else pattern
+            try:
+                labels = name.encode('ascii').split(b'.') if name else []
+            except UnicodeError:
+                labels = name.encode('idna').split(b'.')
+            if not labels or not all(labels) or \
+                    any(len(label) > 63 for label in labels):
+                raise RulesError('invalid host %r' % words[1])
+            node = root
+            for label in reversed(labels):
+                if node.children is None:
+                    node.children = {}
+                child = node.children.get(label)
+                if child is None:
+                    child = node.children[label] = _Node()
+                node = child
+            if not subdomains_only:
+                node.exact = value
+            if subdomains_only or with_subdomains:
+                node.sub = value
+        except (RulesError, UnicodeError, ValueError) as e:
+            raise RulesError('line %d: %s' % (number, e)) from None
+
+    # breadth first, the root is node 0 and 0 marks an empty slot
+    nodes = [(root, b'')]
+    i = 0
+    while i < len(nodes):
+        node = nodes[i][0]
+        if node.children:
+            nodes.extend((child, label)
+                         for label, child in node.children.items())
+        i += 1
+    index = {id(node): n for n, (node, _) in enumerate(nodes)}
+
+    label_blob = bytearray()
+    label_offsets: Dict[bytes, int] = {}
+    node_blob = bytearray(NODE.size * len(nodes))
+    slots: List[int] = []
+    for n, (node, label) in enumerate(nodes):
+        offset = label_offsets.get(label)
+        if offset is None:
+            offset = label_offsets[label] = len(label_blob)
+            label_blob += label
+        table_offset = len(slots)
+        size = 0
+        if node.children:
+            size = _table_size(len(node.children))
+            table = [0] * size
+            mask = size - 1
+            for child_label, child in node.children.items():
+                slot = zlib.crc32(child_label) & mask
+                while table[slot]:
+                    slot = (slot + 1) & mask
+                table[slot] = index[id(child)]
+            slots += table
+        NODE.pack_into(node_blob, NODE.size * n, offset, table_offset, size,
+                       node.exact, node.sub, len(label))
+
+    route_blob = '\n'.join(routes).encode()
+    cidr_blobs = []
+    for version, entry in ((4, CIDR4), (6, CIDR6)):
+        # longest prefixes first, each prefix sorted for a binary search
+        keys = sorted((k for k in networks if k[0] == version),
+                      key=lambda k: (-k[2], k[1]))
+        cidr_blobs.append((len(keys), b''.join(
+            entry.pack(k[1], k[2], networks[k]) for k in keys)))
+
+    sections = [
+        (len(nodes), bytes(node_blob)),
+        (len(slots), struct.pack('<%dI' % len(slots), *slots)),
+        (len(label_blob), bytes(label_blob)),
+        (len(routes), route_blob),
+    ] + cidr_blobs
+    header = [MAGIC, default]
+    body = bytearray()
+    for count, blob in sections:
+        header += [count, HEADER.size + len(body)]
+        body += blob
+    return HEADER.pack(*header) + bytes(body)
+
+
+class RuleSet:
+    """Compiled rules, read in place from a buffer, usually an mmap."""
+
+    def __init__(self, buf):
+        if len(buf) < HEADER.size or buf[:len(MAGIC)] != MAGIC:
+            raise RulesError('not a compiled rules file')
+        fields = HEADER.unpack_from(buf)
+        self.buf = buf
+        self.default = fields[1]
+        (self.node_count, self.nodes_offset, _, self.slots_offset,
+         _, self.labels_offset, route_count, routes_offset,
+         cidr4_count, cidr4_offset, cidr6_count, cidr6_offset) = fields[2:]
+        self.routes = bytes(
+            buf[routes_offset:cidr4_offset]).decode().split('\n') \
+            if route_count else []
+        self.networks = {
+            4: self._prefix_groups(CIDR4, cidr4_offset, cidr4_count),
+            6: self._prefix_groups(CIDR6, cidr6_offset, cidr6_count),
+        }
+
+    def _prefix_groups(self, entry: struct.Struct, offset: int, count: int):
+        """The networks of each prefix length, longest first, as lists of
+        (network, value) sorted for bisect."""
+        groups: List[Tuple[int, List[bytes], List[int]]] = []
+        for network, prefix, value in entry.iter_unpack(
+                self.buf[offset:offset + entry.size * count]):
+            if not groups or groups[-1][0] != prefix:
+                groups.append((prefix, [], []))
+            groups[-1][1].append(network)
+            groups[-1][2].append(value)
+        return groups
+
+    def decide(self, host: str) -> Tuple[int, Optional[str]]:
+        """Return the action for ``host`` and the local address to
+        connect from, for ROUTE."""
+        value = self.lookup(host) or self.default
+        if value >= ROUTE:
+            return ROUTE, self.routes[value - ROUTE]
+        return value, None
+
+    def lookup(self, host: str) -> int:
+        host = host.lower().rstrip('.')
+        # names don't end with a digit, addresses without colons do
+        if host and (host[-1].isdigit() or ':' in host):
+            try:
+                return self.lookup_address(ipaddress.ip_address(host))
+            except ValueError:
+                pass
+        return self.lookup_name(host.encode('latin-1', 'replace'))
+
+    def lookup_name(self, name: bytes) -> int:
+        buf = self.buf
+        node_at = self.nodes_offset
+        slot_at = self.slots_offset
+        label_at = self.labels_offset
+        _, table, size, exact, sub, _ = NODE.unpack_from(buf, node_at)
+        best = 0
+        for label in reversed(name.split(b'.')):
+            # the host is below this node
+            if sub:
+                best = sub
+            if not size:
+                return best
+            mask = size - 1
+            slot = zlib.crc32(label) & mask
+            while True:
+                child = SLOT.unpack_from(buf, slot_at + 4 * (table + slot))[0]
+                if not child:
+                    return best
+                offset, child_table, child_size, exact, sub, length = \
+                    NODE.unpack_from(buf, node_at + NODE.size * child)
+                if length == len(label) and \
+                        buf[label_at + offset:label_at + offset + length] \
+                        == label:
+                    break
+                slot = (slot + 1) & mask
+            table, size = child_table, child_size
+        return exact or best
+
+    def lookup_address(self, address) -> int:
+        packed = address.packed
+        bits = len(packed) * 8
+        number = int.from_bytes(packed, 'big')
+        for prefix, networks, values in self.networks[address.version]:
+            masked = (number >> (bits - prefix) << (bits - prefix)) \
+                if prefix else 0
+            network = masked.to_bytes(len(packed), 'big')
+            i = bisect.bisect_left(networks, network)
+            if i < len(networks) and networks[i] == network:
+                return values[i]
+        return 0
+
+
+def load(path: str, compiled_only: bool = False) -> RuleSet:
+    """Map a compiled rules file, or compile a text one."""
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) == MAGIC:
+            return RuleSet(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        if compiled_only:
+            raise RulesError('not a compiled rules file, compile it with '
+                             'python -m proxy.rules compile')
+        f.seek(0)
+        return RuleSet(compile_rules(
+            line.decode('utf-8') for line in f))
+
+
+def file_stamp(path: str):
+    st = os.stat(path)
+    return st.st_ino, st.st_size, st.st_mtime_ns
+
+
+class Rules:
+    """The rules of ``path``, reloaded when the file changes.
+
+    A thread checks the file every ``interval`` seconds, and swaps in
+    the new rules once they are loaded, the loops keep deciding with the
+    old ones meanwhile. A file that fails to load is logged and the old
+    rules are kept. Replace the file with a rename for the change to be
+    atomic, as the compile command does.
+
+    Only a compiled file is reloaded: compiling holds the GIL, for
+    seconds with a large list, and the loops of the process would stall
+    meanwhile.
+    """
+
+    def __init__(self, path: str, interval: float):
+        self.path = path
+        self.interval = interval
+        self.stamp = file_stamp(path)
+        self.rules = load(path)
+        self.stopped = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    def decide(self, host: str) -> Tuple[int, Optional[str]]:
+        return self.rules.decide(host)
+
+    def start(self):
+        if self.interval > 0:
+            self.thread = threading.Thread(target=self.watch, daemon=True,
+                                           name='rules')
+            self.thread.start()
+
+    def watch(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                stamp = file_stamp(self.path)
+                if stamp == self.stamp:
+                    continue
+                self.stamp = stamp
+                # a mapping in use stays valid, the old one is unmapped
+                # once the last reference to it is dropped
+                self.rules = load(self.path, compiled_only=True)
+                logger.info('Reloaded the rules from %s', self.path)
+            except (OSError, RulesError) as e:
+                logger.error('Cannot reload the rules from %s: %s',
+                             self.path, e)
+
+    def stop(self):
+        self.stopped.set()
+
+
+def compile_file(source: str, output: str):
+    with open(source, encoding='utf-8') as f:
+        data = compile_rules(f)
+    tmp = '%s.%d.tmp' % (output, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, output)
+    return data
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    commands = parser.add_subparsers(dest='command', required=True)
+    command = commands.add_parser('compile', help='compile a text file')
+    command.add_argument('source')
+    command.add_argument('output')
+    command = commands.add_parser('lookup', help='decide for hosts')
+    command.add_argument('rules')
+    command.add_argument('hosts', nargs='+')
+    args = parser.parse_args(argv)
+    try:
+        if args.command == 'compile':
+            data = compile_file(args.source, args.output)
+            rules = RuleSet(data)
+            print('%d nodes, %d bytes' % (rules.node_count, len(data)))
+        else:
+            rules = load(args.rules)
+            names = {ALLOW: 'allow', DENY: 'deny', ROUTE: 'route'}
+            for host in args.hosts:
+                action, egress = rules.decide(host)
+                print(host, names[action], egress or '')
+    except (OSError, RulesError) as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
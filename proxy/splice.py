@@ -0,0 +1,82 @@
+"""
+    splice.py: move tunnel bytes between sockets inside the kernel
+"""
+
+import errno
+import fcntl
+import os
+
+# a pipe this large lets a single splice carry several TCP windows, the
+# kernel caps it at /proc/sys/fs/pipe-max-size
+PIPE_SIZE = 1024 * 1024
+
+# splice returns these when one of the descriptors does not support it
+UNSUPPORTED_ERRORS = (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP)
+
+
+def is_available():
+    return hasattr(os, 'splice') and hasattr(os, 'pipe2')
+
+
+class SpliceChannel:
+    """One direction of a tunnel: ``source`` -> pipe -> ``sink``.
+
+    The bytes never enter userspace. ``pending`` counts the bytes sitting
+    in the pipe, ``total`` every byte read from the source.
+    """
+
+    def __init__(self, source, sink):
+        self.source = source
+        self.sink = sink
+        self.read_fd, self.write_fd = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+        try:
+            self.capacity = fcntl.fcntl(
+                self.write_fd, fcntl.F_SETPIPE_SZ, PIPE_SIZE)
+        except OSError:
+            self.capacity = fcntl.fcntl(self.write_fd, fcntl.F_GETPIPE_SZ)
+        self.flags = os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK
+        self.pending = 0
+        self.total = 0
+        # the source reached end of file, and the sink was shut down
+        self.eof = False
+        self.shutdown = False
+        self.closed = False
+
+    def fill(self) -> int:
+        """Move bytes from the source into the pipe, -1 at end of file."""
+        if self.is_full():
+            return 0
+        try:
+            n = os.splice(self.source.fileno(), self.write_fd,
+                          self.capacity - self.pending, flags=self.flags)
+        except BlockingIOError:
+            return 0
+        if n == 0:
+            self.eof = True
+            return -1
+        self.pending += n
+        self.total += n
+        return n
+
+    def drain(self) -> int:
+        if not self.pending:
+            return 0
+        try:
+            n = os.splice(self.read_fd, self.sink.fileno(), self.pending,
+                          flags=self.flags)
+        except BlockingIOError:
+            return 0
+        self.pending -= n
+        return n
+
+    def is_full(self):
+        return self.pending >= self.capacity
+
+    def is_done(self):
+        return self.eof and not self.pending
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            os.close(self.read_fd)
+            os.close(self.write_fd)
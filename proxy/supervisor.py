@@ -0,0 +1,240 @@
+"""
+    supervisor.py: run the proxy in several worker processes
+"""
+
+from typing import Callable, Dict, List, Optional
+import logging
+import os
+import select
+import signal
+import struct
+import time
+
+from .constants import WORKER_RESTART_DELAY
+
+logger = logging.getLogger(__name__)
+
+# in a worker process, the pipe to tell the supervisor it listens
+ready_fd: Optional[int] = None
+
+
+def notify_ready():
+    """Tell the supervisor, if any, that this process accepts clients."""
+    if ready_fd is not None:
+        os.write(ready_fd, struct.pack('i', os.getpid()))
+
+
+def describe_status(status: int) -> str:
+    if os.WIFSIGNALED(status):
+        return 'signal %s' % signal.Signals(os.WTERMSIG(status)).name
+    return 'code %d' % os.waitstatus_to_exitcode(status)
+
+
+class WorkerProcess:
+
+    def __init__(self, slot: int, pid: int):
+        self.slot = slot
+        self.pid = pid
+        self.started = time.monotonic()
+        self.ready = False
+        self.draining = False
+
+
+class Supervisor:
+    """Fork ``workers`` processes that each serve the port on their own.
+
+    ``serve(slot)`` runs in each worker. It binds its own listener with
+    SO_REUSEPORT, so the kernel spreads the connections across the
+    workers, and calls ``notify_ready`` once it accepts them. The
+    supervisor itself only handles signals:
+
+    - SIGHUP reloads: a new worker is started for each slot, and the one
+      it replaces gets SIGQUIT once the new one is ready;
+    - SIGQUIT stops gracefully, the workers stop accepting and finish
+      their connections;
+    - SIGINT and SIGTERM stop the workers now;
+    - SIGUSR2 is passed on, each worker writes a profile.
+
+    A worker that exits on its own is restarted, after a delay if it
+    didn't live for that long.
+    """
+
+    SIGNALS = (signal.SIGCHLD, signal.SIGHUP, signal.SIGQUIT,
+               signal.SIGINT, signal.SIGTERM, signal.SIGUSR2)
+
+    def __init__(self, workers: int, serve: Callable[[int], None]):
+        self.workers = workers
+        self.serve = serve
+        self.processes: Dict[int, WorkerProcess] = {}
+        # the newest process of each slot
+        self.current: Dict[int, WorkerProcess] = {}
+        # slot -> when to start it again
+        self.restarts: Dict[int, float] = {}
+        self.signals: List[int] = []
+        self.stopping = False
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        self.ready_r, self.ready_w = os.pipe()
+        for fd in (self.wakeup_r, self.wakeup_w, self.ready_r):
+            os.set_blocking(fd, False)
+
+    def on_signal(self, signum, frame):
+        self.signals.append(signum)
+
+    def spawn(self, slot: int):
+        pid = os.fork()
+        if pid == 0:
+            self.run_worker(slot)
+        process = WorkerProcess(slot, pid)
+        self.processes[pid] = process
+        self.current[slot] = process
+        logger.info('Start worker %d, pid %d', slot, pid)
+
+    def run_worker(self, slot: int):
+        global ready_fd
+        code = 0
+        try:
+            signal.set_wakeup_fd(-1)
+            for signum in self.SIGNALS:
+                signal.signal(signum, signal.SIG_DFL)
+            # the terminal's ^C and the supervisor's stop both raise
+            # KeyboardInterrupt, as in the single process mode
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            signal.signal(signal.SIGTERM, signal.default_int_handler)
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            # until the server handles it
+            signal.signal(signal.SIGUSR2, signal.SIG_IGN)
+            for fd in (self.wakeup_r, self.wakeup_w, self.ready_r):
+                os.close(fd)
+            ready_fd = self.ready_w
+            self.serve(slot)
+        except KeyboardInterrupt:
+            pass
+        except BaseException:
+            logger.exception('Worker %d failed', slot)
+            code = 1
+        finally:
+            os._exit(code)
+
+    def run(self):
+        for signum in self.SIGNALS:
+            signal.signal(signum, self.on_signal)
+        signal.set_wakeup_fd(self.wakeup_w)
+        for slot in range(self.workers):
+            self.spawn(slot)
+        while self.processes or (self.restarts and not self.stopping):
+            timeout = None
+            if self.restarts:
+                timeout = max(min(self.restarts.values()) - time.monotonic(),
+                              0)
+            readable, _, _ = select.select(
+                [self.wakeup_r, self.ready_r], [], [], timeout)
+            if self.wakeup_r in readable:
+                self.read_all(self.wakeup_r)
+            if self.ready_r in readable:
+                data = self.read_all(self.ready_r)
+                for (pid,) in struct.iter_unpack('i', data):
+                    self.on_ready(pid)
+            signals, self.signals = self.signals, []
+            for signum in signals:
+                self.handle_signal(signum)
+            self.restart_due()
+        logger.info('All workers stopped')
+
+    @staticmethod
+    def read_all(fd: int) -> bytes:
+        chunks = []
+        try:
+            while True:
+                data = os.read(fd, 4096)
+                if not data:
+                    break
+                chunks.append(data)
+        except BlockingIOError:
+            pass
+        return b''.join(chunks)
+
+    def handle_signal(self, signum: int):
+        if signum == signal.SIGCHLD:
+            self.reap()
+        elif signum == signal.SIGHUP:
+            if not self.stopping:
+                self.reload()
+        elif signum == signal.SIGQUIT:
+            self.stop(signal.SIGQUIT)
+        elif signum == signal.SIGUSR2:
+            for process in list(self.current.values()):
+                self.kill(process, signal.SIGUSR2)
+        else:
+            self.stop(signal.SIGTERM)
+
+    def reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            process = self.processes.pop(pid, None)
+            if process is None:
+                continue
+            if self.current.get(process.slot) is not process:
+                logger.info('Worker %d, pid %d, stopped', process.slot, pid)
+                continue
+            del self.current[process.slot]
+            if self.stopping:
+                logger.info('Worker %d, pid %d, stopped', process.slot, pid)
+                continue
+            logger.warning('Worker %d, pid %d, exited with %s',
+                           process.slot, pid, describe_status(status))
+            delay = 0.0
+            if time.monotonic() - process.started < WORKER_RESTART_DELAY:
+                # don't spin on a worker that can't start
+                delay = WORKER_RESTART_DELAY
+            self.restarts[process.slot] = time.monotonic() + delay
+
+    def restart_due(self):
+        if self.stopping:
+            self.restarts.clear()
+            return
+        now = time.monotonic()
+        for slot, when in list(self.restarts.items()):
+            if when <= now:
+                del self.restarts[slot]
+                self.spawn(slot)
+
+    def on_ready(self, pid: int):
+        process = self.processes.get(pid)
+        if process is None or self.current.get(process.slot) is not process:
+            return
+        process.ready = True
+        # the processes it replaces stop accepting and drain
+        for old in list(self.processes.values()):
+            if old.slot == process.slot and old is not process and \
+                    not old.draining:
+                self.kill(old, signal.SIGQUIT)
+                old.draining = True
+
+    def reload(self):
+        logger.info('Reload %d workers', self.workers)
+        self.restarts.clear()
+        for slot in range(self.workers):
+            self.spawn(slot)
+
+    def stop(self, signum: int):
+        if signum == signal.SIGQUIT:
+            logger.info('Stop gracefully')
+        else:
+            logger.info('Stop')
+        self.stopping = True
+        for process in list(self.processes.values()):
+            if signum == signal.SIGQUIT and process.draining:
+                continue
+            self.kill(process, signum)
+            process.draining = True
+
+    def kill(self, process: WorkerProcess, signum: int):
+        try:
+            os.kill(process.pid, signum)
+        except ProcessLookupError:
+            pass
@@ -2,67 +2,250 @@
     tcp_server.py: A basic tcp server.
 """
 
-from typing import Optional
+from typing import Dict, List, Optional
 import logging
+import os
+import signal
 import socket
 import selectors
-from collections import deque
 import threading
 
 from .connection import TcpConnection
 from .worker import Worker
+from .resolver import Resolver
+from .cache import HttpCache
+from .compress import Compression
+from .rules import Rules
+from .capture import Capture
+from .profiler import profiler
+from .watchdog import LagWatchdog
+from .metrics import MetricsServer
+from .access_log import AccessLog
+from .supervisor import notify_ready
+from .flag import flags
+from .constants import ACCEPT_BATCH_SIZE
 
 
 logger = logging.getLogger(__name__)
 
 
 class TcpServer:
+    """Accept clients and hand them to the worker thread.
 
-    def __init__(self, addr, port):
+    ``slot`` is the index of the worker process in the prefork mode, the
+    listener is then bound with SO_REUSEPORT, and the per-process
+    resources, the metrics port and the disk cache, are offset by it.
+
+    SIGQUIT stops accepting, the worker finishes the connections in
+    flight for up to ``--drain-timeout`` seconds before the server exits.
+    SIGUSR2 profiles the process for ``--profile-seconds``.
+    """
+
+    def __init__(self, addr, port, slot: Optional[int] = None):
         self.addr = addr
         self.port = port
-        self.work_queue = deque()
-        self.lock = threading.Lock()
-        self.local_worker = Worker(self.work_queue, self.lock)
-        self.local_thread: Optional[threading.Thread] = None
+        self.slot = slot
+        self.resolver = Resolver(
+            max_size=flags.args.dns_cache_size,
+            ttl=flags.args.dns_ttl,
+            negative_ttl=flags.args.dns_negative_ttl,
+            max_workers=flags.args.dns_workers)
+        self.cache: Optional[HttpCache] = None
+        if flags.args.cache:
+            cache_dir = flags.args.cache_dir
+            if cache_dir and slot is not None:
+                # the disk index isn't shared between processes
+                cache_dir = os.path.join(cache_dir, str(slot))
+            self.cache = HttpCache(
+                flags.args.cache_memory_size,
+                flags.args.cache_max_object_size,
+                cache_dir, flags.args.cache_disk_size)
+        self.access_log: Optional[AccessLog] = None
+        if flags.args.access_log:
+            self.access_log = AccessLog(flags.args.access_log)
+        self.compression: Optional[Compression] = None
+        if flags.args.compress:
+            self.compression = Compression(
+                flags.args.compress_min_size,
+                [t.strip().lower().encode()
+                 for t in flags.args.compress_types.split(',') if t.strip()],
+                flags.args.compress_threads)
+        self.rules: Optional[Rules] = None
+        if flags.args.rules:
+            self.rules = Rules(flags.args.rules,
+                               flags.args.rules_reload_interval)
+        self.capture: Optional[Capture] = None
+        if flags.args.capture_dir:
+            self.capture = Capture(
+                flags.args.capture_dir, flags.args.capture_format,
+                [h for h in flags.args.capture_hosts.split(',') if h.strip()],
+                flags.args.capture_sample, flags.args.capture_file_size,
+                flags.args.capture_files)
+        # the memory budget is split, each worker accounts for its own
+        threads = max(flags.args.threads, 1)
+        self.workers = [
+            Worker(self.resolver, self.cache, self.access_log,
+                   flags.args.memory_budget // threads, self.compression,
+                   self.rules, self.capture)
+            for _ in range(threads)]
+        self.worker_threads: List[threading.Thread] = []
+        self.watchdog: Optional[LagWatchdog] = None
+        if flags.args.lag_threshold > 0:
+            self.watchdog = LagWatchdog(self.workers,
+                                        flags.args.lag_threshold)
+        self.metrics_server: Optional[MetricsServer] = None
         self.selector = selectors.DefaultSelector()
+        # signals only set a flag, the waker makes select return
+        self.waker_r, self.waker_w = socket.socketpair()
+        self.waker_r.setblocking(False)
+        self.waker_w.setblocking(False)
+        self.selector.register(self.waker_r, selectors.EVENT_READ,
+                               data='waker')
+        self.draining = False
+        self.profile_requested = False
         self.setup()
 
     def setup(self):
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        family = socket.AF_INET6 if ':' in self.addr else socket.AF_INET
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.slot is not None:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.sock.bind((self.addr, self.port))
-        self.sock.listen()
+        # bursts queue in the kernel rather than being dropped
+        self.sock.listen(socket.SOMAXCONN)
         self.sock.setblocking(False)
         self.selector.register(self.sock, selectors.EVENT_READ, data=None)
         logger.info('Start server at %s, port %d', self.addr, self.port)
 
-    def accept_new_client(self):
-        sock, addr = self.sock.accept()
-        logger.info('Accept new connection %s, fileno %d', addr, sock.fileno())
-        sock.setblocking(False)
-        conn = TcpConnection(sock, addr)
-        with self.lock:
-            self.work_queue.append(conn)
+    def pick_worker(self, batch: Dict[Worker, List]) -> Worker:
+        if len(self.workers) == 1:
+            return self.workers[0]
+        return min(self.workers,
+                   key=lambda w: w.load() + len(batch.get(w, ())))
+
+    def accept_new_clients(self) -> int:
+        """Accept what the backlog holds, up to ACCEPT_BATCH_SIZE clients.
+
+        Each worker gets its share in one handoff, and is woken up once.
+        """
+        batch: Dict[Worker, List] = {}
+        accepted = 0
+        while accepted < ACCEPT_BATCH_SIZE:
+            try:
+                sock, addr = self.sock.accept()
+            except BlockingIOError:
+                break
+            except OSError as e:
+                # e.g. EMFILE, the client stays in the backlog
+                logger.warning('Cannot accept a connection: %s', e)
+                break
+            accepted += 1
+            logger.debug('Accept new connection %s, fileno %d',
+                         addr, sock.fileno())
+            sock.setblocking(False)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conn = TcpConnection(sock, addr)
+            batch.setdefault(self.pick_worker(batch), []).append(conn)
+        for worker, conns in batch.items():
+            worker.add_works(conns)
+        return accepted
+
+    def start_workers(self):
+        for i, worker in enumerate(self.workers):
+            thread = threading.Thread(target=worker.run_forever,
+                                      name='worker-%d' % i)
+            thread.daemon = True
+            thread.start()
+            self.worker_threads.append(thread)
 
-    def start_local_worker(self):
-        self.local_thread = threading.Thread(
-            target=self.local_worker.run_forever)
-        self.local_thread.daemon = True
-        self.local_thread.start()
+    def on_drain_signal(self, signum, frame):
+        self.draining = True
+
+    def on_profile_signal(self, signum, frame):
+        self.profile_requested = True
+
+    def install_signal_handlers(self):
+        if threading.current_thread() is not threading.main_thread():
+            # embedded in another program, which owns the signals
+            return
+        signal.set_wakeup_fd(self.waker_w.fileno())
+        signal.signal(signal.SIGQUIT, self.on_drain_signal)
+        signal.signal(signal.SIGUSR2, self.on_profile_signal)
+
+    def close_listener(self):
+        if self.sock.fileno() < 0:
+            return
+        self.selector.unregister(self.sock)
+        self.sock.close()
+
+    def drain(self):
+        logger.info('Stop accepting, drain %d handlers',
+                    sum(len(worker.handlers) for worker in self.workers))
+        # what the kernel already queued would be reset by the close
+        while self.accept_new_clients():
+            pass
+        self.close_listener()
+        if self.metrics_server:
+            self.metrics_server.stop()
+        for worker in self.workers:
+            worker.event_manager.call_soon_threadsafe(
+                worker.drain, flags.args.drain_timeout)
+        for thread in self.worker_threads:
+            thread.join()
 
     def run_forever(self):
         try:
-            while True:
+            while not self.draining:
                 events = self.selector.select()
                 for key, _ in events:
                     if key.data is None:
-                        self.accept_new_client()
+                        self.accept_new_clients()
+                    else:
+                        try:
+                            while self.waker_r.recv(4096):
+                                pass
+                        except BlockingIOError:
+                            pass
+                if self.profile_requested:
+                    self.profile_requested = False
+                    profiler.start(flags.args.profile_seconds,
+                                   flags.args.profile_dir)
+            self.drain()
         except KeyboardInterrupt:
             pass
         finally:
-            self.selector.unregister(self.sock)
-            self.sock.close()
+            self.close_listener()
+            if self.compression:
+                self.compression.close()
+            if self.rules:
+                self.rules.stop()
+            if self.watchdog:
+                self.watchdog.stop()
+            if self.capture:
+                self.capture.close()
+            if self.access_log:
+                self.access_log.close()
 
     def run(self):
-        self.start_local_worker()
+        metrics_port = flags.args.metrics_port
+        if metrics_port:
+            if self.slot is not None:
+                metrics_port += self.slot
+            # reuse_port, a reloaded worker binds while the old one drains
+            self.metrics_server = MetricsServer(
+                flags.args.metrics_host, metrics_port,
+                reuse_port=self.slot is not None)
+            self.metrics_server.start()
+        if self.access_log:
+            self.access_log.start()
+        if self.rules:
+            self.rules.start()
+        if self.watchdog:
+            self.watchdog.start()
+        if self.capture:
+            self.capture.start()
+        self.install_signal_handlers()
+        self.start_workers()
+        notify_ready()
         self.run_forever()
@@ -0,0 +1,136 @@
+"""
+    timer.py: hashed timer wheel
+"""
+
+from typing import Callable, Dict, List, Optional
+import heapq
+import math
+import time
+
+from .constants import TIMER_RESOLUTION, TIMER_WHEEL_SIZE
+
+# stale heap entries tolerated before a rebuild, with few armed ticks
+HEAP_SLACK = 64
+
+
+class Timer:
+
+    __slots__ = ('wheel', 'deadline', 'callback', 'args', 'tick', 'cancelled')
+
+    def __init__(self, wheel: 'TimerWheel', deadline: float,
+                 callback: Callable, args):
+        self.wheel = wheel
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.tick = 0
+        self.cancelled = False
+
+    def cancel(self):
+        if not self.cancelled:
+            self.cancelled = True
+            self.wheel.remove(self)
+
+    def reset(self, delay: float):
+        """Move the deadline to ``delay`` seconds from now."""
+        if not self.cancelled:
+            self.wheel.remove(self)
+            self.deadline = time.monotonic() + delay
+            self.wheel.add(self)
+
+
+class TimerWheel:
+    """A hashed timer wheel (Varghese & Lauck).
+
+    Time is cut in ticks of ``resolution`` seconds, a timer goes into the
+    slot of its deadline tick modulo ``size``. Arming, resetting and
+    cancelling are O(1). Each slot is a dict, so a removal does not scan.
+    Expiring costs one slot per elapsed tick. Timers more than one lap
+    away wait in their slot until their own tick comes. The time to the
+    next deadline comes from a heap of the armed ticks, an entry is left
+    in the heap when its last timer goes and dropped once it's on top, or
+    when the heap is rebuilt: it never holds more than twice the armed
+    ticks, plus HEAP_SLACK.
+
+    Timers fire at most one ``resolution`` late, never early.
+    """
+
+    def __init__(self, resolution: float = TIMER_RESOLUTION,
+                 size: int = TIMER_WHEEL_SIZE):
+        self.resolution = resolution
+        self.size = size
+        self.slots: List[Dict[Timer, None]] = [{} for _ in range(size)]
+        self.count = 0
+        # the number of timers of each armed tick, and a heap of them
+        self.ticks: Dict[int, int] = {}
+        self.heap: List[int] = []
+        # every tick before this one has been expired
+        self.current = self.to_tick(time.monotonic())
+
+    def to_tick(self, deadline: float) -> int:
+        return math.ceil(deadline / self.resolution)
+
+    def call_later(self, delay: float, callback: Callable, *args) -> Timer:
+        timer = Timer(self, time.monotonic() + delay, callback, args)
+        self.add(timer)
+        return timer
+
+    def add(self, timer: Timer):
+        # a deadline in the past fires on the next expire
+        timer.tick = max(self.to_tick(timer.deadline), self.current)
+        self.slots[timer.tick % self.size][timer] = None
+        self.count += 1
+        count = self.ticks.get(timer.tick)
+        if count is None:
+            self.ticks[timer.tick] = 1
+            heapq.heappush(self.heap, timer.tick)
+        else:
+            self.ticks[timer.tick] = count + 1
+
+    def remove(self, timer: Timer):
+        if self.slots[timer.tick % self.size].pop(timer, 0) is None:
+            self.count -= 1
+            self.forget(timer.tick)
+
+    def forget(self, tick: int):
+        count = self.ticks[tick] - 1
+        if count:
+            self.ticks[tick] = count
+            return
+        del self.ticks[tick]
+        # timers re-armed over and over leave their old ticks behind
+        if len(self.heap) > 2 * len(self.ticks) + HEAP_SLACK:
+            self.heap = list(self.ticks)
+            heapq.heapify(self.heap)
+
+    def expire(self, now: Optional[float] = None):
+        """Run the callbacks of the timers due at ``now``."""
+        now = time.monotonic() if now is None else now
+        last = int(now / self.resolution)
+        # after a long sleep, every slot is visited once
+        first = max(self.current, last - self.size + 1)
+        due = []
+        for tick in range(first, last + 1):
+            slot = self.slots[tick % self.size]
+            if slot:
+                for timer in [t for t in slot if t.tick <= last]:
+                    del slot[timer]
+                    self.forget(timer.tick)
+                    due.append(timer)
+        self.current = last + 1
+        self.count -= len(due)
+        due.sort(key=lambda t: t.deadline)
+        for timer in due:
+            if not timer.cancelled:
+                timer.cancelled = True
+                timer.callback(*timer.args)
+
+    def timeout(self, now: Optional[float] = None) -> Optional[float]:
+        """Seconds until the next tick with a timer, None if there's none."""
+        heap = self.heap
+        while heap and heap[0] not in self.ticks:
+            heapq.heappop(heap)
+        if not heap:
+            return None
+        now = time.monotonic() if now is None else now
+        return max(heap[0] * self.resolution - now, 0)
@@ -0,0 +1,71 @@
+"""
+    tls.py: the upstream TLS context and sessions, shared by the connections
+"""
+
+from collections import OrderedDict
+from typing import Optional, Tuple
+import logging
+import ssl
+import threading
+
+from .constants import DEFAULT_TLS_SESSION_CACHE_SIZE
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_client_context: Optional[ssl.SSLContext] = None
+
+
+def client_context() -> ssl.SSLContext:
+    """The context of the upstream connections, created once per process.
+
+    Loading the trust store is the costly part of a context, and sessions
+    can only be resumed with the context they were made with.
+    """
+    global _client_context
+    if _client_context is None:
+        with _lock:
+            if _client_context is None:
+                _client_context = ssl.create_default_context()
+    return _client_context
+
+
+class SessionCache:
+    """The last TLS session of each upstream (host, port), to resume it.
+
+    A TLS 1.3 session can only be resumed once the server has sent its
+    ticket, after the handshake, see ``is_resumable``. Shared by the
+    worker threads, the least recently used sessions are evicted.
+    """
+
+    def __init__(self, size: int = DEFAULT_TLS_SESSION_CACHE_SIZE):
+        self.size = size
+        self.lock = threading.Lock()
+        self.sessions: OrderedDict = OrderedDict()
+
+    def get(self, key: Tuple[str, int]) -> Optional[ssl.SSLSession]:
+        with self.lock:
+            session = self.sessions.get(key)
+            if session is not None:
+                self.sessions.move_to_end(key)
+            return session
+
+    def put(self, key: Tuple[str, int], session: ssl.SSLSession):
+        if self.size <= 0:
+            return
+        with self.lock:
+            self.sessions[key] = session
+            self.sessions.move_to_end(key)
+            while len(self.sessions) > self.size:
+                self.sessions.popitem(last=False)
+
+    @staticmethod
+    def is_resumable(sock: ssl.SSLSocket) -> bool:
+        session = sock.session
+        if session is None:
+            return False
+        # TLS 1.2 resumes by session id, TLS 1.3 only with a ticket
+        return session.has_ticket or sock.version() != 'TLSv1.3'
+
+
+sessions = SessionCache()
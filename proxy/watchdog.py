@@ -0,0 +1,83 @@
+"""
+    watchdog.py: catch the loop iterations that take too long
+"""
+
+from collections import deque
+from typing import List
+import json
+import logging
+import sys
+import threading
+import time
+
+from .constants import LAG_RECORDS
+from .profiler import collapse_stack
+
+logger = logging.getLogger(__name__)
+
+# what a handler may block the loop in, the innermost one is reported
+OPERATIONS = frozenset((
+    'recv', 'flush', 'wrap_socket', 'do_handshake', 'connect_upstream',
+    'lookup_cache', 'serve_from_cache', 'check_rules', 'splice_from',
+    'splice_to', 'feed_request', 'feed_response', 'close',
+))
+
+# the last slow iterations of the process, served at /debug/lag
+records: deque = deque(maxlen=LAG_RECORDS)
+
+
+def find_operation(frame) -> str:
+    innermost = frame.f_code.co_name if frame is not None else 'unknown'
+    while frame is not None:
+        if frame.f_code.co_name in OPERATIONS:
+            return frame.f_code.co_name
+        frame = frame.f_back
+    return innermost
+
+
+class LagWatchdog:
+    """Look at the workers' stacks while an iteration runs too long.
+
+    A worker marks when select returns, before the callbacks and the
+    timers run, and the handler it is on while handling events. The
+    watchdog thread checks every quarter of ``threshold`` and leaves a
+    sample on a worker stuck in an iteration for longer, the worker
+    reports it once the iteration is over, see ``Worker.report_lag``.
+    The workers pay an attribute store per event, and nothing is sampled
+    while the loops keep up.
+    """
+
+    def __init__(self, workers: List, threshold: float):
+        self.workers = workers
+        self.threshold = threshold
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.watch, name='watchdog',
+                                       daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def watch(self):
+        while not self.stopped.wait(self.threshold / 4):
+            now = time.monotonic()
+            for worker in self.workers:
+                started = worker.iteration_started
+                if not started or now - started < self.threshold:
+                    continue
+                sample = worker.lag_sample
+                if sample is not None and sample[0] == started:
+                    continue
+                frame = sys._current_frames().get(worker.thread_ident)
+                handler = worker.current_handler
+                worker.lag_sample = (
+                    started, handler.id if handler else None,
+                    find_operation(frame), collapse_stack(frame))
+                # the frames reference locals of the worker thread
+                del frame
+
+    def stop(self):
+        self.stopped.set()
+
+
+def format_records() -> str:
+    return ''.join(json.dumps(record) + '\n' for record in list(records))
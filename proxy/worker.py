@@ -3,127 +3,194 @@
 """
 
 from collections import deque
+from typing import List, Optional
 import threading
 import logging
 import ssl
+import time
 
 from .connection import TcpConnection
 from .events import EventManager
+from .buffer import MemoryBudget
+from .resolver import Resolver
+from .pool import UpstreamPool
+from .cache import HttpCache
+from .compress import Compression
+from .rules import Rules
+from .capture import Capture
+from .access_log import AccessLog
+from .metrics import WorkerMetrics, registry
+from .flag import flags
 from .constants import EVENT_READ, EVENT_WRITE
 from .http_handler import HttpProxyHandler
+from . import watchdog
 
 logger = logging.getLogger(__name__)
 
 
 class Worker:
-    def __init__(self, work_queue: deque, lock: threading.Lock):
-        self.work_queue = work_queue
+    def __init__(self, resolver: Resolver, cache: Optional[HttpCache] = None,
+                 access_log: Optional[AccessLog] = None,
+                 memory_budget: Optional[int] = None,
+                 compression: Optional[Compression] = None,
+                 rules: Optional[Rules] = None,
+                 capture: Optional[Capture] = None):
+        # accepted connections, handed over by the acceptor thread
+        self.work_queue = deque()
+        self.lock = threading.Lock()
+        self.resolver = resolver
+        self.cache = cache
+        self.access_log = access_log
+        self.compression = compression
+        self.rules = rules
+        self.capture = capture
+        self.capture_ring = None
+        if capture is not None:
+            self.capture_ring = capture.ring(
+                flags.args.capture_buffer_size // max(flags.args.threads, 1))
         self.event_manager = EventManager()
         self.handlers = {}
-        self.lock = lock
+        # bytes a connection may read in a turn, then the others' turn
+        self.read_budget = flags.args.read_budget
+        # shared by the handlers, by what they wait on
+        self.timeouts = {
+            'header': flags.args.header_timeout,
+            'idle': flags.args.idle_timeout,
+            'handshake': flags.args.handshake_timeout,
+        }
+        if memory_budget is None:
+            memory_budget = flags.args.memory_budget
+        self.memory_budget = MemoryBudget(memory_budget)
+        self.upstream_pool = UpstreamPool(
+            self.event_manager, flags.args.pool_max_idle,
+            flags.args.pool_idle_timeout)
+        self.metrics = WorkerMetrics({
+            'active_handlers': lambda: len(self.handlers),
+            'pending_bytes': lambda: self.memory_budget.used,
+        })
+        registry.add(self.metrics)
+        self.draining = False
+        # read by the lag watchdog: when the current iteration started,
+        # 0 between iterations, the handler it is on, and the stack the
+        # watchdog caught it in
+        self.lag_threshold = flags.args.lag_threshold
+        self.thread_ident = None
+        self.iteration_started = 0.0
+        self.current_handler: Optional[HttpProxyHandler] = None
+        self.lag_sample = None
+
+    def add_works(self, conns: List[TcpConnection]):
+        """Queue connections from another thread, and wake the loop."""
+        with self.lock:
+            self.work_queue.extend(conns)
+        self.event_manager.wakeup()
+
+    def load(self) -> int:
+        # read from the acceptor thread, an estimate is enough
+        return len(self.handlers) + len(self.work_queue)
 
     def check_for_new_works(self):
+        if not self.work_queue:
+            return
+        # the loop may have slept through several accepts
         with self.lock:
-            if len(self.work_queue) <= 0:
-                return
-            conn: TcpConnection = self.work_queue.popleft()
-            handler = None
-            if conn.tag == "client":
-                handler = HttpProxyHandler(conn, self.work_queue, self.lock)
-                self.handlers[handler.id] = handler
-            elif conn.tag == "upstream":
-                handler = self.handlers.get(conn.handler_id)
-            logger.info('Receive a new %s work, fileno %d',
-                        conn.tag, conn.fileno())
-            if handler:
-                self.event_manager.set_event(conn, EVENT_READ, data=handler)
+            works = list(self.work_queue)
+            self.work_queue.clear()
+        for conn in works:
+            handler = HttpProxyHandler(conn, self)
+            self.handlers[handler.id] = handler
+            self.metrics.inc('handlers')
+            logger.debug('Receive a new %s work, fileno %d',
+                         conn.tag, conn.fileno())
+            self.event_manager.register(conn, handler)
 
-    def clear_works(self):
-        hids = []
-        for handler in self.handlers.values():
-            handler: HttpProxyHandler
-            if handler.client.is_closed() and \
-                    handler.client.selected_event != 0:
-                self.event_manager.unregister(handler.client)
-            if (
-                handler.upstream
-                and handler.upstream.is_closed()
-                and handler.upstream.selected_event != 0
-            ):
-                self.event_manager.unregister(handler.upstream)
-            if (
-                handler.client.is_closed()
-                and handler.upstream
-                and handler.upstream.is_closed()
-            ):
-                hids.append(handler.id)
-        for hid in hids:
-            self.handlers.pop(hid)
-            logger.info('Delete handler %s', hid)
+    def remove_handler(self, handler: HttpProxyHandler):
+        if self.handlers.pop(handler.id, None):
+            handler.cancel_deadline()
+            handler.finish_record()
+            logger.debug('Delete handler %s, %d bytes up, %d bytes down',
+                         handler.id, handler.bytes_up, handler.bytes_down)
 
-    def get_events(self):
-        events = []
-        for handler in self.handlers.values():
-            if not handler.client.is_closed():
-                event = 0 if handler.client.is_read_closed() else EVENT_READ
-                if handler.client.has_buffer():
-                    event |= EVENT_WRITE
-                events.append((handler.client, event, handler))
-            if handler.upstream and not handler.upstream.is_closed():
-                event = 0 if handler.upstream.is_read_closed() else EVENT_READ
-                if handler.upstream.has_buffer():
-                    event |= EVENT_WRITE
-                events.append((handler.upstream, event, handler))
-        return events
+    def close_handlers(self, reason: str):
+        for handler in list(self.handlers.values()):
+            handler.set_close_reason(reason)
+            handler.close()
+            self.remove_handler(handler)
 
-    def update_events(self, events):
-        for conn, event, handler in events:
-            self.event_manager.set_event(conn, event, handler)
+    def drain(self, timeout: float):
+        """Let the clients finish their requests, then stop the loop."""
+        self.check_for_new_works()
+        self.draining = True
+        for handler in list(self.handlers.values()):
+            handler.drain()
+            handler.check_closed()
+        self.event_manager.call_later(timeout, self.close_handlers,
+                                      'drain timeout')
 
-    def check_pending_works(self):
-        events = self.event_manager.select_events()
-        works = {}
-        for key, mask in events:
-            handler = key.data
-            works.setdefault(handler.id, (handler, [], []))
-            if mask & EVENT_READ:
-                works[handler.id][1].append(key.fileobj)
-            if mask & EVENT_WRITE:
-                works[handler.id][2].append(key.fileobj)
-        return works
+    def handle_works(self, events):
+        for conn, mask in events.items():
+            handler: HttpProxyHandler = conn.event_data
+            self.current_handler = handler
+            if conn.is_closed():
+                # closed while handling an earlier event of this batch
+                continue
+            try:
+                if mask & EVENT_READ:
+                    try:
+                        handler.read_from(conn)
+                    except (ssl.SSLWantReadError, BlockingIOError):
+                        pass
+                if mask & EVENT_WRITE and not conn.is_closed():
+                    try:
+                        handler.write_to(conn)
+                    except (ssl.SSLWantWriteError, BlockingIOError):
+                        pass
+            except OSError as e:
+                logger.warning('Handler %s failed: %r', handler.id, e)
+                handler.set_close_reason('%s: %s' % (type(e).__name__, e))
+                handler.close()
+            if handler.is_closed():
+                self.remove_handler(handler)
+            elif not conn.is_closed() and conn.get_interest() & EVENT_READ:
+                # out of budget with TLS records already decrypted
+                self.event_manager.requeue(conn)
 
-    def handle_works(self, works: dict):
-        for handler, readables, writables in works.values():
-            handler: HttpProxyHandler
-            for fo in readables:
-                try:
-                    handler.read_from_fd(fo.fileno())
-                except (ssl.SSLWantReadError, BlockingIOError):
-                    pass
-            for fo in writables:
-                try:
-                    handler.write_to_fd(fo.fileno())
-                except (ssl.SSLWantWriteError, BlockingIOError):
-                    pass
+    def report_lag(self, started: float, elapsed: float):
+        sample = self.lag_sample
+        if sample is None or sample[0] != started:
+            # over before the watchdog looked, the last handler is a guess
+            handler = self.current_handler
+            sample = (started, handler.id if handler else None, None, None)
+        _, handler_id, operation, stack = sample
+        self.metrics.inc('loop_lags')
+        watchdog.records.append({
+            'time': time.time(), 'thread': threading.current_thread().name,
+            'seconds': round(elapsed, 6), 'handler': handler_id,
+            'operation': operation, 'stack': stack})
+        logger.warning('Loop iteration took %.1f ms, handler %s in %s',
+                       elapsed * 1000, handler_id, operation or 'unknown')
 
     def run_forever(self):
+        self.thread_ident = threading.get_ident()
         try:
-            while True:
-                self.clear_works()
+            while not self.draining or self.handlers:
+                selected = self.event_manager.wait()
+                # the iteration is everything but the sleep: callbacks
+                # (certificates, resolved names, cache fetches), timers,
+                # accepts, then the ready connections
+                started = time.monotonic()
+                self.iteration_started = started
+                events = self.event_manager.dispatch(selected)
                 self.check_for_new_works()
-                events = self.get_events()
-                self.update_events(events)
-                works = self.check_pending_works()
-                self.handle_works(works)
+                self.handle_works(events)
+                elapsed = time.monotonic() - started
+                self.iteration_started = 0.0
+                self.metrics.observe('loop_iteration_seconds', elapsed)
+                if 0 < self.lag_threshold <= elapsed:
+                    self.report_lag(started, elapsed)
+                self.current_handler = None
         except KeyboardInterrupt:
             pass
         finally:
-            for handler in self.handlers.values():
-                self.event_manager.unregister(handler.client)
-                if not handler.client.is_closed():
-                    handler.client.close()
-                if handler.upstream:
-                    self.event_manager.unregister(handler.upstream)
-                    if not handler.upstream.is_closed():
-                        handler.upstream.close()
-
+            self.close_handlers('shutdown')
+            self.upstream_pool.close()
@@ -0,0 +1,79 @@
+import json
+import os
+import tempfile
+import unittest
+
+from proxy.access_log import AccessLog, AccessRecorder
+from proxy.http_parser import HttpParser
+
+
+def request(head=b'GET http://example.com/a?b HTTP/1.1\r\n\r\n'):
+    parser = HttpParser()
+    parser.parse(head)
+    return parser
+
+
+class TestAccessLog(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'access.log')
+        self.access_log = AccessLog(self.path, batch_size=2)
+        self.access_log.start()
+        self.addCleanup(self.access_log.close)
+
+    def records(self):
+        self.access_log.close()
+        with open(self.path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_background_writes(self):
+        for i in range(5):
+            self.access_log.log({'handler': i})
+        # in batches of at most two, all of them by the close
+        self.assertEqual(self.records(), [{'handler': i} for i in range(5)])
+
+    def test_dropped_when_full(self):
+        access_log = AccessLog(self.path, max_queue=2)
+        for i in range(3):
+            access_log.log({'handler': i})
+        self.assertEqual(access_log.dropped, 1)
+
+    def test_recorder(self):
+        recorder = AccessRecorder(self.access_log, 7, ('192.0.2.1', 5000))
+        recorder.start(request())
+        recorder.update(status=200, encoding='gzip')
+        recorder.finish(100, 1000, 'complete')
+        # a record per request, with the bytes since the previous one
+        recorder.start(request(b'POST http://example.com/ HTTP/1.1\r\n'
+                               b'Content-Length: 3\r\n\r\n'))
+        recorder.set_close_reason('client closed')
+        recorder.set_close_reason('upstream closed')
+        recorder.finish(150, 1100)
+        # nothing without a request
+        recorder.finish(200, 1200)
+        first, second = self.records()
+        self.assertEqual(
+            {k: first[k] for k in ('handler', 'client', 'method', 'host',
+                                   'port', 'target', 'status', 'encoding',
+                                   'bytes_in', 'bytes_out', 'reason')},
+            {'handler': 7, 'client': '192.0.2.1:5000', 'method': 'GET',
+             'host': 'example.com', 'port': 80,
+             'target': 'http://example.com/a?b', 'status': 200,
+             'encoding': 'gzip', 'bytes_in': 100, 'bytes_out': 1000,
+             'reason': 'complete'})
+        self.assertEqual((second['method'], second['bytes_in'],
+                          second['bytes_out'], second['reason']),
+                         ('POST', 50, 100, 'client closed'))
+
+    def test_recorder_without_log(self):
+        recorder = AccessRecorder(None, 1, None)
+        recorder.start(request())
+        recorder.finish(1, 1)
+        self.assertIsNone(recorder.record)
+        self.assertIsNone(recorder.client)
+
+
+if __name__ == '__main__':
+    unittest.main()
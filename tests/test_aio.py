@@ -0,0 +1,51 @@
+import asyncio
+import socket
+import threading
+import time
+import unittest
+
+from proxy import __main__  # noqa: F401, the flags
+from proxy.aio import AsyncProxyServer, set_result_once
+from proxy.flag import flags
+
+
+class TestAsyncProxyServer(unittest.TestCase):
+
+    def setUp(self):
+        flags.parse_args(['--engine', 'asyncio', '--access-log', '',
+                          '--connect-timeout', '5'])
+        self.server = AsyncProxyServer('127.0.0.1', 0)
+        thread = threading.Thread(target=asyncio.run,
+                                  args=(self.server.serve(),), daemon=True)
+        thread.start()
+        self.addCleanup(thread.join, 5)
+        deadline = time.monotonic() + 5
+        while self.server.stopped is None:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+        self.addCleanup(self.server.loop.call_soon_threadsafe,
+                        set_result_once, self.server.stopped, None)
+        self.port = self.server.server.sockets[0].getsockname()[1]
+
+    def request(self, head: bytes) -> bytes:
+        client = socket.create_connection(('127.0.0.1', self.port),
+                                          timeout=5)
+        self.addCleanup(client.close)
+        client.sendall(head)
+        received = b''
+        while True:
+            data = client.recv(4096)
+            if not data:
+                return received
+            received += data
+
+    def test_label_too_long(self):
+        # the IDNA codec raises a UnicodeError
+        host = b'a' * 64 + b'.example'
+        response = self.request(b'GET http://' + host + b'/ HTTP/1.1\r\n'
+                                b'Host: ' + host + b'\r\n\r\n')
+        self.assertTrue(response.startswith(b'HTTP/1.1 502 '), response)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+import time
+import unittest
+
+from proxy.cache import HttpCache, cache_key
+from proxy.http_parser import HttpParser, RESPONSE_PARSER
+
+
+def request(target=b'http://example.com/a'):
+    parser = HttpParser()
+    parser.parse(b'GET ' + target + b' HTTP/1.1\r\n\r\n')
+    return parser
+
+
+def response(head: bytes):
+    parser = HttpParser(RESPONSE_PARSER)
+    parser.request_method = 'GET'
+    parser.parse(head + b'\r\n')
+    return parser
+
+
+def headers(head: bytes):
+    return [line for line in head.split(b'\r\n')[1:] if line]
+
+
+class TestHttpCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = HttpCache(memory_size=10000, max_object_size=10000)
+
+    def store(self, head, body=b'body', target=b'http://example.com/a'):
+        req, resp = request(target), response(head)
+        expires = self.cache.freshness(req, resp)
+        self.assertIsNotNone(expires)
+        self.cache.store(req, resp, expires, [body])
+        return self.cache.lookup(req)
+
+    def assertAccounted(self):
+        self.assertEqual(self.cache.memory_used,
+                         sum(e.memory_cost() for e in
+                             self.cache.memory.values()))
+
+    def test_store_and_serve(self):
+        entry = self.store(b'HTTP/1.1 200 OK\r\nContent-Length: 4\r\n'
+                           b'Cache-Control: max-age=60\r\nAge: 10\r\n')
+        self.assertTrue(entry.is_fresh())
+        self.assertAlmostEqual(entry.expires, time.time() + 50, delta=1)
+        head, body = self.cache.serve(entry)
+        self.assertEqual(bytes(body), b'body')
+        self.assertEqual(headers(head), [b'Content-Length: 4',
+                                         b'Cache-Control: max-age=60',
+                                         b'Age: 0'])
+        self.assertAccounted()
+
+    def test_not_stored(self):
+        for head in (b'HTTP/1.1 200 OK\r\nContent-Length: 4\r\n'
+                     b'Cache-Control: no-store\r\n',
+                     b'HTTP/1.1 200 OK\r\nContent-Length: 4\r\n'
+                     b'Cache-Control: max-age=60\r\nSet-Cookie: a=b\r\n',
+                     b'HTTP/1.1 206 Partial Content\r\nContent-Length: 4\r\n'
+                     b'Cache-Control: max-age=60\r\n',
+                     b'HTTP/1.1 200 OK\r\nContent-Length: 4\r\n'):
+            with self.subTest(head=head):
+                self.assertIsNone(self.cache.freshness(request(),
+                                                       response(head)))
+
+    def test_refresh(self):
+        entry = self.store(b'HTTP/1.1 200 OK\r\nContent-Length: 4\r\n'
+                           b'Cache-Control: max-age=1\r\nETag: "v1"\r\n'
+                           b'X-Kept: 1\r\n')
+        entry.stored_at -= 100
+        entry.expires = time.time() - 99
+        self.assertFalse(entry.is_fresh())
+        self.cache.refresh(entry, response(
+            b'HTTP/1.1 304 Not Modified\r\nCache-Control: max-age=300\r\n'
+            b'ETag: "v2"\r\nX-New: a longer header than before\r\n'
+            b'Content-Length: 0\r\nAge: 5\r\n'))
+        self.assertTrue(entry.is_fresh())
+        self.assertAlmostEqual(entry.expires, time.time() + 295, delta=1)
+        self.assertEqual(entry.etag, b'"v2"')
+        head, body = self.cache.serve(entry)
+        self.assertEqual(bytes(body), b'body')
+        # the age starts over, the 304's headers replace the stored ones,
+        # but not the framing
+        self.assertEqual(headers(head), [
+            b'Content-Length: 4', b'X-Kept: 1',
+            b'Cache-Control: max-age=300', b'ETag: "v2"',
+            b'X-New: a longer header than before', b'Age: 5'])
+        self.assertAccounted()
+
+    def test_refresh_freshness_from_stored_headers(self):
+        entry = self.store(b'HTTP/1.1 200 OK\r\nContent-Length: 4\r\n'
+                           b'Cache-Control: max-age=60\r\nETag: "v1"\r\n')
+        entry.expires = time.time() - 1
+        # a 304 without Cache-Control keeps the stored lifetime
+        self.cache.refresh(entry, response(
+            b'HTTP/1.1 304 Not Modified\r\nETag: "v1"\r\n'))
+        self.assertAlmostEqual(entry.expires, time.time() + 60, delta=1)
+
+    def test_memory_eviction_counts_heads(self):
+        head = b'HTTP/1.1 200 OK\r\nContent-Length: 100\r\n' \
+               b'Cache-Control: max-age=60\r\nX-Padding: ' + \
+               b'p' * 900 + b'\r\n'
+        for i in range(20):
+            self.store(head, b'b' * 100, b'http://example.com/%d' % i)
+        self.assertAccounted()
+        self.assertLessEqual(self.cache.memory_used, 10000)
+        # the heads are ten times the bodies, fewer than 20 entries fit
+        self.assertLess(len(self.cache.memory), 10)
+        self.assertIn('example.com:80/19', self.cache.memory)
+
+    def test_cache_key(self):
+        self.assertEqual(cache_key(request(b'http://Example.com:8080/a?b')),
+                         'example.com:8080/a?b')
+        self.assertEqual(cache_key(request(b'http://example.com')),
+                         'example.com:80/')
+
+
+if __name__ == '__main__':
+    unittest.main()
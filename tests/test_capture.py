@@ -0,0 +1,299 @@
+import io
+import ipaddress
+import json
+import os
+import struct
+import tempfile
+import unittest
+from unittest import mock
+
+from proxy.capture import (IPV4_HEADER, IPV6_HEADER, MAX_SEGMENT, TCP_HEADER,
+                           Capture, CaptureRing, DataEvent, Exchange,
+                           HttpEvent, PcapngWriter, dechunk)
+
+CLIENT = ('192.0.2.1', 50000)
+SERVER = ('198.51.100.7', 80)
+
+
+def http_event(stream=1, target=b'/a', response_head=None,
+               response_body=b'', request_body=b''):
+    if response_head is None:
+        response_head = (b'HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\n'
+                         b'Content-Length: %d\r\n\r\n' % len(response_body))
+    return HttpEvent(
+        stream, CLIENT, SERVER, 'example.com', 80, 'http', 1700000000.25,
+        0.5, b'GET ' + target + b' HTTP/1.1\r\nHost: example.com\r\n\r\n',
+        request_body, response_head, response_body, False)
+
+
+def data_event(direction, data, stream=2, server=SERVER):
+    return DataEvent(stream, CLIENT, server, 'example.com', 443,
+                     1700000000.0, direction, data)
+
+
+class TestCaptureRing(unittest.TestCase):
+
+    def test_drops_when_full(self):
+        ring = CaptureRing(100)
+        self.assertTrue(ring.push('a', 60))
+        self.assertTrue(ring.push('b', 40))
+        # nothing is evicted, the new event is dropped
+        self.assertFalse(ring.push('c', 1))
+        self.assertEqual(ring.pop(), 'a')
+        self.assertFalse(ring.push('d', 61))
+        self.assertTrue(ring.push('e', 60))
+        self.assertEqual([ring.pop(), ring.pop()], ['b', 'e'])
+        self.assertRaises(IndexError, ring.pop)
+        self.assertEqual(ring.pushed, ring.popped)
+
+    def test_larger_than_ring(self):
+        ring = CaptureRing(10)
+        self.assertFalse(ring.push('a', 11))
+        self.assertTrue(ring.push('b', 10))
+
+
+class TestExchange(unittest.TestCase):
+
+    def test_truncated(self):
+        exchange = Exchange('http', b'GET / HTTP/1.1\r\n\r\n')
+        with mock.patch('proxy.capture.CAPTURE_MAX_BODY', 10):
+            exchange.add_request_body(memoryview(b'0123'))
+            exchange.add_response_body(b'456789')
+            exchange.add_response_body(b'x')
+        event = exchange.event(1, CLIENT, SERVER, 'example.com', 80)
+        self.assertEqual(event.request_body, b'0123')
+        self.assertEqual(event.response_body, b'456789')
+        self.assertTrue(event.truncated)
+        self.assertIsNone(event.response_head)
+        self.assertEqual(exchange.size(), 18 + 10)
+
+
+class TestDechunk(unittest.TestCase):
+
+    def test_dechunk(self):
+        self.assertEqual(dechunk(b'5\r\nhello\r\n6;ext=1\r\n world\r\n'
+                                 b'0\r\nTrailer: x\r\n\r\n'), b'hello world')
+        self.assertEqual(dechunk(b'A\r\n0123456789\r\n0\r\n\r\n'),
+                         b'0123456789')
+        self.assertEqual(dechunk(b''), b'')
+
+    def test_malformed(self):
+        # as much as is well formed
+        self.assertEqual(dechunk(b'5\r\nhello\r\nzz\r\nmore\r\n'), b'hello')
+        self.assertEqual(dechunk(b'5\r\nhello\r\n5'), b'hello')
+        self.assertEqual(dechunk(b'5\r\nhel'), b'hel')
+
+
+class CaptureTestCase(unittest.TestCase):
+
+    fmt = 'har'
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def capture(self, file_size=1 << 20, files=10, hosts=()):
+        capture = Capture(self.directory, self.fmt, hosts, 1.0, file_size,
+                          files)
+        self.addCleanup(capture.close_file)
+        return capture
+
+    def files(self):
+        return sorted(os.listdir(self.directory))
+
+    def read(self, name, mode='r'):
+        with open(os.path.join(self.directory, name), mode) as f:
+            return f.read()
+
+
+class TestHarWriter(CaptureTestCase):
+
+    def entries(self, name):
+        return json.loads(self.read(name))['log']['entries']
+
+    def test_valid_across_batches(self):
+        capture = self.capture()
+        ring = capture.ring(1 << 20)
+        ring.push(http_event(response_body=b'one'), 1)
+        capture.drain()
+        [name] = self.files()
+        self.assertEqual(len(self.entries(name)), 1)
+        ring.push(http_event(2, b'/b', response_body=b'two'), 1)
+        # tunnel bytes are left out of HAR
+        ring.push(data_event(0, b'\x16\x03\x01'), 1)
+        capture.drain()
+        entries = self.entries(name)
+        self.assertEqual([e['request']['url'] for e in entries],
+                         ['http://example.com/a', 'http://example.com/b'])
+        self.assertEqual([e['response']['content']['text'] for e in entries],
+                         ['one', 'two'])
+        self.assertEqual(entries[0]['serverIPAddress'], SERVER[0])
+        self.assertEqual(entries[0]['startedDateTime'],
+                         '2023-11-14T22:13:20.250Z')
+        self.assertEqual(entries[0]['time'], 500.0)
+        capture.close_file()
+        self.assertEqual(len(self.entries(name)), 2)
+
+    def test_response_bodies(self):
+        capture = self.capture()
+        ring = capture.ring(1 << 20)
+        ring.push(http_event(response_head=(
+            b'HTTP/1.1 200 OK\r\nContent-Type: text/html\r\n'
+            b'Transfer-Encoding: chunked\r\n\r\n'),
+            response_body=b'5\r\nhello\r\n0\r\n\r\n'), 1)
+        ring.push(http_event(response_body=b'\xff\xfe'), 1)
+        ring.push(http_event(request_body=b'a=1')._replace(
+            response_head=None), 1)
+        capture.drain()
+        chunked, binary, incomplete = self.entries(self.files()[0])
+        self.assertEqual(chunked['response']['content'],
+                         {'size': 5, 'mimeType': 'text/html',
+                          'text': 'hello'})
+        self.assertEqual(chunked['response']['bodySize'], 15)
+        self.assertEqual(binary['response']['content']['text'], '//4=')
+        self.assertEqual(binary['response']['content']['encoding'],
+                         'base64')
+        self.assertEqual(incomplete['response']['status'], 0)
+        self.assertEqual(incomplete['request']['postData']['text'], 'a=1')
+
+    def test_rotation(self):
+        capture = self.capture(file_size=2000, files=3)
+        ring = capture.ring(1 << 20)
+        for i in range(12):
+            ring.push(http_event(i, b'/%d' % i, response_body=b'x' * 500), 1)
+            capture.drain()
+        names = self.files()
+        # the oldest files are removed
+        self.assertEqual(len(names), 3)
+        self.assertNotIn('capture-%d-0001.har' % os.getpid(), names)
+        urls = []
+        for name in names:
+            urls += [e['request']['url'] for e in self.entries(name)]
+        self.assertEqual(urls[-1], 'http://example.com/11')
+        self.assertEqual(urls, sorted(urls, key=lambda u: int(u[19:])))
+
+    def test_wants(self):
+        capture = self.capture(hosts=['Example.com'])
+        self.assertTrue(capture.wants('example.com'))
+        self.assertTrue(capture.wants('www.EXAMPLE.com'))
+        self.assertFalse(capture.wants('notexample.com'))
+        self.assertFalse(capture.wants(None))
+
+
+def read_blocks(data: bytes):
+    blocks = []
+    pos = 0
+    while pos < len(data):
+        block_type, length = struct.unpack_from('<II', data, pos)
+        assert length % 4 == 0
+        assert struct.unpack_from('<I', data, pos + length - 4)[0] == length
+        blocks.append((block_type, data[pos + 8:pos + length - 4]))
+        pos += length
+    return blocks
+
+
+def read_packets(data: bytes):
+    """(src, dst, sport, dport, seq, ack, payload) of the packets."""
+    packets = []
+    for block_type, body in read_blocks(data)[2:]:
+        assert block_type == 6
+        _, _, _, captured, length = struct.unpack_from('<IIIII', body)
+        assert captured == length
+        packet = body[20:20 + captured]
+        if packet[0] >> 4 == 4:
+            header = IPV4_HEADER.unpack_from(packet)
+            assert header[2] == len(packet)
+            src, dst = header[8], header[9]
+            ip_size = IPV4_HEADER.size
+        else:
+            header = IPV6_HEADER.unpack_from(packet)
+            assert header[1] == len(packet) - IPV6_HEADER.size
+            src, dst = header[4], header[5]
+            ip_size = IPV6_HEADER.size
+        sport, dport, seq, ack = TCP_HEADER.unpack_from(packet, ip_size)[:4]
+        packets.append((src, dst, sport, dport, seq, ack,
+                        packet[ip_size + TCP_HEADER.size:]))
+    return packets
+
+
+class TestPcapngWriter(unittest.TestCase):
+
+    def write(self, *events) -> bytes:
+        f = io.BytesIO()
+        writer = PcapngWriter(f)
+        for event in events:
+            writer.write(event)
+        writer.sync()
+        return f.getvalue()
+
+    def test_blocks(self):
+        blocks = read_blocks(self.write())
+        self.assertEqual([block_type for block_type, _ in blocks],
+                         [0x0A0D0D0A, 1])
+        self.assertEqual(struct.unpack('<IHHq', blocks[0][1]),
+                         (0x1A2B3C4D, 1, 0, -1))
+        self.assertEqual(struct.unpack('<HHI', blocks[1][1]), (101, 0, 0))
+
+    def test_http_event(self):
+        event = http_event(response_body=b'hello')
+        data = self.write(event)
+        request, response = read_packets(data)
+        client, server = bytes([192, 0, 2, 1]), bytes([198, 51, 100, 7])
+        sent = event.request_head
+        received = event.response_head + b'hello'
+        self.assertEqual(request, (client, server, 50000, 80, 1, 1, sent))
+        self.assertEqual(response, (server, client, 80, 50000, 1,
+                                    1 + len(sent), received))
+        # the timestamp of the response is when the exchange ended
+        timestamps = [struct.unpack_from('<II', body, 4)
+                      for _, body in read_blocks(data)[2:]]
+        self.assertEqual([high << 32 | low for high, low in timestamps],
+                         [1700000000250000, 1700000000750000])
+
+    def test_ipv4_checksum(self):
+        packet = read_blocks(self.write(http_event()))[2][1][20:]
+        words = struct.unpack('!10H', packet[:20])
+        self.assertEqual(sum(words) % 0xffff, 0)
+
+    def test_sequence_numbers(self):
+        big = bytes(range(256)) * 300
+        events = [data_event(0, b'hello'), data_event(1, big),
+                  data_event(0, b'bye'), data_event(0, b'other', stream=3)]
+        packets = read_packets(self.write(*events))
+        self.assertEqual(len(big) // MAX_SEGMENT + 1, 2)
+        self.assertEqual([(p[4], p[5], len(p[6])) for p in packets], [
+            (1, 1, 5),
+            # split in segments, within the IP length field
+            (1, 6, MAX_SEGMENT), (1 + MAX_SEGMENT, 6, len(big) - MAX_SEGMENT),
+            (6, 1 + len(big), 3),
+            # another stream starts over
+            (1, 1, 5)])
+        self.assertEqual(b''.join(p[6] for p in packets[1:3]), big)
+
+    def test_mixed_families(self):
+        event = data_event(0, b'hello', server=('2001:db8::1', 443, 0, 0))
+        [packet] = read_packets(self.write(event))
+        self.assertEqual(packet[0],
+                         b'\0' * 10 + b'\xff\xff' + bytes([192, 0, 2, 1]))
+        self.assertEqual(packet[1], ipaddress.ip_address('2001:db8::1').packed)
+        self.assertEqual(packet[2:4], (50000, 443))
+
+    def test_capture_files(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        capture = Capture(directory.name, 'pcapng', (), 1.0, 1 << 20, 10)
+        ring = capture.ring(1 << 20)
+        ring.push(http_event(), 1)
+        capture.drain()
+        ring.push(data_event(0, b'hello'), 1)
+        capture.drain()
+        capture.close_file()
+        [name] = os.listdir(directory.name)
+        self.assertTrue(name.endswith('.pcapng'))
+        with open(os.path.join(directory.name, name), 'rb') as f:
+            self.assertEqual(len(read_packets(f.read())), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+import unittest
+from unittest import mock
+
+from proxy import cert
+from proxy.cert import CertificateHelper, cert_name
+
+
+class PublicSuffixesStub:
+    """is_private of publicsuffixlist, on a few suffixes."""
+
+    PUBLIC = {'com', 'de', 'uk', 'co.uk', 'io', 'github.io'}
+
+    def is_private(self, domain):
+        labels = domain.split('.')
+        return domain not in self.PUBLIC and any(
+            '.'.join(labels[i:]) in self.PUBLIC
+            for i in range(1, len(labels)))
+
+
+class TestCertName(unittest.TestCase):
+
+    def test_wildcards(self):
+        with mock.patch.object(cert, 'public_suffixes', PublicSuffixesStub()):
+            for hostname, name in (
+                    ('www.bmw.de', '*.bmw.de'),
+                    ('www.example.com', '*.example.com'),
+                    ('a.b.example.com', '*.b.example.com'),
+                    ('www.example.co.uk', '*.example.co.uk'),
+                    # the parent is a public suffix
+                    ('example.com', 'example.com'),
+                    ('example.co.uk', 'example.co.uk'),
+                    ('user.github.io', 'user.github.io'),
+                    ('localhost', 'localhost'),
+                    ('192.0.2.1', '192.0.2.1'),
+                    ('2001:db8::1', '2001:db8::1')):
+                with self.subTest(hostname=hostname):
+                    self.assertEqual(cert_name(hostname), name)
+
+    def test_without_public_suffixes(self):
+        with mock.patch.object(cert, 'public_suffixes', None):
+            self.assertEqual(cert_name('www.bmw.de'), 'www.bmw.de')
+            self.assertEqual(cert_name('a.b.example.com'),
+                             'a.b.example.com')
+
+    @unittest.skipIf(cert.public_suffixes is None,
+                     'publicsuffixlist is not installed')
+    def test_public_suffix_list(self):
+        self.assertEqual(cert_name('www.bmw.de'), '*.bmw.de')
+        self.assertEqual(cert_name('a.co.uk'), 'a.co.uk')
+
+    def test_subject_alt_names(self):
+        self.assertEqual(CertificateHelper.subject_alt_names('*.example.com'),
+                         [('DNS', '*.example.com'), ('DNS', 'example.com')])
+        self.assertEqual(CertificateHelper.subject_alt_names('::1'),
+                         [('IP', '::1')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,255 @@
+from concurrent.futures import ThreadPoolExecutor
+import queue
+import threading
+import unittest
+import zlib
+
+from proxy.compress import (ENCODERS, Compression, CompressionStream,
+                            GzipEncoder, compressed_head,
+                            parse_accept_encoding)
+from proxy.http_parser import HttpParser, RESPONSE_PARSER
+
+TYPES = (b'text/', b'application/json')
+
+
+def request(accept_encoding=b'gzip', method=b'GET', version=b'HTTP/1.1'):
+    parser = HttpParser()
+    head = method + b' http://a/ ' + version + b'\r\n'
+    if accept_encoding is not None:
+        head += b'Accept-Encoding: ' + accept_encoding + b'\r\n'
+    parser.parse(head + b'\r\n')
+    return parser
+
+
+def response(headers=b'Content-Type: text/html\r\nContent-Length: 5000\r\n',
+             status_line=b'HTTP/1.1 200 OK'):
+    parser = HttpParser(RESPONSE_PARSER)
+    parser.request_method = 'GET'
+    parser.parse(status_line + b'\r\n' + headers + b'\r\n')
+    return parser
+
+
+def dechunk(data: bytes) -> bytes:
+    parser = HttpParser(RESPONSE_PARSER)
+    parser.request_method = 'GET'
+    body = bytearray()
+    parser.on_body = body.extend
+    parser.parse(b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n')
+    parser.parse(data)
+    assert parser.is_completed()
+    return bytes(body)
+
+
+class TestAcceptEncoding(unittest.TestCase):
+
+    def test_parse(self):
+        self.assertEqual(parse_accept_encoding(None), {})
+        self.assertEqual(
+            parse_accept_encoding(b'gzip, BR;q=0.5 , identity;q=0, *;q=x'),
+            {b'gzip': 1.0, b'br': 0.5, b'identity': 0.0, b'*': 0.0})
+        self.assertEqual(parse_accept_encoding(b', ,gzip;level=1;q=0.1'),
+                         {b'gzip': 0.1})
+
+
+class TestChoose(unittest.TestCase):
+
+    def setUp(self):
+        self.compression = Compression(1000, TYPES, 1)
+        self.addCleanup(self.compression.close)
+
+    def choose(self, req, resp):
+        return self.compression.choose(req, resp)
+
+    def test_gzip(self):
+        self.assertIs(self.choose(request(), response()), GzipEncoder)
+        chunked = response(b'Content-Type: application/json; charset=utf-8'
+                           b'\r\nTransfer-Encoding: chunked\r\n')
+        self.assertIs(self.choose(request(), chunked), GzipEncoder)
+        problem = response(b'Content-Type: application/problem+json\r\n'
+                           b'Content-Length: 5000\r\n')
+        self.assertIs(self.choose(request(), problem), GzipEncoder)
+
+    def test_accept_encoding(self):
+        self.assertIsNone(self.choose(request(None), response()))
+        self.assertIsNone(self.choose(request(b'gzip;q=0'), response()))
+        self.assertIsNone(self.choose(request(b'identity'), response()))
+        self.assertIsNone(self.choose(request(b'*;q=0'), response()))
+        self.assertIs(self.choose(request(b'*'), response()), ENCODERS[0])
+        # an explicit q=0 wins over the wildcard
+        self.assertIsNone(self.choose(
+            request(b'*, ' + b', '.join(e.name + b';q=0' for e in ENCODERS)),
+            response()))
+
+    def test_not_eligible(self):
+        cases = {
+            'not 200': (request(), response(
+                status_line=b'HTTP/1.1 206 Partial Content')),
+            'HEAD': (request(method=b'HEAD'), response()),
+            'HTTP/1.0 client': (request(version=b'HTTP/1.0'), response()),
+            'HTTP/1.0 origin': (request(), response(
+                status_line=b'HTTP/1.0 200 OK')),
+            'too small': (request(), response(
+                b'Content-Type: text/html\r\nContent-Length: 999\r\n')),
+            'until close': (request(), response(
+                b'Content-Type: text/html\r\n')),
+            'encoded': (request(), response(
+                b'Content-Type: text/html\r\nContent-Length: 5000\r\n'
+                b'Content-Encoding: gzip\r\n')),
+            'no-transform': (request(), response(
+                b'Content-Type: text/html\r\nContent-Length: 5000\r\n'
+                b'Cache-Control: public, no-transform\r\n')),
+            'image': (request(), response(
+                b'Content-Type: image/png\r\nContent-Length: 5000\r\n')),
+            'no type': (request(), response(b'Content-Length: 5000\r\n')),
+        }
+        for name, (req, resp) in cases.items():
+            with self.subTest(name):
+                self.assertIsNone(self.choose(req, resp))
+
+
+class TestCompressedHead(unittest.TestCase):
+
+    def head_lines(self, headers):
+        return compressed_head(response(headers), b'gzip').split(b'\r\n')
+
+    def test_headers(self):
+        lines = self.head_lines(b'Content-Type: text/html\r\n'
+                                b'Content-Length: 5000\r\n'
+                                b'Accept-Ranges: bytes\r\n'
+                                b'ETag: "v1"\r\n')
+        self.assertEqual(lines, [
+            b'HTTP/1.1 200 OK', b'Content-Type: text/html', b'ETag: W/"v1"',
+            b'Vary: Accept-Encoding', b'Content-Encoding: gzip',
+            b'Transfer-Encoding: chunked', b'', b''])
+
+    def test_weak_etag_kept(self):
+        lines = self.head_lines(b'ETag: W/"v1"\r\nContent-Length: 5000\r\n')
+        self.assertIn(b'ETag: W/"v1"', lines)
+
+    def test_vary(self):
+        for vary, merged in ((b'Origin', b'Origin, Accept-Encoding'),
+                             (b'accept-encoding', b'accept-encoding'),
+                             (b'Origin, Accept-Encoding',
+                              b'Origin, Accept-Encoding'),
+                             (b'*', b'*')):
+            with self.subTest(vary=vary):
+                lines = self.head_lines(b'Vary: ' + vary + b'\r\n'
+                                        b'Content-Length: 5000\r\n')
+                self.assertEqual(
+                    [line for line in lines if line.startswith(b'Vary')],
+                    [b'Vary: ' + merged])
+
+
+class LoopStub:
+    """call_soon_threadsafe queues, ``run`` runs on the test thread."""
+
+    def __init__(self):
+        self.callbacks: queue.Queue = queue.Queue()
+
+    def call_soon_threadsafe(self, callback, *args):
+        self.callbacks.put((callback, args))
+
+    def run_once(self):
+        callback, args = self.callbacks.get(timeout=5)
+        callback(*args)
+
+
+class SlowEncoder:
+    """Records the batches, the first one blocks until released."""
+
+    name = b'slow'
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.batches = []
+        self.running = 0
+
+    def compress(self, data):
+        self.running += 1
+        assert self.running == 1, 'batches compressed concurrently'
+        if not self.batches:
+            self.release.wait(5)
+        self.batches.append(data)
+        self.running -= 1
+        return data.upper()
+
+    def finish(self):
+        return b'!'
+
+
+class FailingEncoder(SlowEncoder):
+
+    def compress(self, data):
+        raise zlib.error('broken')
+
+
+class TestCompressionStream(unittest.TestCase):
+
+    def setUp(self):
+        self.executor = ThreadPoolExecutor(max_workers=4)
+        self.addCleanup(self.executor.shutdown)
+        self.loop = LoopStub()
+        self.outputs = []
+
+    def stream(self, encoder):
+        return CompressionStream(
+            self.executor, encoder, self.loop,
+            lambda data, final: self.outputs.append((data, final)))
+
+    def run_until_final(self):
+        while not self.outputs or not self.outputs[-1][1]:
+            self.loop.run_once()
+
+    def test_gzip_round_trip(self):
+        body = b'{"hello": "world"}\n' * 5000
+        stream = self.stream(GzipEncoder())
+        for i in range(0, len(body), 7000):
+            stream.feed(memoryview(body[i:i + 7000]))
+        stream.finish()
+        self.run_until_final()
+        self.assertTrue(all(data is not None for data, _ in self.outputs))
+        compressed = dechunk(b''.join(data for data, _ in self.outputs))
+        self.assertEqual(zlib.decompress(compressed, 16 + 15), body)
+        self.assertEqual(stream.bytes_in, len(body))
+        self.assertLess(stream.bytes_out, len(body))
+
+    def test_batches_in_order(self):
+        encoder = SlowEncoder()
+        stream = self.stream(encoder)
+        stream.feed(memoryview(b'a'))
+        # fed while the first batch runs, they make the next batch
+        for data in (b'b', b'c', b'd'):
+            stream.feed(memoryview(data))
+        stream.finish()
+        encoder.release.set()
+        self.run_until_final()
+        self.assertEqual(encoder.batches, [b'a', b'bcd'])
+        self.assertEqual(b''.join(data for data, _ in self.outputs),
+                         b'1\r\nA\r\n4\r\nBCD!\r\n0\r\n\r\n')
+        self.assertEqual([final for _, final in self.outputs],
+                         [False, True])
+
+    def test_encoder_error(self):
+        stream = self.stream(FailingEncoder())
+        stream.feed(memoryview(b'a'))
+        stream.feed(memoryview(b'b'))
+        self.run_until_final()
+        self.assertEqual(self.outputs, [(None, True)])
+        # nothing more after a failure
+        stream.finish()
+        self.assertTrue(self.loop.callbacks.empty())
+
+    def test_close(self):
+        encoder = SlowEncoder()
+        stream = self.stream(encoder)
+        stream.feed(memoryview(b'a'))
+        stream.feed(memoryview(b'b'))
+        stream.close()
+        encoder.release.set()
+        self.loop.run_once()
+        self.assertEqual(self.outputs, [])
+        self.assertEqual(encoder.batches, [b'a'])
+
+
+if __name__ == '__main__':
+    unittest.main()
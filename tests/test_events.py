@@ -0,0 +1,72 @@
+import os
+import threading
+import unittest
+from unittest import mock
+
+from proxy.events import EventManager
+
+
+class TestWakeup(unittest.TestCase):
+
+    def setUp(self):
+        self.event_manager = EventManager()
+
+    def tearDown(self):
+        self.event_manager.selector.close()
+
+    @unittest.skipUnless(hasattr(os, 'eventfd'), 'eventfd only')
+    def test_wakeup_while_draining(self):
+        ran = []
+        read = os.eventfd_read
+
+        def wakeup_then_read(fd):
+            # another thread hands a callback over as the loop drains
+            self.event_manager.call_soon_threadsafe(ran.append, 2)
+            return read(fd)
+
+        self.event_manager.call_soon_threadsafe(ran.append, 1)
+        with mock.patch('proxy.events.os.eventfd_read',
+                        side_effect=wakeup_then_read):
+            self.event_manager.select_events()
+        self.event_manager.call_soon_threadsafe(ran.append, 3)
+        # neither handoff is lost, the last one wakes select up
+        while len(ran) < 3:
+            self.assertTrue(self.event_manager.selector.select(timeout=1),
+                            'a wakeup was lost')
+            self.event_manager.run_callbacks()
+        self.assertEqual(ran, [1, 2, 3])
+
+    def test_concurrent_producers(self):
+        producers = 3
+        calls = 20000
+        count = [0]
+        done = threading.Event()
+
+        def increment():
+            count[0] += 1
+            if count[0] == producers * calls:
+                done.set()
+
+        def produce():
+            for _ in range(calls):
+                self.event_manager.call_soon_threadsafe(increment)
+
+        def loop():
+            while not done.is_set():
+                self.event_manager.select_events()
+
+        loop_thread = threading.Thread(target=loop, daemon=True)
+        loop_thread.start()
+        threads = [threading.Thread(target=produce) for _ in range(producers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        loop_thread.join(10)
+        self.assertFalse(loop_thread.is_alive(), 'a wakeup was lost')
+        self.assertEqual(count[0], producers * calls)
+        self.assertFalse(self.event_manager.callbacks)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,153 @@
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+import unittest
+import zlib
+
+from proxy import __main__  # noqa: F401, the flags
+from proxy.access_log import AccessLog
+from proxy.compress import Compression, GzipEncoder
+from proxy.connection import TcpConnection
+from proxy.flag import flags
+from proxy.http_parser import HttpParser, RESPONSE_PARSER
+from proxy.resolver import Resolver
+from proxy.worker import Worker
+
+BODY = b'<p>hello world</p>\n' * 4000
+
+
+class SlowGzipEncoder(GzipEncoder):
+    """Still compressing when the origin closes."""
+
+    def compress(self, data):
+        time.sleep(0.05)
+        return super().compress(data)
+
+
+class SlowCompression(Compression):
+
+    def choose(self, request, response):
+        return SlowGzipEncoder if super().choose(request, response) else None
+
+
+class Origin(threading.Thread):
+    """Answer each connection with ``response``, then close it."""
+
+    def __init__(self, response: bytes):
+        super().__init__(daemon=True)
+        self.response = response
+        self.sock = socket.socket()
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(8)
+        self.port = self.sock.getsockname()[1]
+
+    def run(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            with conn:
+                head = b''
+                while b'\r\n\r\n' not in head:
+                    data = conn.recv(4096)
+                    if not data:
+                        break
+                    head += data
+                conn.sendall(self.response)
+
+    def close(self):
+        self.sock.close()
+
+
+class TestCompressedResponses(unittest.TestCase):
+
+    def setUp(self):
+        flags.parse_args(['--compress', '--access-log', ''])
+        self.compression = SlowCompression(1024, [b'text/'], 1)
+        self.addCleanup(self.compression.close)
+        resolver = Resolver(max_workers=1)
+        self.addCleanup(resolver.executor.shutdown)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.access_log_path = os.path.join(directory.name, 'access.log')
+        self.access_log = AccessLog(self.access_log_path)
+        self.access_log.start()
+        self.addCleanup(self.access_log.close)
+        self.worker = Worker(resolver, access_log=self.access_log,
+                             compression=self.compression)
+        thread = threading.Thread(target=self.worker.run_forever,
+                                  daemon=True)
+        thread.start()
+        self.addCleanup(thread.join, 5)
+        self.addCleanup(self.worker.event_manager.call_soon_threadsafe,
+                        self.worker.drain, 0)
+
+    def start_origin(self, response: bytes) -> int:
+        origin = Origin(response)
+        origin.start()
+        self.addCleanup(origin.close)
+        return origin.port
+
+    def fetch(self, port: int) -> bytes:
+        """The bytes the client gets until the proxy closes it."""
+        client, server = socket.socketpair()
+        self.addCleanup(client.close)
+        server.setblocking(False)
+        self.worker.add_works([TcpConnection(server, ('127.0.0.1', 0))])
+        client.settimeout(5)
+        client.sendall(b'GET http://127.0.0.1:%d/ HTTP/1.1\r\n'
+                       b'Host: 127.0.0.1\r\nAccept-Encoding: gzip\r\n'
+                       b'\r\n' % port)
+        received = b''
+        while True:
+            data = client.recv(65536)
+            if not data:
+                return received
+            received += data
+
+    def records(self):
+        self.access_log.close()
+        with open(self.access_log_path) as f:
+            return [json.loads(line) for line in f]
+
+    def assertGzipped(self, received: bytes):
+        parser = HttpParser(RESPONSE_PARSER)
+        parser.request_method = 'GET'
+        body = bytearray()
+        parser.on_body = body.extend
+        while received:
+            n = parser.parse(received)
+            received = received[n:]
+            if parser.is_completed():
+                break
+        self.assertTrue(parser.is_completed(), 'no terminating chunk')
+        self.assertEqual(parser.get_header(b'content-encoding'), b'gzip')
+        self.assertEqual(zlib.decompress(bytes(body), 16 + 15), BODY)
+
+    def test_origin_closes_after_body(self):
+        port = self.start_origin(
+            b'HTTP/1.1 200 OK\r\nContent-Type: text/html\r\n'
+            b'Content-Length: %d\r\nConnection: close\r\n\r\n' % len(BODY)
+            + BODY)
+        sizes = []
+        for _ in range(3):
+            received = self.fetch(port)
+            self.assertGzipped(received)
+            sizes.append(len(received))
+        # what the client got, not what the origin sent
+        self.assertEqual([r['bytes_out'] for r in self.records()], sizes)
+
+    def test_chunked_origin_closes_after_body(self):
+        port = self.start_origin(
+            b'HTTP/1.1 200 OK\r\nContent-Type: text/html\r\n'
+            b'Transfer-Encoding: chunked\r\n\r\n'
+            b'%x\r\n' % len(BODY) + BODY + b'\r\n0\r\n\r\n')
+        self.assertGzipped(self.fetch(port))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,287 @@
+import unittest
+
+from proxy.http_parser import (HttpParser, HttpParserError, RESPONSE_PARSER,
+                               split_authority)
+
+
+def feed(parser, data, step=None):
+    """Feed ``data`` in pieces of ``step`` bytes until the message is
+    complete, return the body and the bytes left over."""
+    body = bytearray()
+    parser.on_body = body.extend
+    step = step or len(data) or 1
+    pos = 0
+    while pos < len(data) and not parser.is_completed():
+        piece = data[pos:pos + step]
+        n = parser.parse(piece)
+        if parser.is_headers_completed() and n < len(piece):
+            # the head ended inside the piece, the body is fed next
+            pos += n
+            continue
+        pos += len(piece)
+    return bytes(body), data[pos:]
+
+
+def response(request_method='GET'):
+    parser = HttpParser(RESPONSE_PARSER)
+    parser.request_method = request_method
+    return parser
+
+
+class TestRequest(unittest.TestCase):
+
+    def test_absolute_form(self):
+        parser = HttpParser()
+        raw = b'GET http://example.com:8080/a?b=c HTTP/1.1\r\n' \
+              b'Host: example.com:8080\r\nX-Many: 1\r\nX-Many: 2\r\n\r\n'
+        self.assertEqual(parser.parse(raw), len(raw))
+        self.assertTrue(parser.is_completed())
+        self.assertEqual(parser.method, 'GET')
+        self.assertEqual((parser.host, parser.port), ('example.com', 8080))
+        self.assertEqual(parser.raw_head, raw)
+        self.assertEqual(parser.get_header(b'X-Many'), b'1, 2')
+        self.assertEqual([bytes(n) for n, _ in parser.header_list],
+                         [b'Host', b'X-Many', b'X-Many'])
+        self.assertTrue(parser.is_keep_alive())
+
+    def test_origin_form(self):
+        parser = HttpParser(default_port=443)
+        parser.parse(b'GET / HTTP/1.1\r\nHost: example.com\r\n\r\n')
+        self.assertEqual((parser.host, parser.port), ('example.com', 443))
+
+    def test_connect(self):
+        parser = HttpParser()
+        parser.parse(b'CONNECT [::1]:8443 HTTP/1.1\r\n\r\n')
+        self.assertTrue(parser.is_connect())
+        self.assertEqual((parser.host, parser.port), ('::1', 8443))
+
+    def test_content_length(self):
+        raw = b'POST http://a/ HTTP/1.1\r\nContent-Length: 10\r\n\r\n'
+        for step in (1, 7, 1000):
+            with self.subTest(step=step):
+                parser = HttpParser()
+                body, rest = feed(parser, raw + b'0123456789extra', step)
+                self.assertTrue(parser.is_completed())
+                self.assertEqual(body, b'0123456789')
+                self.assertEqual(rest, b'extra')
+                self.assertEqual(parser.content_length, 10)
+
+    def test_head_split_across_reads(self):
+        raw = b'GET http://a/ HTTP/1.1\r\nHost: a\r\n\r\n'
+        # every split of the final CRLFCRLF
+        for cut in range(len(raw) - 4, len(raw)):
+            with self.subTest(cut=cut):
+                parser = HttpParser()
+                self.assertEqual(parser.parse(raw[:cut]), cut)
+                self.assertTrue(parser.is_started())
+                self.assertFalse(parser.is_headers_completed())
+                self.assertEqual(parser.parse(raw[cut:] + b'next'),
+                                 len(raw) - cut)
+                self.assertTrue(parser.is_completed())
+                self.assertEqual(parser.raw_head, raw)
+
+    def test_pipelined(self):
+        data = b'GET http://a/1 HTTP/1.1\r\n\r\n' \
+               b'POST http://a/2 HTTP/1.1\r\nContent-Length: 3\r\n\r\nabc' \
+               b'GET http://a/3 HTTP/1.1\r\n\r\n'
+        targets = []
+        bodies = []
+        while data:
+            parser = HttpParser()
+            body, data = feed(parser, data)
+            self.assertTrue(parser.is_completed())
+            targets.append(parser.target)
+            bodies.append(body)
+        self.assertEqual(targets, [b'http://a/1', b'http://a/2',
+                                   b'http://a/3'])
+        self.assertEqual(bodies, [b'', b'abc', b''])
+
+    def test_leading_empty_lines(self):
+        parser = HttpParser()
+        parser.parse(b'\r\n\r\nGET http://a/ HTTP/1.1\r\n\r\n')
+        self.assertTrue(parser.is_completed())
+        self.assertEqual(parser.method, 'GET')
+
+    def test_header_too_large(self):
+        parser = HttpParser(max_header_size=64)
+        with self.assertRaises(HttpParserError) as cm:
+            parser.parse(b'GET http://a/ HTTP/1.1\r\nX: ' + b'a' * 100)
+        self.assertEqual(cm.exception.status, 431)
+        # also when the head ends in the same read
+        parser = HttpParser(max_header_size=64)
+        with self.assertRaises(HttpParserError) as cm:
+            parser.parse(b'GET http://a/ HTTP/1.1\r\nX: ' + b'a' * 100 +
+                         b'\r\n\r\n')
+        self.assertEqual(cm.exception.status, 431)
+        # a head of exactly the limit is fine
+        raw = b'GET http://a/ HTTP/1.1\r\nX: '
+        raw += b'a' * (64 - len(raw) - 4) + b'\r\n\r\n'
+        parser = HttpParser(max_header_size=64)
+        self.assertEqual(parser.parse(raw), 64)
+
+    def test_invalid(self):
+        for raw in (b'GET /\r\n\r\n',
+                    b'GET http://a/ HTTP/1.1\r\n Folded: x\r\n\r\n',
+                    b'GET http://a/ HTTP/1.1\r\nName : x\r\n\r\n',
+                    b'GET http://a/ HTTP/1.1\r\nContent-Length: 1, 2\r\n\r\n',
+                    b'GET http://a/ HTTP/1.1\r\nContent-Length: -1\r\n\r\n',
+                    b'POST http://a/ HTTP/1.1\r\n'
+                    b'Transfer-Encoding: gzip\r\n\r\n',
+                    b'GET http://a:x/ HTTP/1.1\r\n\r\n'):
+            with self.subTest(raw=raw):
+                with self.assertRaises(HttpParserError) as cm:
+                    HttpParser().parse(raw)
+                self.assertEqual(cm.exception.status, 400)
+
+    def test_keep_alive(self):
+        parser = HttpParser()
+        parser.parse(b'GET http://a/ HTTP/1.0\r\n\r\n')
+        self.assertFalse(parser.is_keep_alive())
+        parser = HttpParser()
+        parser.parse(b'GET http://a/ HTTP/1.1\r\nConnection: close\r\n\r\n')
+        self.assertFalse(parser.is_keep_alive())
+
+
+class TestChunked(unittest.TestCase):
+
+    RAW = b'POST http://a/ HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n' \
+          b'5;ext=1\r\nhello\r\n1a\r\n' + b'x' * 26 + b'\r\n0\r\n' \
+          b'Trailer-One: 1\r\nTrailer-Two: 2\r\n\r\n'
+
+    def test_chunked_with_trailers(self):
+        for step in (1, 2, 3, 5, 64, 4096):
+            with self.subTest(step=step):
+                parser = HttpParser()
+                body, rest = feed(parser, self.RAW + b'next', step)
+                self.assertTrue(parser.chunked)
+                self.assertTrue(parser.is_completed())
+                self.assertEqual(body, b'hello' + b'x' * 26)
+                self.assertEqual(rest, b'next')
+
+    def test_no_trailers(self):
+        parser = HttpParser()
+        body, rest = feed(parser, b'POST http://a/ HTTP/1.1\r\n'
+                                  b'Transfer-Encoding: chunked\r\n\r\n'
+                                  b'3\r\nabc\r\n0\r\n\r\n')
+        self.assertTrue(parser.is_completed())
+        self.assertEqual((body, rest), (b'abc', b''))
+
+    def test_chunk_size_line_split(self):
+        head = b'POST http://a/ HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n'
+        parser = HttpParser()
+        parser.parse(head)
+        for piece in (b'1', b'0', b'\r', b'\n', b'a' * 16, b'\r', b'\n0',
+                      b'\r\n', b'\r', b'\n'):
+            self.assertEqual(parser.parse(piece), len(piece))
+        self.assertTrue(parser.is_completed())
+        self.assertEqual(parser.body_read, 16)
+
+    def test_invalid_chunk_size(self):
+        parser = HttpParser()
+        parser.parse(b'POST http://a/ HTTP/1.1\r\n'
+                     b'Transfer-Encoding: chunked\r\n\r\n')
+        with self.assertRaises(HttpParserError):
+            parser.parse(b'zz\r\n')
+
+    def test_invalid_chunk_end(self):
+        parser = HttpParser()
+        parser.parse(b'POST http://a/ HTTP/1.1\r\n'
+                     b'Transfer-Encoding: chunked\r\n\r\n')
+        with self.assertRaises(HttpParserError):
+            parser.parse(b'3\r\nabcXY')
+
+    def test_chunk_line_too_long(self):
+        parser = HttpParser(max_header_size=1024)
+        parser.parse(b'POST http://a/ HTTP/1.1\r\n'
+                     b'Transfer-Encoding: chunked\r\n\r\n')
+        with self.assertRaises(HttpParserError):
+            for _ in range(5):
+                parser.parse(b'1;' + b'e' * 1000)
+
+
+class TestResponse(unittest.TestCase):
+
+    def test_content_length(self):
+        parser = response()
+        body, rest = feed(parser, b'HTTP/1.1 200 OK\r\nContent-Length: 2\r\n'
+                                  b'\r\nokHTTP/1.1', 3)
+        self.assertEqual(parser.status, 200)
+        self.assertEqual(parser.reason, b'OK')
+        self.assertEqual((body, rest), (b'ok', b'HTTP/1.1'))
+
+    def test_until_close(self):
+        parser = response()
+        body, rest = feed(parser, b'HTTP/1.0 200 OK\r\n\r\nall of it')
+        self.assertFalse(parser.is_completed())
+        self.assertEqual(body, b'all of it')
+
+    def test_interim(self):
+        data = b'HTTP/1.1 100 Continue\r\n\r\n' \
+               b'HTTP/1.1 103 Early Hints\r\nLink: </a>\r\n\r\n' \
+               b'HTTP/1.1 200 OK\r\nContent-Length: 1\r\n\r\nx'
+        statuses = []
+        while data:
+            parser = response('POST')
+            body, data = feed(parser, data)
+            self.assertTrue(parser.is_completed())
+            statuses.append((parser.status, parser.is_interim(), body))
+        self.assertEqual(statuses, [(100, True, b''), (103, True, b''),
+                                    (200, False, b'x')])
+
+    def test_switching_protocols(self):
+        parser = response()
+        body, _ = feed(parser, b'HTTP/1.1 101 Switching Protocols\r\n\r\nws')
+        self.assertFalse(parser.is_interim())
+        self.assertFalse(parser.is_completed())
+        self.assertEqual(body, b'ws')
+
+    def test_head_has_no_body(self):
+        parser = response('HEAD')
+        raw = b'HTTP/1.1 200 OK\r\nContent-Length: 100\r\n\r\n'
+        self.assertEqual(parser.parse(raw + b'HTTP/1.1'), len(raw))
+        self.assertTrue(parser.is_completed())
+
+    def test_no_body_statuses(self):
+        for status in (b'204 No Content', b'304 Not Modified'):
+            with self.subTest(status=status):
+                parser = response()
+                raw = b'HTTP/1.1 ' + status + b'\r\n' \
+                      b'Transfer-Encoding: chunked\r\n' \
+                      b'Content-Length: 5\r\n\r\n'
+                self.assertEqual(parser.parse(raw + b'HTTP/1.1'), len(raw))
+                self.assertTrue(parser.is_completed())
+
+    def test_connect_established(self):
+        parser = response('CONNECT')
+        raw = b'HTTP/1.1 200 Connection established\r\n\r\n'
+        self.assertEqual(parser.parse(raw + b'\x16\x03'), len(raw))
+        self.assertTrue(parser.is_completed())
+
+    def test_chunked_response(self):
+        parser = response()
+        body, rest = feed(parser, b'HTTP/1.1 200 OK\r\n'
+                                  b'Transfer-Encoding: gzip, chunked\r\n\r\n'
+                                  b'2\r\nab\r\n0\r\n\r\n', 1)
+        self.assertTrue(parser.is_completed())
+        self.assertEqual((body, rest), (b'ab', b''))
+
+    def test_invalid_status_line(self):
+        with self.assertRaises(HttpParserError) as cm:
+            response().parse(b'HTTP/1.1 2000 OK\r\n\r\n')
+        self.assertEqual(cm.exception.status, 502)
+
+
+class TestSplitAuthority(unittest.TestCase):
+
+    def test_split_authority(self):
+        self.assertEqual(split_authority('a.example', 80), ('a.example', 80))
+        self.assertEqual(split_authority('user@a:81', 80), ('a', 81))
+        self.assertEqual(split_authority('[2001:db8::1]:82', 80),
+                         ('2001:db8::1', 82))
+        self.assertEqual(split_authority('[::1]', 443), ('::1', 443))
+        with self.assertRaises(HttpParserError):
+            split_authority(':80', 80)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+from http.client import HTTPConnection
+import unittest
+from unittest import mock
+
+from proxy.constants import MAX_PROFILE_SECONDS
+from proxy.metrics import MetricsRegistry, MetricsServer, WorkerMetrics
+
+
+class TestMetricsServer(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = MetricsRegistry()
+        self.metrics = WorkerMetrics({'active_handlers': lambda: 3,
+                                      'pending_bytes': lambda: 0})
+        self.registry.add(self.metrics)
+        self.server = MetricsServer('127.0.0.1', 0, self.registry)
+        self.server.start()
+        self.addCleanup(self.server.stop)
+
+    def get(self, path: str):
+        conn = HTTPConnection('127.0.0.1', self.server.server.server_port,
+                              timeout=5)
+        self.addCleanup(conn.close)
+        conn.request('GET', path)
+        response = conn.getresponse()
+        return response.status, response.read().decode()
+
+    def test_metrics(self):
+        self.metrics.inc('handlers', 2)
+        status, text = self.get('/metrics')
+        self.assertEqual(status, 200)
+        self.assertIn('proxy_handlers_total 2', text)
+        self.assertIn('proxy_active_handlers 3', text)
+
+    def test_profile_seconds(self):
+        with mock.patch('proxy.metrics.profiler.profile',
+                        return_value='a;b 1\n') as profile:
+            for seconds in ('x', 'nan', 'inf', '-1', '0'):
+                with self.subTest(seconds=seconds):
+                    status, _ = self.get('/debug/profile?seconds=' + seconds)
+                    self.assertEqual(status, 400)
+            profile.assert_not_called()
+            self.assertEqual(self.get('/debug/profile?seconds=0.5'),
+                             (200, 'a;b 1\n'))
+            self.get('/debug/profile?seconds=1e9')
+        self.assertEqual([c.args[0] for c in profile.call_args_list],
+                         [0.5, MAX_PROFILE_SECONDS])
+
+    def test_not_found(self):
+        self.assertEqual(self.get('/other')[0], 404)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+import socket
+import unittest
+from unittest import mock
+
+from proxy.connection import TcpConnection
+from proxy.constants import EVENT_READ
+from proxy.events import EventManager
+from proxy.pool import UpstreamPool
+
+KEY = ('example.com', 80, None)
+
+
+class TestUpstreamPool(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch('proxy.timer.time.monotonic',
+                             side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.event_manager = EventManager()
+        self.addCleanup(self.event_manager.selector.close)
+        self.pool = UpstreamPool(self.event_manager, 2, 30)
+        self.addCleanup(self.pool.close)
+
+    def connection(self):
+        """An upstream connection, and the origin's end of it."""
+        sock, peer = socket.socketpair()
+        self.addCleanup(peer.close)
+        sock.setblocking(False)
+        return TcpConnection(sock, None, 'upstream'), peer
+
+    def advance(self, seconds):
+        self.now += seconds
+        self.event_manager.timers.expire()
+
+    def test_checkin_checkout(self):
+        self.assertIsNone(self.pool.checkout(KEY))
+        conn, _ = self.connection()
+        self.event_manager.register(conn, None)
+        conn.pause_reading()
+        self.pool.checkin(KEY, conn)
+        # idle connections are left out of the selector
+        self.assertIsNone(conn.event_manager)
+        self.assertEqual(conn.selected_event, 0)
+        self.assertFalse(conn.read_paused)
+        self.assertIsNone(self.pool.checkout(('example.com', 443, None)))
+        self.assertIsNone(self.pool.checkout(('example.com', 80, '::1')))
+        self.assertIs(self.pool.checkout(KEY), conn)
+        self.assertIsNone(self.pool.checkout(KEY))
+        self.assertEqual(self.pool.idle, {})
+        self.event_manager.register(conn, None)
+        self.assertEqual(conn.selected_event, EVENT_READ)
+
+    def test_most_recent_first(self):
+        first, _ = self.connection()
+        second, _ = self.connection()
+        self.pool.checkin(KEY, first)
+        self.pool.checkin(KEY, second)
+        self.assertIs(self.pool.checkout(KEY), second)
+        self.assertIs(self.pool.checkout(KEY), first)
+
+    def test_max_idle(self):
+        conns = [self.connection()[0] for _ in range(3)]
+        for conn in conns:
+            self.pool.checkin(KEY, conn)
+        other, _ = self.connection()
+        self.pool.checkin(('example.org', 80, None), other)
+        # the oldest one makes room, per key
+        self.assertTrue(conns[0].is_closed())
+        self.assertEqual([c for c, _ in self.pool.idle[KEY]], conns[1:])
+        self.assertFalse(other.is_closed())
+
+    def test_disabled(self):
+        pool = UpstreamPool(self.event_manager, 0, 30)
+        conn, _ = self.connection()
+        pool.checkin(KEY, conn)
+        self.assertTrue(conn.is_closed())
+        self.assertIsNone(pool.checkout(KEY))
+
+    def test_idle_timeout(self):
+        first, _ = self.connection()
+        self.pool.checkin(KEY, first)
+        self.advance(20)
+        second, _ = self.connection()
+        self.pool.checkin(KEY, second)
+        self.advance(11)
+        self.assertTrue(first.is_closed())
+        self.assertFalse(second.is_closed())
+        self.advance(20)
+        self.assertTrue(second.is_closed())
+        self.assertEqual(self.pool.idle, {})
+
+    def test_checkout_cancels_timeout(self):
+        conn, _ = self.connection()
+        self.pool.checkin(KEY, conn)
+        self.assertIs(self.pool.checkout(KEY), conn)
+        self.advance(60)
+        self.assertFalse(conn.is_closed())
+        conn.close()
+
+    def test_health_check(self):
+        healthy, _ = self.connection()
+        closed, peer = self.connection()
+        chatty, chatty_peer = self.connection()
+        self.pool.checkin(KEY, healthy)
+        self.pool.checkin(KEY, closed)
+        peer.close()
+        self.assertIsNone(self.pool.checkout(('other', 80, None)))
+        # the closed one is dropped on the way to the healthy one
+        self.assertIs(self.pool.checkout(KEY), healthy)
+        self.assertTrue(closed.is_closed())
+        self.pool.checkin(KEY, chatty)
+        chatty_peer.sendall(b'HTTP/1.1 408 Request Timeout\r\n\r\n')
+        self.assertIsNone(self.pool.checkout(KEY))
+        self.assertTrue(chatty.is_closed())
+        self.assertEqual(self.pool.idle, {})
+        healthy.close()
+
+    def test_close(self):
+        conns = [self.connection()[0] for _ in range(2)]
+        for conn in conns:
+            self.pool.checkin(KEY, conn)
+        self.pool.close()
+        self.assertTrue(all(conn.is_closed() for conn in conns))
+        self.assertEqual(self.pool.idle, {})
+        self.assertEqual(self.event_manager.timers.count, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
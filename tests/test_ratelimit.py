@@ -0,0 +1,116 @@
+import socket
+import unittest
+from unittest import mock
+
+from proxy import __main__  # noqa: F401, the flags
+from proxy.connection import TcpConnection
+from proxy.constants import RATE_LIMIT_RESUME
+from proxy.flag import flags
+from proxy.http_handler import HttpProxyHandler
+from proxy.ratelimit import TokenBucket
+from proxy.resolver import Resolver
+from proxy.worker import Worker
+
+
+class ClockTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        for target in ('proxy.ratelimit.time.monotonic',
+                       'proxy.timer.time.monotonic'):
+            patcher = mock.patch(target, side_effect=lambda: self.now)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+
+class TestTokenBucket(ClockTestCase):
+
+    def test_refill(self):
+        bucket = TokenBucket(1000, 500)
+        self.assertEqual(bucket.available(), 500)
+        bucket.consume(500)
+        self.assertTrue(bucket.is_empty())
+        self.now += 0.125
+        self.assertEqual(bucket.available(), 125)
+        self.assertFalse(bucket.is_empty())
+        # never more than the burst
+        self.now += 10
+        self.assertEqual(bucket.available(), 500)
+
+    def test_borrow(self):
+        bucket = TokenBucket(1000, 500)
+        # a read may take more than what is left, the bucket owes it
+        bucket.consume(800)
+        self.assertTrue(bucket.is_empty())
+        self.assertEqual(bucket.available(), -300)
+        self.now += 0.25
+        self.assertEqual(bucket.available(), -50)
+        self.now += 0.25
+        self.assertEqual(bucket.available(), 200)
+
+    def test_resume_delay(self):
+        bucket = TokenBucket(1000, 500)
+        bucket.consume(500)
+        # waits for RATE_LIMIT_RESUME seconds worth of tokens
+        self.assertAlmostEqual(bucket.resume_delay(), RATE_LIMIT_RESUME)
+        bucket.consume(100)
+        self.assertAlmostEqual(bucket.resume_delay(),
+                               RATE_LIMIT_RESUME + 0.1)
+        # or the burst, if it is smaller
+        small = TokenBucket(1000, 10)
+        small.consume(10)
+        self.assertAlmostEqual(small.resume_delay(), 0.01)
+        self.now += 1
+        self.assertEqual(small.available(), 10)
+        self.assertEqual(small.resume_delay(), 0)
+
+
+class TestReadBudget(ClockTestCase):
+
+    def handler(self, *args):
+        flags.parse_args(['--access-log', ''] + list(args))
+        resolver = Resolver(max_workers=1)
+        self.addCleanup(resolver.executor.shutdown)
+        worker = Worker(resolver)
+        self.addCleanup(worker.event_manager.selector.close)
+        sock, self.peer = socket.socketpair()
+        self.addCleanup(self.peer.close)
+        sock.setblocking(False)
+        conn = TcpConnection(sock, ('127.0.0.1', 0))
+        handler = HttpProxyHandler(conn, worker)
+        worker.event_manager.register(conn, handler)
+        self.addCleanup(handler.close)
+        # a request head still coming, nothing is forwarded
+        self.peer.sendall(b'GET http://example.com/ HTTP/1.1\r\n' +
+                          b'X-Padding: ' + b'a' * 20000)
+        return handler
+
+    def test_read_budget(self):
+        handler = self.handler('--read-budget', '4096')
+        handler.read_from(handler.client)
+        self.assertEqual(handler.bytes_up, 4096)
+        handler.read_from(handler.client)
+        self.assertEqual(handler.bytes_up, 8192)
+
+    def test_no_read_budget(self):
+        handler = self.handler('--read-budget', '0')
+        handler.read_from(handler.client)
+        self.assertEqual(handler.bytes_up, 20045)
+
+    def test_client_rate(self):
+        handler = self.handler('--read-budget', '4096', '--client-rate',
+                               '1000')
+        # the tokens, a second worth, cap the read below the budget
+        handler.read_from(handler.client)
+        self.assertEqual(handler.bytes_up, 1000)
+        self.assertTrue(handler.client.read_throttled)
+        self.assertIsNotNone(handler.throttle_timer)
+        self.now += RATE_LIMIT_RESUME
+        handler.worker.event_manager.timers.expire()
+        self.assertFalse(handler.client.read_throttled)
+        handler.read_from(handler.client)
+        self.assertEqual(handler.bytes_up, 1100)
+
+
+if __name__ == '__main__':
+    unittest.main()
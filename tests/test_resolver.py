@@ -0,0 +1,119 @@
+import queue
+import socket
+import threading
+import unittest
+from unittest import mock
+
+from proxy.resolver import Resolver
+
+ADDRINFOS = [(socket.AF_INET, socket.SOCK_STREAM, 6, '',
+              ('192.0.2.1', 0))]
+
+
+class StubGetaddrinfo:
+    """Answers from a table, after ``release`` is set."""
+
+    def __init__(self, answers):
+        self.answers = answers
+        self.calls = []
+        self.release = threading.Event()
+        self.release.set()
+
+    def __call__(self, host, port, type=0):
+        self.calls.append(host)
+        self.release.wait(5)
+        answer = self.answers[host]
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+
+class TestResolver(unittest.TestCase):
+
+    def make_resolver(self, answers, **kwargs):
+        self.getaddrinfo = StubGetaddrinfo(answers)
+        resolver = Resolver(getaddrinfo=self.getaddrinfo, **kwargs)
+        self.addCleanup(resolver.executor.shutdown)
+        return resolver
+
+    def resolve(self, resolver, host, port=80):
+        results = queue.Queue()
+        result = resolver.resolve(host, port, results.put)
+        if result is not None:
+            return result
+        return results.get(timeout=5)
+
+    def test_answer_with_port(self):
+        resolver = self.make_resolver({'example.com': ADDRINFOS})
+        addrinfos, error = self.resolve(resolver, 'example.com', 8080)
+        self.assertIsNone(error)
+        self.assertEqual(addrinfos[0][4], ('192.0.2.1', 8080))
+        # from the cache this time
+        self.assertEqual(resolver.resolve('example.com', 443, None),
+                         ([ADDRINFOS[0][:4] + (('192.0.2.1', 443),)], None))
+        self.assertEqual(self.getaddrinfo.calls, ['example.com'])
+
+    def test_literal_address(self):
+        resolver = self.make_resolver({})
+        resolver.getaddrinfo = socket.getaddrinfo
+        addrinfos, error = resolver.resolve('127.0.0.1', 80, None)
+        self.assertIsNone(error)
+        self.assertEqual(addrinfos[0][4], ('127.0.0.1', 80))
+
+    def test_coalescing(self):
+        resolver = self.make_resolver({'example.com': ADDRINFOS})
+        self.getaddrinfo.release.clear()
+        results = queue.Queue()
+        for port in (80, 81, 82):
+            self.assertIsNone(resolver.resolve('example.com', port,
+                                               results.put))
+        self.getaddrinfo.release.set()
+        ports = sorted(results.get(timeout=5)[0][0][4][1] for _ in range(3))
+        self.assertEqual(ports, [80, 81, 82])
+        self.assertEqual(self.getaddrinfo.calls, ['example.com'])
+        self.assertFalse(resolver.pending)
+
+    def test_gaierror_is_cached(self):
+        error = socket.gaierror(socket.EAI_NONAME, 'not known')
+        resolver = self.make_resolver({'nx.example': error},
+                                      negative_ttl=30)
+        self.assertEqual(self.resolve(resolver, 'nx.example'), (None, error))
+        self.assertEqual(resolver.resolve('nx.example', 80, None),
+                         (None, error))
+        self.assertEqual(len(self.getaddrinfo.calls), 1)
+
+    def test_unexpected_error(self):
+        # getaddrinfo raises UnicodeError for a label over 63 characters
+        host = 'a' * 64 + '.com'
+        resolver = self.make_resolver({host: UnicodeError('label too long')})
+        self.getaddrinfo.release.clear()
+        results = queue.Queue()
+        resolver.resolve(host, 80, results.put)
+        resolver.resolve(host, 80, results.put)
+        self.getaddrinfo.release.set()
+        for _ in range(2):
+            addrinfos, error = results.get(timeout=5)
+            self.assertIsNone(addrinfos)
+            self.assertIsInstance(error, UnicodeError)
+        self.assertFalse(resolver.pending)
+
+    def test_ttl_expiry(self):
+        resolver = self.make_resolver({'example.com': ADDRINFOS}, ttl=10)
+        with mock.patch('proxy.resolver.time.monotonic', return_value=100):
+            self.resolve(resolver, 'example.com')
+        with mock.patch('proxy.resolver.time.monotonic', return_value=109):
+            self.assertIsNotNone(resolver.resolve('example.com', 80, None))
+        with mock.patch('proxy.resolver.time.monotonic', return_value=111):
+            self.assertIsNotNone(self.resolve(resolver, 'example.com'))
+        self.assertEqual(self.getaddrinfo.calls, ['example.com'] * 2)
+
+    def test_cache_size(self):
+        answers = {'%d.example' % i: ADDRINFOS for i in range(3)}
+        resolver = self.make_resolver(answers, max_size=2)
+        for host in answers:
+            self.resolve(resolver, host)
+        self.assertEqual(list(resolver.cache), ['1.example', '2.example'])
+
+
+if __name__ == '__main__':
+    unittest.main()
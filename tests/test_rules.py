@@ -0,0 +1,178 @@
+import os
+import tempfile
+import time
+import unittest
+
+from proxy.rules import (ALLOW, DENY, MAX_ROUTES, ROUTE, Rules, RulesError,
+                         RuleSet, compile_file, compile_rules, load)
+
+RULES = '''
+# names
+deny ads.example.com
+deny .tracker.example
+allow www.tracker.example
+deny *.cdn.example
+route .corp.example 192.0.2.10
+route build.corp.example 2001:db8::10
+deny bücher.example
+# addresses
+deny 198.51.100.0/24
+allow 198.51.100.128/25
+route 203.0.113.7 192.0.2.11
+deny 2001:db8:dead::/48
+'''
+
+
+def rule_set(text: str) -> RuleSet:
+    return RuleSet(compile_rules(text.splitlines()))
+
+
+class TestRuleSet(unittest.TestCase):
+
+    def setUp(self):
+        self.rules = rule_set(RULES)
+
+    def assertDecisions(self, decisions):
+        for host, expected in decisions.items():
+            with self.subTest(host=host):
+                self.assertEqual(self.rules.decide(host), expected)
+
+    def test_names(self):
+        self.assertDecisions({
+            'ads.example.com': (DENY, None),
+            'ADS.Example.COM.': (DENY, None),
+            # the host only
+            'x.ads.example.com': (ALLOW, None),
+            'example.com': (ALLOW, None),
+            # the domain and its subdomains
+            'tracker.example': (DENY, None),
+            'a.b.tracker.example': (DENY, None),
+            'notatracker.example': (ALLOW, None),
+            # the most specific rule wins
+            'www.tracker.example': (ALLOW, None),
+            'a.www.tracker.example': (DENY, None),
+            # the subdomains only
+            'cdn.example': (ALLOW, None),
+            'img.cdn.example': (DENY, None),
+            'corp.example': (ROUTE, '192.0.2.10'),
+            'wiki.corp.example': (ROUTE, '192.0.2.10'),
+            'build.corp.example': (ROUTE, '2001:db8::10'),
+            'xn--bcher-kva.example': (DENY, None),
+            '': (ALLOW, None),
+            'example': (ALLOW, None),
+        })
+
+    def test_addresses(self):
+        self.assertDecisions({
+            '198.51.100.1': (DENY, None),
+            # the longest prefix wins
+            '198.51.100.200': (ALLOW, None),
+            '198.51.101.1': (ALLOW, None),
+            '203.0.113.7': (ROUTE, '192.0.2.11'),
+            '203.0.113.8': (ALLOW, None),
+            '2001:db8:dead:1::1': (DENY, None),
+            '2001:db8:beef::1': (ALLOW, None),
+            # a name that looks like a number
+            '1.example.100': (ALLOW, None),
+        })
+
+    def test_default(self):
+        rules = rule_set('default deny\nallow .example.org')
+        self.assertEqual(rules.decide('a.example.org'), (ALLOW, None))
+        self.assertEqual(rules.decide('example.net'), (DENY, None))
+        self.assertEqual(rules.decide('192.0.2.1'), (DENY, None))
+
+    def test_empty(self):
+        rules = rule_set('# nothing\n\n')
+        self.assertEqual(rules.decide('example.com'), (ALLOW, None))
+        self.assertEqual(rules.decide('::1'), (ALLOW, None))
+
+    def test_many_siblings(self):
+        # open addressing tables with collisions
+        rules = rule_set('\n'.join('deny h%d.example' % i
+                                   for i in range(2000)))
+        for i in range(0, 2000, 7):
+            self.assertEqual(rules.lookup('h%d.example' % i), DENY)
+        self.assertEqual(rules.lookup('h2000.example'), 0)
+        self.assertEqual(rules.lookup('h1.example.com'), 0)
+
+    def test_invalid(self):
+        for text in ('block example.com', 'deny', 'deny a b',
+                     'route example.com', 'route example.com not-an-address',
+                     'deny a..example', 'deny ' + 'a' * 64 + '.example',
+                     'default maybe'):
+            with self.subTest(text=text):
+                with self.assertRaisesRegex(RulesError, '^line 1: '):
+                    compile_rules([text])
+
+    def test_too_many_routes(self):
+        def routes(count):
+            for i in range(count):
+                yield 'route h%d.example 10.%d.%d.%d' % (
+                    i, i >> 16, (i >> 8) & 255, i & 255)
+
+        rules = RuleSet(compile_rules(routes(MAX_ROUTES)))
+        self.assertEqual(rules.decide('h%d.example' % (MAX_ROUTES - 1)),
+                         (ROUTE, '10.0.255.252'))
+        with self.assertRaisesRegex(RulesError, 'route addresses'):
+            compile_rules(routes(MAX_ROUTES + 1))
+
+    def test_not_compiled(self):
+        with self.assertRaises(RulesError):
+            RuleSet(b'deny example.com')
+
+
+class TestRulesFile(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def write(self, name: str, text: str) -> str:
+        path = os.path.join(self.directory, name)
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    def test_load(self):
+        text = self.write('rules.txt', RULES)
+        compiled = os.path.join(self.directory, 'rules.bin')
+        compile_file(text, compiled)
+        for path in (text, compiled):
+            with self.subTest(path=path):
+                self.assertEqual(load(path).decide('ads.example.com'),
+                                 (DENY, None))
+        with self.assertRaises(RulesError):
+            load(text, compiled_only=True)
+
+    def wait_for(self, rules, host, expected):
+        deadline = time.monotonic() + 5
+        while rules.decide(host) != expected:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+
+    def test_reload(self):
+        path = os.path.join(self.directory, 'rules.bin')
+        compile_file(self.write('a.txt', 'deny a.example'), path)
+        rules = Rules(path, 0.01)
+        rules.start()
+        self.addCleanup(rules.stop)
+        self.assertEqual(rules.decide('a.example'), (DENY, None))
+        compile_file(self.write('b.txt', 'deny b.example'), path)
+        self.wait_for(rules, 'b.example', (DENY, None))
+        self.assertEqual(rules.decide('a.example'), (ALLOW, None))
+        # a text file is not compiled on the reload thread, the compiled
+        # rules are kept
+        os.replace(self.write('c.txt', 'deny c.example'), path)
+        compile_file(self.write('d.txt', 'deny d.example'),
+                     os.path.join(self.directory, 'd.bin'))
+        time.sleep(0.1)
+        self.assertEqual(rules.decide('c.example'), (ALLOW, None))
+        self.assertEqual(rules.decide('b.example'), (DENY, None))
+        os.replace(os.path.join(self.directory, 'd.bin'), path)
+        self.wait_for(rules, 'd.example', (DENY, None))
+
+
+if __name__ == '__main__':
+    unittest.main()
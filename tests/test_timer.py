@@ -0,0 +1,131 @@
+import unittest
+from unittest import mock
+
+from proxy.timer import HEAP_SLACK, TimerWheel
+
+
+class TestTimerWheel(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch('proxy.timer.time.monotonic',
+                             side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.wheel = TimerWheel(resolution=0.01, size=16)
+        self.fired = []
+
+    def call_later(self, delay, name):
+        return self.wheel.call_later(delay, self.fired.append, name)
+
+    def advance(self, seconds):
+        self.now += seconds
+        self.wheel.expire()
+
+    def test_empty(self):
+        self.assertIsNone(self.wheel.timeout())
+        self.advance(1)
+        self.assertEqual(self.fired, [])
+
+    def test_arm(self):
+        self.call_later(0.05, 'a')
+        self.assertAlmostEqual(self.wheel.timeout(), 0.05)
+        self.advance(0.04)
+        self.assertEqual(self.fired, [])
+        self.advance(0.02)
+        self.assertEqual(self.fired, ['a'])
+        self.assertIsNone(self.wheel.timeout())
+        self.assertEqual(self.wheel.count, 0)
+
+    def test_never_early(self):
+        self.call_later(0.015, 'a')
+        self.advance(0.01)
+        self.assertEqual(self.fired, [])
+        self.advance(0.01)
+        self.assertEqual(self.fired, ['a'])
+
+    def test_expiry_order(self):
+        self.call_later(0.05, 'c')
+        self.call_later(0.02, 'a')
+        self.call_later(0.03, 'b')
+        # all due at once, by deadline
+        self.advance(0.1)
+        self.assertEqual(self.fired, ['a', 'b', 'c'])
+
+    def test_cancel(self):
+        a = self.call_later(0.02, 'a')
+        self.call_later(0.05, 'b')
+        a.cancel()
+        a.cancel()
+        self.assertAlmostEqual(self.wheel.timeout(), 0.05)
+        self.advance(0.1)
+        self.assertEqual(self.fired, ['b'])
+        self.assertEqual(self.wheel.count, 0)
+
+    def test_cancel_from_a_callback(self):
+        b = self.call_later(0.03, 'b')
+        self.wheel.call_later(0.02, b.cancel)
+        self.advance(0.05)
+        self.assertEqual(self.fired, [])
+        self.assertIsNone(self.wheel.timeout())
+
+    def test_reset(self):
+        a = self.call_later(0.02, 'a')
+        a.reset(0.1)
+        self.assertAlmostEqual(self.wheel.timeout(), 0.1)
+        self.advance(0.05)
+        self.assertEqual(self.fired, [])
+        a.reset(0.02)
+        self.advance(0.03)
+        self.assertEqual(self.fired, ['a'])
+        # a fired timer can't be reset
+        a.reset(0.01)
+        self.assertIsNone(self.wheel.timeout())
+
+    def test_wrap_around(self):
+        # 16 slots of 10 ms, 0.35 s is more than two laps away and shares
+        # its slot with the 0.03 s timer
+        self.call_later(0.35, 'far')
+        self.call_later(0.03, 'near')
+        self.assertAlmostEqual(self.wheel.timeout(), 0.03)
+        self.advance(0.05)
+        self.assertEqual(self.fired, ['near'])
+        self.assertAlmostEqual(self.wheel.timeout(), 0.30)
+        for _ in range(5):
+            self.advance(0.05)
+        self.assertEqual(self.fired, ['near'])
+        self.advance(0.06)
+        self.assertEqual(self.fired, ['near', 'far'])
+
+    def test_long_sleep(self):
+        for i in range(40):
+            self.call_later(i * 0.01, i)
+        # more than a lap at once, every timer fires, in order
+        self.advance(1)
+        self.assertEqual(self.fired, list(range(40)))
+        self.assertIsNone(self.wheel.timeout())
+
+    def test_heap_bounded(self):
+        # idle deadlines pushed back by every read
+        timers = [self.call_later(1, i) for i in range(10)]
+        for _ in range(1000):
+            self.now += 0.01
+            for timer in timers:
+                timer.reset(1 + timer.args[0] * 0.01)
+            self.assertLessEqual(len(self.wheel.heap),
+                                 2 * len(self.wheel.ticks) + HEAP_SLACK)
+        self.assertAlmostEqual(self.wheel.timeout(), 1)
+        timers[0].cancel()
+        self.assertAlmostEqual(self.wheel.timeout(), 1.01)
+        self.advance(2)
+        self.assertEqual(self.fired, list(range(1, 10)))
+
+    def test_past_deadline(self):
+        self.call_later(-1, 'a')
+        self.assertEqual(self.wheel.timeout(), 0)
+        self.wheel.expire()
+        self.assertEqual(self.fired, ['a'])
+
+
+if __name__ == '__main__':
+    unittest.main()